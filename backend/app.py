@@ -1,12 +1,36 @@
 """
 Flask API server for gradient removal processing.
+
+`python app.py` runs the development server. In production run it under
+gunicorn with gunicorn.conf.py, which loads this module once before forking
+and warms each worker up with warm_up() before it accepts requests.
 """
 
-from flask import Flask, request, jsonify
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
+import atexit
+import json
 import logging
+import os
+import threading
 import traceback
-from gradient_removal import GradientRemovalProcessor
+import numpy as np
+from gradient_removal import GradientRemovalProcessor, CorrectionAnalysis, ALGORITHM_VERSION
+from calibration import CalibrationProfile, ProfileStore, UnknownProfileError, validate_name
+from image_store import ImageStore, UnknownImageError
+from result_cache import ResultCache
+from pipeline import StagedPipeline, parse_processing_params
+from buffers import WorkingSet
+from tiled_processing import TiledCorrectionEngine
+from parallel import ParallelEngine
+from jobs import JobManager, JobQueueFullError, PRIORITY_FINAL, PRIORITY_PREVIEW
+from batch import BatchRunner, BatchRun, collect_items
+from encoding import ImageEncoder, FORMATS, negotiate_format
+from decoding import ImageDecoder, read_source
+from metrics import REGISTRY, Counter, Gauge, Histogram, INPUT_MEGAPIXELS, BYTE_BUCKETS
 
 # Configure logging
 logging.basicConfig(
@@ -17,16 +41,336 @@ logger = logging.getLogger(__name__)
 
 # Create Flask app
 app = Flask(__name__)
-CORS(app)  # Enable CORS for React frontend
+CORS(app, expose_headers=['X-Image-Id', 'X-Mode', 'X-Quality', 'X-Diagnostics'])  # Enable CORS for React frontend
+
+# Initialize gradient removal processor, splitting heavy stages across cores by row bands
+workers = int(os.environ.get('GRADIENT_REMOVAL_WORKERS', os.cpu_count() or 1))
+processor = GradientRemovalProcessor(
+    parallel=ParallelEngine(workers, kind=os.environ.get('GRADIENT_REMOVAL_EXECUTOR', 'thread')) if workers > 1 else None,
+    # 'pyramid' makes the lighting blurs ~3x faster but not exact (README, Incremental Recompute)
+    blur_mode=os.environ.get('GRADIENT_REMOVAL_BLUR_MODE', 'exact'),
+)
+# Results are encoded with cv2 (faster) or PIL
+processor.encoder = ImageEncoder(backend=os.environ.get('IMAGE_ENCODER_BACKEND', 'cv2'))
+processor.decoder = ImageDecoder(backend=os.environ.get('IMAGE_DECODER_BACKEND', 'cv2'))
+# Quality diagnostics on every Nth request (0 = only when requested), measured on a proxy (0 = full resolution)
+processor.diagnostics.sample_every = int(os.environ.get('DIAGNOSTICS_SAMPLE_EVERY', 0))
+processor.diagnostics.max_dimension = int(os.environ.get('DIAGNOSTICS_MAX_DIMENSION', 512)) or None
+
+# Decoded images uploaded once via /api/images, bounded by memory and idle time
+image_store = ImageStore(
+    processor,
+    max_bytes=int(os.environ.get('IMAGE_STORE_MAX_BYTES', 2 * 1024**3)),
+    ttl_seconds=float(os.environ.get('IMAGE_STORE_TTL_SECONDS', 30 * 60)),
+)
+
+# Analysis and texture decomposition are memoized so slider changes only rerun the final blend
+pipeline = StagedPipeline(
+    processor,
+    max_layer_bytes=int(os.environ.get('PIPELINE_LAYER_CACHE_MAX_BYTES', 3 * 1024**3)),
+    max_field_bytes=int(os.environ.get('PIPELINE_FIELD_CACHE_MAX_BYTES', 1024**3)),
+    ttl_seconds=float(os.environ.get('IMAGE_STORE_TTL_SECONDS', 30 * 60)),
+    tiled_engine=TiledCorrectionEngine(
+        processor,
+        memory_budget_bytes=int(os.environ.get('TILED_MEMORY_BUDGET_BYTES', 512 * 1024**2)),
+    ),
+    tiled_min_pixels=int(float(os.environ.get('TILED_MIN_MEGAPIXELS', 60)) * 1_000_000),
+)
+
+# Encoded results on local disk, shared by all worker processes; unset RESULT_CACHE_DIR disables it
+result_cache = None
+if os.environ.get('RESULT_CACHE_DIR'):
+    result_cache = ResultCache(
+        os.environ['RESULT_CACHE_DIR'],
+        max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 5 * 1024**3)),
+    )
+
+# Named calibration profiles; without CALIBRATION_DIR they live in this process's memory only
+profile_store = ProfileStore(os.environ.get('CALIBRATION_DIR'))
+
+# Asynchronous jobs: bounded workers, final renders before previews, latest request per session wins
+job_manager = JobManager(
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('JOB_MAX_PENDING', 16)),
+    result_ttl_seconds=float(os.environ.get('JOB_RESULT_TTL_SECONDS', 5 * 60)),
+)
+
+atexit.register(job_manager.shutdown)
+
+MAX_LONG_POLL_SECONDS = 30
+
+# Server-side batches read and write only below BATCH_ROOT; unset disables /api/batch
+BATCH_ROOT = os.environ.get('BATCH_ROOT')
+batch_runner = BatchRunner(
+    processor.serial(),
+    process_workers=int(os.environ.get('BATCH_PROCESS_WORKERS', 0)) or None,
+    tiled_engine=pipeline.tiled_engine,
+    tiled_min_pixels=pipeline.tiled_min_pixels,
+    profiles=profile_store,
+    memory_budget_bytes=int(os.environ.get('BATCH_MEMORY_BUDGET_MB', 4096)) * 1024**2,
+)
+batch_runs = {}
+
+# Request metrics for /metrics; processing stages are timed in gradient_removal.py
+HTTP_REQUESTS = Counter(
+    'gradient_removal_http_requests_total', 'HTTP requests by endpoint, mode and status.',
+    ['endpoint', 'mode', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'gradient_removal_http_request_seconds', 'HTTP request latency.', ['endpoint']
+)
+HTTP_IN_FLIGHT = Gauge(
+    'gradient_removal_http_requests_in_flight', 'HTTP requests being handled.', ['endpoint']
+)
+HTTP_PAYLOAD_BYTES = Histogram(
+    'gradient_removal_http_payload_bytes', 'HTTP request and response body sizes.',
+    ['endpoint', 'direction'], buckets=BYTE_BUCKETS
+)
+
+STARTUP_SECONDS = Gauge(
+    'gradient_removal_startup_seconds', 'Time spent starting this process, by phase.', ['phase']
+)
+FIRST_REQUEST_SECONDS = Gauge(
+    'gradient_removal_first_request_seconds', 'Latency of the first processing request this process served.'
+)
+PROCESSING_ENDPOINTS = {'process_gradient_removal', 'process_gradient_removal_binary'}
+first_request_served = threading.Event()
+
+def collect_service_metrics():
+    """Cache, job and scratch buffer state at scrape time."""
+    caches = {'images': image_store.stats(), **pipeline.stats()}
+    if result_cache is not None:
+        caches['results'] = result_cache.stats()
+    yield ('gradient_removal_cache_bytes', 'gauge', 'Bytes held by each cache.',
+           [({'cache': name}, stats['bytes']) for name, stats in caches.items()])
+    yield ('gradient_removal_cache_entries', 'gauge', 'Entries in each cache.',
+           [({'cache': name}, stats['entries']) for name, stats in caches.items()])
+    yield ('gradient_removal_cache_hits_total', 'counter', 'Cache hits.',
+           [({'cache': name}, stats['hits']) for name, stats in caches.items()])
+    yield ('gradient_removal_cache_misses_total', 'counter', 'Cache misses.',
+           [({'cache': name}, stats['misses']) for name, stats in caches.items()])
+    job_stats = job_manager.stats()
+    yield ('gradient_removal_jobs', 'gauge', 'Tracked jobs by status.',
+           [({'status': status}, count) for status, count in job_stats['jobs'].items()])
+    scratch = processor.scratch_pool.stats()
+    yield ('gradient_removal_scratch_bytes', 'gauge', 'Pooled blend scratch buffers.',
+           [({'state': 'idle'}, scratch['idleBytes']), ({'state': 'in_use'}, scratch['inUseBytes']),
+            ({'state': 'peak_in_use'}, scratch['peakInUseBytes'])])
+
+REGISTRY.add_collector(collect_service_metrics)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.metrics_endpoint = request.endpoint or 'unmatched'
+    HTTP_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+    if request.content_length:
+        HTTP_PAYLOAD_BYTES.observe(request.content_length, endpoint=g.metrics_endpoint, direction='request')
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = g.get('metrics_endpoint', 'unmatched')
+    HTTP_REQUESTS.inc(endpoint=endpoint, mode=g.get('metrics_mode', ''), status=response.status_code)
+    elapsed = time.perf_counter() - g.get('metrics_start', time.perf_counter())
+    HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    if endpoint in PROCESSING_ENDPOINTS and not first_request_served.is_set():
+        first_request_served.set()
+        FIRST_REQUEST_SECONDS.set(elapsed)
+        logger.info(f"First processing request took {elapsed:.3f}s")
+    if response.content_length:
+        HTTP_PAYLOAD_BYTES.observe(response.content_length, endpoint=endpoint, direction='response')
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'metrics_endpoint' in g:
+        HTTP_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
 
-# Initialize gradient removal processor
-processor = GradientRemovalProcessor()
+def request_processing_params(data):
+    """parse_processing_params, remembering the mode for the request metrics."""
+    params = parse_processing_params(data)
+    g.metrics_mode = params['mode']
+    return params
+
+def warm_up():
+    """Run a small synthetic scan through every processing path of this process.
+    
+    The first call into cv2 filters, colour conversions, the FFT, the JPEG codecs
+    and the worker pools is much slower than later ones. Pre-forking servers call
+    this in each worker (after the fork, since pools and threads don't survive it)
+    before the worker accepts requests.
+    """
+    started = time.perf_counter()
+    y, x = np.mgrid[0:480, 0:640].astype(np.float32)
+    weave = 20 * np.sin(x * np.pi / 3) * np.sin(y * np.pi / 3)
+    lightness = 110 + 40 * x / 640 + weave
+    image = np.clip(lightness[:, :, np.newaxis] * np.array([1.0, 0.9, 0.8], dtype=np.float32), 0, 255).astype(np.uint8)
+    image = processor.decode_image_bytes(processor.encode_image_bytes(image))
+    
+    selection = {'left': 0.1, 'top': 0.1, 'width': 0.8, 'height': 0.8}
+    for mode in ['advanced', 'uniform']:
+        for quality in ['preview', 'final']:
+            result = pipeline.process('warm-up', image, selection, mode, quality=quality, preview_max_dimension=320)
+    processor.encode_image(result)
+    processor.measure_quality(image, result)
+    pipeline.invalidate('warm-up')
+    
+    elapsed = time.perf_counter() - started
+    STARTUP_SECONDS.set(elapsed, phase='warm_up')
+    logger.info(f"Warm-up finished in {elapsed:.3f}s")
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text format metrics."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({'status': 'healthy', 'service': 'gradient-removal-api'})
 
+@app.route('/api/images', methods=['POST'])
+def register_image():
+    """Upload an image once and get a content-hash ID for later requests.
+    
+    Accepts a JSON body with a base64 data URL (or, with BATCH_ROOT set, the path
+    of a file below it), a multipart `image` file or raw image bytes. JPEGs are
+    decoded only when a request needs them.
+    """
+    try:
+        if request.is_json:
+            data = request.get_json()
+            
+            if data and 'path' in data and 'image' not in data:
+                if not BATCH_ROOT:
+                    return jsonify({'error': 'Server-side files are disabled, set BATCH_ROOT'}), 404
+                try:
+                    image_source = read_source(batch_path(data['path']))
+                except FileNotFoundError:
+                    return jsonify({'error': f'File not found: {data["path"]}'}), 404
+                image_id, image = image_store.register_bytes(image_source, lazy=True)
+            elif not data or 'image' not in data:
+                return jsonify({'error': 'Missing required field: image'}), 400
+            else:
+                image_id, image = image_store.register_data_url(data['image'], lazy=True)
+        else:
+            if 'image' in request.files:
+                image_bytes = request.files['image'].read()
+            else:
+                image_bytes = request.get_data(cache=False)
+            if not image_bytes:
+                return jsonify({'error': 'Missing required field: image'}), 400
+            
+            image_id, image = image_store.register_bytes(image_bytes, lazy=True)
+        h, w = image.shape[:2]
+        
+        return jsonify({
+            'imageId': image_id,
+            'imageSize': {'width': w, 'height': h},
+            'status': 'success'
+        }), 201
+        
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Image registration error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+@app.route('/api/images/<image_id>', methods=['DELETE'])
+def remove_image(image_id):
+    """Release a registered image."""
+    pipeline.invalidate(image_id)
+    if not image_store.remove(image_id):
+        return jsonify({'error': 'Unknown imageId'}), 404
+    return jsonify({'imageId': image_id, 'status': 'deleted'})
+
+def resolve_profile(params):
+    """The calibration profile named by validated params, or None; ValueError if it doesn't exist."""
+    if params['profile'] is None:
+        return None
+    try:
+        return profile_store.get(params['profile'], params['profile_version'])
+    except UnknownProfileError as e:
+        raise ValueError(e.args[0])
+
+def needs_full_resolution(params, measure=False):
+    """Whether a request needs the fully decoded image rather than a reduced decode.
+    
+    Previews only need the full resolution for the analysis of a selection, or
+    when they are measured, since diagnostics compare against the original.
+    """
+    return (params['quality'] == 'final' or measure
+            or (params['mode'] != 'uniform' and params['profile'] is None))
+
+def run_gradient_removal(image_id, image, params, cancel_check=None, profile=None, working_set=None):
+    """Run the staged pipeline for a resolved image and validated params."""
+    INPUT_MEGAPIXELS.observe(image.shape[0] * image.shape[1] / 1e6)
+    return pipeline.process(
+        image_id, image, params['selection'], params['mode'],
+        params['gradient_strength'], params['brightness_preservation'], params['color_preservation'],
+        params['quality'], params['preview_max_dimension'], cancel_check, profile, working_set
+    )
+
+def encode_options(params, output_format='jpeg'):
+    """Encoder arguments for a request: its format and overrides, with the preset of its quality level."""
+    return {
+        'format': params['format'] or output_format,
+        'preset': params['quality'],
+        'quality': params['encode_quality'],
+        'subsampling': params['chroma_subsampling'],
+    }
+
+def encoded_result(image_id, load_image, params, output_format='jpeg', cancel_check=None):
+    """Encoded result of a request as (bytes, (width, height), diagnostics or None,
+    peak working-set bytes or None).
+    
+    Served from the result cache when possible. load_image() returns the stored
+    image and is only called on a miss, so a hit never decodes the upload. Lazily
+    registered images are decoded in full only if the request needs it.
+    Requests asking for diagnostics always run, since those need the pixels.
+    Sampling is decided before decoding, so a sampled request is measured
+    against the full-resolution image.
+    """
+    options = encode_options(params, output_format)
+    profile = resolve_profile(params)
+    key = None
+    if result_cache is not None:
+        key = result_cache.key(
+            processor.result_version(), image_id, params['selection'], params['mode'],
+            params['gradient_strength'], params['brightness_preservation'], params['color_preservation'],
+            params['quality'], params['preview_max_dimension'] if params['quality'] == 'preview' else None,
+            pipeline.tiled_min_pixels, options, profile.digest if profile is not None else None,
+        )
+        cached = None if params['diagnostics'] else result_cache.get(key)
+        if cached is not None:
+            image_bytes, metadata = cached
+            logger.info(f"Serving cached result for image {image_id[:12]}")
+            return image_bytes, (metadata['width'], metadata['height']), None, None
+    
+    image = load_image()
+    measure = processor.diagnostics.should_measure(params['diagnostics'])
+    if needs_full_resolution(params, measure):
+        image = image_store.decoded(image_id, image)
+    working_set = WorkingSet()
+    corrected_image = run_gradient_removal(image_id, image, params, cancel_check, profile, working_set)
+    if cancel_check is not None:
+        cancel_check()
+    image_bytes = processor.encode_image_bytes(corrected_image, **options)
+    h, w = corrected_image.shape[:2]
+    if key is not None:
+        result_cache.put(key, image_bytes, {'width': w, 'height': h})
+    diagnostics = quality_diagnostics(image, corrected_image) if measure else None
+    return image_bytes, (w, h), diagnostics, working_set.peak
+
+def quality_diagnostics(image, corrected_image):
+    """Measure and record quality diagnostics of a corrected full-resolution image."""
+    diagnostics = processor.measure_quality(image, corrected_image)
+    processor.diagnostics.record(diagnostics)
+    return diagnostics
+
 @app.route('/api/gradient-removal', methods=['POST'])
 def process_gradient_removal():
     """Process gradient removal request."""
@@ -37,53 +381,218 @@ def process_gradient_removal():
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        # Validate required fields
-        required_fields = ['image', 'selection', 'mode']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        # The image may be sent inline or referenced by ID
+        if 'image' not in data and 'imageId' not in data:
+            return jsonify({'error': 'Missing required field: image'}), 400
+        params = request_processing_params(data)
         
-        image_data = data['image']
-        selection = data['selection']
-        mode = data['mode']
-        image_size = data.get('imageSize', {})
-        settings = data.get('settings', {})
+        # Resolve the image: a registered session image or an inline data URL.
+        # Inline images are registered too (unless the result is cached), so repeated
+        # uploads of the same scan hit the caches.
+        if 'imageId' in data:
+            image_id = data['imageId']
+            load_image = lambda: image_store.get(image_id)
+        else:
+            upload = processor.data_url_to_bytes(data['image'])
+            image_id = ImageStore.content_id(upload)
+            load_image = lambda: image_store.register_bytes(upload, lazy=True)[1]
         
-        # Extract strength parameters with defaults
-        gradient_strength = settings.get('gradientStrength', 0.5)
-        brightness_preservation = settings.get('brightnessPreservation', 0.8)
-        color_preservation = settings.get('colorPreservation', 0.9)
+        # Process the image
+        try:
+            image_bytes, (w, h), diagnostics, working_set_peak = encoded_result(image_id, load_image, params)
+        except UnknownImageError:
+            return jsonify({'error': 'Unknown imageId, upload the image again'}), 404
+        output_format = params['format'] or 'jpeg'
         
-        logger.info(f"Processing gradient removal request - Mode: {mode}, Selection: {selection}")
-        logger.info(f"Strength settings - Gradient: {gradient_strength}, Brightness: {brightness_preservation}, Color: {color_preservation}")
+        # Return result
+        result = {
+            'processedImage': processor.bytes_to_data_url(image_bytes, output_format),
+            'mode': params['mode'],
+            'selection': params['selection'],
+            'quality': params['quality'],
+            'format': output_format,
+            'imageSize': {'width': w, 'height': h},
+            'status': 'success'
+        }
+        if diagnostics is not None:
+            result['diagnostics'] = diagnostics
+        if working_set_peak is not None:
+            result['peakWorkingSetBytes'] = working_set_peak
+        return jsonify(result)
         
-        # Validate selection data
-        if not all(key in selection for key in ['left', 'top', 'width', 'height']):
-            return jsonify({'error': 'Invalid selection data'}), 400
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Processing error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+def binary_request_params():
+    """Collect gradient removal params from a binary request.
+    
+    Params come from a JSON `params` part (multipart) or from X-* headers (raw body).
+    """
+    if 'params' in request.form:
+        try:
+            return json.loads(request.form['params'])
+        except json.JSONDecodeError as e:
+            raise ValueError(f'Invalid params JSON: {e}')
+    
+    data = {}
+    if 'X-Selection' in request.headers:
+        try:
+            data['selection'] = json.loads(request.headers['X-Selection'])
+        except json.JSONDecodeError as e:
+            raise ValueError(f'Invalid X-Selection header: {e}')
+    if 'X-Mode' in request.headers:
+        data['mode'] = request.headers['X-Mode']
+    if 'X-Quality' in request.headers:
+        data['quality'] = request.headers['X-Quality']
+    if 'X-Profile' in request.headers:
+        data['profile'] = request.headers['X-Profile']
+    if 'X-Profile-Version' in request.headers:
+        try:
+            data['profileVersion'] = int(request.headers['X-Profile-Version'])
+        except ValueError:
+            raise ValueError('Invalid profileVersion: must be a positive integer')
+    if 'X-Format' in request.headers:
+        data['format'] = request.headers['X-Format']
+    if 'X-Encode-Quality' in request.headers:
+        try:
+            data['encodeQuality'] = int(request.headers['X-Encode-Quality'])
+        except ValueError:
+            raise ValueError('Invalid encodeQuality: must be an integer between 1 and 100')
+    if 'X-Chroma-Subsampling' in request.headers:
+        data['chromaSubsampling'] = request.headers['X-Chroma-Subsampling']
+    if 'X-Diagnostics' in request.headers:
+        data['diagnostics'] = {'true': True, 'false': False}.get(request.headers['X-Diagnostics'].lower())
+    if 'X-Preview-Max-Dimension' in request.headers:
+        try:
+            data['previewMaxDimension'] = int(request.headers['X-Preview-Max-Dimension'])
+        except ValueError:
+            raise ValueError('Invalid previewMaxDimension: must be an integer between 64 and 8192')
+    
+    settings = {}
+    for header, name in [('X-Gradient-Strength', 'gradientStrength'),
+                         ('X-Brightness-Preservation', 'brightnessPreservation'),
+                         ('X-Color-Preservation', 'colorPreservation')]:
+        if header in request.headers:
+            try:
+                settings[name] = float(request.headers[header])
+            except ValueError:
+                raise ValueError(f'Invalid {name}: must be between 0 and 1')
+    data['settings'] = settings
+    return data
+
+@app.route('/api/gradient-removal/binary', methods=['POST'])
+def process_gradient_removal_binary():
+    """Process gradient removal with raw image bytes in and out.
+    
+    Accepts multipart/form-data (an `image` file part plus a `params` JSON part),
+    a raw image body with settings in X-* headers, or an X-Image-Id header naming
+    a registered image. Responds with the encoded image bytes, in the format
+    given by the params or negotiated from the Accept header.
+    """
+    try:
+        params = request_processing_params(binary_request_params())
+        output_format = params['format'] or negotiate_format(request.headers.get('Accept'))
         
-        # Validate mode
-        if mode not in ['uniform', 'advanced']:
-            return jsonify({'error': 'Invalid mode. Must be "uniform" or "advanced"'}), 400
+        image_id = request.headers.get('X-Image-Id') or request.form.get('imageId')
+        if image_id:
+            load_image = lambda: image_store.get(image_id)
+        else:
+            if 'image' in request.files:
+                upload = request.files['image'].read()
+            else:
+                upload = request.get_data(cache=False)
+            if not upload:
+                return jsonify({'error': 'Missing required field: image'}), 400
+            image_id = ImageStore.content_id(upload)
+            load_image = lambda: image_store.register_bytes(upload, lazy=True)[1]
         
-        # Validate strength parameters
-        for param_name, param_value in [('gradientStrength', gradient_strength), 
-                                      ('brightnessPreservation', brightness_preservation), 
-                                      ('colorPreservation', color_preservation)]:
-            if not 0 <= param_value <= 1:
-                return jsonify({'error': f'Invalid {param_name}: must be between 0 and 1'}), 400
+        try:
+            image_bytes, _, diagnostics, working_set_peak = encoded_result(image_id, load_image, params, output_format)
+        except UnknownImageError:
+            return jsonify({'error': 'Unknown imageId, upload the image again'}), 404
         
-        # Process the image
-        processed_image = processor.process_gradient_removal(
-            image_data, selection, mode, gradient_strength, brightness_preservation, color_preservation
-        )
+        response = Response(image_bytes, mimetype=FORMATS[output_format][0])
+        response.vary.add('Accept')
+        response.headers['X-Image-Id'] = image_id
+        response.headers['X-Mode'] = params['mode']
+        response.headers['X-Quality'] = params['quality']
+        if diagnostics is not None:
+            response.headers['X-Diagnostics'] = json.dumps(diagnostics)
+        if working_set_peak is not None:
+            response.headers['X-Peak-Working-Set-Bytes'] = str(working_set_peak)
+        return response
         
-        # Return result
-        return jsonify({
-            'processedImage': processed_image,
-            'mode': mode,
-            'selection': selection,
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Processing error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+@app.route('/api/correction-field', methods=['POST'])
+def get_correction_field():
+    """The correction for an image as a compact field plus blend parameters.
+    
+    Takes the same body as /api/gradient-removal plus an optional
+    fieldMaxDimension (8-1024, default 64), and returns a few kilobytes that let
+    a client apply the correction to the full-resolution image itself.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        if 'image' not in data and 'imageId' not in data:
+            return jsonify({'error': 'Missing required field: image'}), 400
+        params = request_processing_params(data)
+        field_max_dimension = data.get('fieldMaxDimension', 64)
+        if not isinstance(field_max_dimension, int) or not 8 <= field_max_dimension <= 1024:
+            raise ValueError('fieldMaxDimension must be an integer between 8 and 1024')
+        
+        if 'imageId' in data:
+            image_id = data['imageId']
+            try:
+                image = image_store.get(image_id)
+            except UnknownImageError:
+                return jsonify({'error': 'Unknown imageId, upload the image again'}), 404
+        else:
+            image_id, image = image_store.register_bytes(processor.data_url_to_bytes(data['image']), lazy=True)
+        
+        profile = resolve_profile(params)
+        if profile is not None:
+            analysis = CorrectionAnalysis(profile.correction_map, profile.kind)
+        else:
+            if params['mode'] != 'uniform':
+                image = image_store.decoded(image_id, image)
+            analysis = pipeline.correction_analysis(image_id, image, params['selection'], params['mode'])
+        target_lighting = None
+        if params['mode'] == 'uniform':
+            # The preview proxy's median is within rounding of the full image's
+            layers = pipeline.layers(image_id, image, 'uniform', params['preview_max_dimension'])
+            target_lighting = layers.median_lighting
+        h, w = image.shape[:2]
+        result = {
+            'imageId': image_id,
+            'mode': params['mode'],
+            'selection': params['selection'],
+            'imageSize': {'width': w, 'height': h},
+            'profile': {'name': profile.name, 'version': profile.version} if profile is not None else None,
+            **processor.correction_parameters(
+                analysis, image.shape, params['mode'], params['gradient_strength'],
+                params['brightness_preservation'], params['color_preservation'],
+                field_max_dimension, target_lighting
+            ),
             'status': 'success'
-        })
+        }
+        return jsonify(result)
         
     except ValueError as e:
         logger.error(f"Validation error: {e}")
@@ -94,6 +603,262 @@ def process_gradient_removal():
         logger.error(traceback.format_exc())
         return jsonify({'error': 'Internal processing error'}), 500
 
+@app.route('/api/calibration-profiles', methods=['POST'])
+def capture_calibration_profile():
+    """Capture a calibration profile from a scan, stored as the next version of its name.
+    
+    Body: {"name", "image" or "imageId", "selection"}. Without a selection the
+    whole scan is taken as a blank or reference scan of the rig; with one, the
+    selection's advanced-mode analysis becomes the profile.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        if 'name' not in data:
+            return jsonify({'error': 'Missing required field: name'}), 400
+        if 'image' not in data and 'imageId' not in data:
+            return jsonify({'error': 'Missing required field: image'}), 400
+        name = validate_name(data['name'])
+        selection = data.get('selection')
+        if selection is not None and (not isinstance(selection, dict)
+                                      or not all(key in selection for key in ['left', 'top', 'width', 'height'])):
+            raise ValueError('Invalid selection data')
+        
+        if 'imageId' in data:
+            image_id = data['imageId']
+            try:
+                image = image_store.get(image_id)
+            except UnknownImageError:
+                return jsonify({'error': 'Unknown imageId, upload the image again'}), 404
+        else:
+            image_id, image = image_store.register_bytes(processor.data_url_to_bytes(data['image']), lazy=True)
+        
+        if selection is None:
+            # Only needs a small proxy, which JPEGs decode to directly
+            analysis, source = processor.analyze_reference(image), 'reference'
+        else:
+            image = image_store.decoded(image_id, image)
+            # Shares the cached analysis with processing requests for the same selection
+            analysis, source = pipeline.correction_analysis(image_id, image, selection, 'advanced'), 'analysis'
+        profile = CalibrationProfile.from_analysis(name, analysis, image.shape, source, selection, ALGORITHM_VERSION)
+        profile_store.save(profile)
+        return jsonify({**profile.metadata(), 'imageId': image_id, 'status': 'success'}), 201
+        
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Calibration error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+@app.route('/api/calibration-profiles', methods=['GET'])
+def list_calibration_profiles():
+    """The latest version of every calibration profile, with the versions stored."""
+    return jsonify({'profiles': [
+        {**profile_store.get(name).metadata(), 'versions': profile_store.versions(name)}
+        for name in profile_store.names()
+    ]})
+
+def profile_version_arg():
+    version = request.args.get('version')
+    if version is None:
+        return None
+    if not version.isdigit() or int(version) < 1:
+        raise ValueError('Invalid version: must be a positive integer')
+    return int(version)
+
+@app.route('/api/calibration-profiles/<name>', methods=['GET'])
+def get_calibration_profile(name):
+    """A calibration profile's metadata, latest version unless ?version= is given."""
+    try:
+        profile = profile_store.get(name, profile_version_arg())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except UnknownProfileError as e:
+        return jsonify({'error': e.args[0]}), 404
+    return jsonify({**profile.metadata(), 'versions': profile_store.versions(name)})
+
+@app.route('/api/calibration-profiles/<name>', methods=['DELETE'])
+def delete_calibration_profile(name):
+    """Delete a calibration profile, or only the version given by ?version=."""
+    try:
+        deleted = profile_store.delete(name, profile_version_arg())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not deleted:
+        return jsonify({'error': f'Unknown calibration profile: {name}'}), 404
+    return jsonify({'name': name, 'deleted': deleted, 'status': 'deleted'})
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a gradient removal job and return its ID immediately.
+    
+    Takes the same body as /api/gradient-removal plus an optional sessionId
+    (defaults to the image ID). A new job cancels the session's queued and
+    running jobs of the same or lower priority.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        if 'image' not in data and 'imageId' not in data:
+            return jsonify({'error': 'Missing required field: image'}), 400
+        params = request_processing_params(data)
+        
+        if 'imageId' in data:
+            image_id = data['imageId']
+            try:
+                image = image_store.get(image_id)
+            except UnknownImageError:
+                return jsonify({'error': 'Unknown imageId, upload the image again'}), 404
+        else:
+            image_id, image = image_store.register_data_url(data['image'], lazy=True)
+        
+        def run(job):
+            image_bytes, (w, h), diagnostics, working_set_peak = encoded_result(
+                image_id, lambda: image, params, cancel_check=job.check_cancelled
+            )
+            output_format = params['format'] or 'jpeg'
+            result = {
+                'processedImage': processor.bytes_to_data_url(image_bytes, output_format),
+                'mode': params['mode'],
+                'selection': params['selection'],
+                'quality': params['quality'],
+                'format': output_format,
+                'imageSize': {'width': w, 'height': h},
+            }
+            if diagnostics is not None:
+                result['diagnostics'] = diagnostics
+            if working_set_peak is not None:
+                result['peakWorkingSetBytes'] = working_set_peak
+            return result
+        
+        priority = PRIORITY_FINAL if params['quality'] == 'final' else PRIORITY_PREVIEW
+        try:
+            job = job_manager.submit(run, session_id=data.get('sessionId', image_id), priority=priority)
+        except JobQueueFullError as e:
+            logger.warning(f"Rejecting job: {e}")
+            response = jsonify({'error': 'Too many queued jobs, retry later'})
+            response.headers['Retry-After'] = '1'
+            return response, 429
+        
+        return jsonify({**job.to_dict(), 'imageId': image_id}), 202
+        
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Job submission error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status, including the result once it succeeded.
+    
+    With ?wait=<seconds> (at most 30) the request long-polls until the job finishes.
+    """
+    try:
+        job = job_manager.get(job_id)
+    except KeyError:
+        return jsonify({'error': 'Unknown jobId'}), 404
+    
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_LONG_POLL_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'Invalid wait: must be a number of seconds'}), 400
+    if wait > 0:
+        job.wait(wait)
+    
+    info = job.to_dict()
+    if job.status == 'succeeded':
+        info.update(job.result)
+    return jsonify(info)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running job."""
+    try:
+        job = job_manager.cancel(job_id)
+    except KeyError:
+        return jsonify({'error': 'Unknown jobId'}), 404
+    return jsonify(job.to_dict())
+
+def batch_path(path):
+    """Resolve a path relative to BATCH_ROOT, raising ValueError if it leaves the root."""
+    root = os.path.realpath(BATCH_ROOT)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f'Path outside the batch root: {path}')
+    return resolved
+
+@app.route('/api/batch', methods=['POST'])
+def submit_batch():
+    """Start a batch over a directory or manifest below BATCH_ROOT.
+    
+    Body: {"input": dir or manifest, "outputDir": dir, "defaults": {selection, mode, settings},
+    "resume": true}. Only one batch runs at a time.
+    """
+    if not BATCH_ROOT:
+        return jsonify({'error': 'Batch processing is disabled, set BATCH_ROOT'}), 404
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
+        
+        for field in ['input', 'outputDir']:
+            if field not in data:
+                return jsonify({'error': f'Missing required field: {field}'}), 400
+        
+        output_dir = batch_path(data['outputDir'])
+        items = collect_items(batch_path(data['input']), output_dir, data.get('defaults'))
+        for item in items:
+            batch_path(item.path)
+            batch_path(item.output)
+        
+        if any(not run.done for run in batch_runs.values()):
+            response = jsonify({'error': 'A batch is already running, retry later'})
+            response.headers['Retry-After'] = '60'
+            return response, 429
+        
+        run = BatchRun(batch_runner, items, output_dir, resume=bool(data.get('resume', True)))
+        batch_runs[run.id] = run
+        logger.info(f"Started batch {run.id} with {len(items)} items")
+        return jsonify(run.to_dict()), 202
+        
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    except Exception as e:
+        logger.error(f"Batch submission error: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Internal processing error'}), 500
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Batch progress, with the throughput summary once it has finished."""
+    if batch_id not in batch_runs:
+        return jsonify({'error': 'Unknown batchId'}), 404
+    return jsonify(batch_runs[batch_id].to_dict())
+
+@app.route('/api/batch/<batch_id>', methods=['DELETE'])
+def cancel_batch(batch_id):
+    """Stop a batch after the items in flight; rerunning it resumes where it stopped."""
+    if batch_id not in batch_runs:
+        return jsonify({'error': 'Unknown batchId'}), 404
+    run = batch_runs[batch_id]
+    run.cancel()
+    return jsonify(run.to_dict())
+
 @app.route('/api/gradient-removal/test', methods=['GET'])
 def test_endpoint():
     """Test endpoint to verify the service is working."""
@@ -111,6 +876,8 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
+STARTUP_SECONDS.set(time.perf_counter() - _import_started, phase='import')
+
 if __name__ == '__main__':
     logger.info("Starting gradient removal API server...")
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
@@ -0,0 +1,565 @@
+"""
+Batch gradient removal for whole folders of fabric scans.
+
+Input is a directory of images or a manifest listing files with per-file
+selection, mode and settings (falling back to shared defaults), or with a
+calibration profile that replaces the per-scan analysis. Decoding,
+processing and encoding run as separate worker stages connected by bounded
+queues, so reading the next scan and writing the previous one overlap with
+the correction itself. Each image reserves its estimated working set from a
+memory budget before it is decoded and gives it back once it is written, so
+the images in flight (decoded, queued or being corrected) stay within the
+budget whatever the number of workers. Images too large for the budget go
+through the tiled engine.
+
+Every finished item is appended to a progress file in the output directory,
+with a hash of its processing parameters; rerunning the same batch skips items
+that already succeeded with the same parameters.
+
+Usage:
+    python batch.py SCANS_DIR OUTPUT_DIR --selection 0.05,0.05,0.2,0.2 --mode advanced
+    python batch.py SCANS_DIR OUTPUT_DIR --profile RIG_A --profile-dir profiles
+    python batch.py manifest.json OUTPUT_DIR
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+from PIL import Image
+from calibration import ProfileStore, UnknownProfileError
+from encoding import FORMATS, format_for_path
+from gradient_removal import GradientRemovalProcessor, BLUR_MODES
+from pipeline import parse_processing_params
+from result_cache import ResultCache
+from tiled_processing import TiledCorrectionEngine, open_source
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp', '.npy'}
+PROGRESS_FILENAME = '.batch_progress.jsonl'
+
+# Peak bytes per pixel of an in-memory correction: the decoded image plus the
+# float32 layers, blurs and blend buffers (~70-85 measured, rounded up)
+IN_MEMORY_BYTES_PER_PIXEL = 96
+
+
+class MemoryBudget:
+    """Bytes reserved by the images in flight, waiting while a reservation doesn't fit.
+
+    A reservation larger than the whole budget is granted once nothing else is
+    reserved, so an oversized image runs alone instead of never.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._condition:
+            self._condition.wait_for(lambda: self.reserved == 0 or self.reserved + nbytes <= self.max_bytes)
+            self.reserved += nbytes
+            self.peak = max(self.peak, self.reserved)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.reserved -= nbytes
+            self._condition.notify_all()
+
+
+class BatchItem:
+    """One input file, its validated parameters and its output path."""
+
+    def __init__(self, path, output, params=None, error=None):
+        self.path = path
+        self.output = output
+        self.params = params
+        self.error = error
+        # Hash of everything that determines the output, set by BatchRunner.run
+        self.params_hash = None
+        self.status = None
+        self.data = None
+        self.tiled = False
+        self.pixels = 0
+        self.seconds = {}
+        # Bytes reserved from the runner's MemoryBudget while the item is in flight
+        self.reserved_bytes = 0
+
+    def to_dict(self):
+        record = {'input': self.path, 'output': self.output, 'status': self.status}
+        if self.params_hash is not None:
+            record['paramsHash'] = self.params_hash
+        if self.error is not None:
+            record['error'] = self.error
+        if self.pixels:
+            record['pixels'] = self.pixels
+        if self.seconds:
+            record['seconds'] = {stage: round(seconds, 4) for stage, seconds in self.seconds.items()}
+        return record
+
+
+def load_manifest(path):
+    """Read a manifest: a JSON list of entries, a JSON object with "defaults" and
+    "items", or JSON Lines with one entry per line. Returns (defaults, entries)."""
+    with open(path) as f:
+        text = f.read()
+    try:
+        manifest = json.loads(text)
+    except json.JSONDecodeError:
+        manifest = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(manifest, dict):
+        return manifest.get('defaults', {}), manifest.get('items', [])
+    if not isinstance(manifest, list):
+        raise ValueError('Manifest must be a list of entries or an object with "items"')
+    return {}, manifest
+
+
+def collect_items(source, output_dir, defaults=None):
+    """Build BatchItems from a directory of images or a manifest file.
+
+    Entries take selection or calibration profile (profile, profileVersion),
+    mode, settings and output encoding (format, encodeQuality,
+    chromaSubsampling) from the shared defaults unless they set their own. Invalid entries are kept as items with an error so they
+    show up as failures instead of aborting the batch.
+    """
+    defaults = dict(defaults or {})
+    if os.path.isdir(source):
+        entries = [
+            {'path': os.path.join(source, name)}
+            for name in sorted(os.listdir(source))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+        base_dir = source
+    elif os.path.isfile(source):
+        manifest_defaults, entries = load_manifest(source)
+        defaults = {**manifest_defaults, **defaults}
+        base_dir = os.path.dirname(os.path.abspath(source))
+    else:
+        raise ValueError(f'Batch input not found: {source}')
+
+    items = []
+    outputs = set()
+    for entry in entries:
+        if not isinstance(entry, dict) or 'path' not in entry:
+            raise ValueError(f'Manifest entry without a path: {entry}')
+        path = os.path.abspath(os.path.join(base_dir, entry['path']))
+        stem, ext = os.path.splitext(os.path.basename(path))
+        output_format = entry.get('format', defaults.get('format'))
+        output_extension = FORMATS[output_format][1] if output_format in FORMATS else '.jpg'
+        output = entry.get('output') or stem + ('.npy' if ext.lower() == '.npy' else output_extension)
+        output = os.path.abspath(os.path.join(output_dir, output))
+        if output in outputs:
+            raise ValueError(f'Two batch items write to {output}, set "output" in the manifest')
+        outputs.add(output)
+
+        data = {
+            'selection': entry.get('selection', defaults.get('selection')),
+            'mode': entry.get('mode', defaults.get('mode', 'advanced')),
+            'settings': {**defaults.get('settings', {}), **entry.get('settings', {})},
+        }
+        for key in ['format', 'encodeQuality', 'chromaSubsampling', 'profile', 'profileVersion']:
+            if entry.get(key, defaults.get(key)) is not None:
+                data[key] = entry.get(key, defaults.get(key))
+        if data['selection'] is None:
+            del data['selection']
+        try:
+            items.append(BatchItem(path, output, params=parse_processing_params(data)))
+        except ValueError as e:
+            items.append(BatchItem(path, output, error=str(e)))
+    return items
+
+
+def read_progress(output_dir):
+    """Map input path -> (output path, params hash) of items that succeeded in an earlier run.
+
+    Records written before params hashes were stored have a hash of None, which
+    matches no item, so those items are processed again.
+    """
+    done = {}
+    try:
+        with open(os.path.join(output_dir, PROGRESS_FILENAME)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves a truncated last line
+                    continue
+                if record.get('status') == 'succeeded':
+                    done[record['input']] = (record['output'], record.get('paramsHash'))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+class BatchRunner:
+    """Pipelined decode -> process -> encode over a list of BatchItems.
+
+    Each stage has its own worker threads; cv2 and NumPy release the GIL, so
+    process workers correct several scans at once on separate cores. Images
+    with at least tiled_min_pixels, or whose in-memory working set alone would
+    exceed memory_budget_bytes, go through the tiled engine, if one is given.
+    The budget bounds the images in flight across all stages.
+    """
+
+    def __init__(self, processor, decode_workers=None, process_workers=None, encode_workers=None,
+                 tiled_engine=None, tiled_min_pixels=60_000_000, profiles=None,
+                 memory_budget_bytes=4 * 1024**3):
+        cpus = os.cpu_count() or 1
+        self.processor = processor
+        # ProfileStore for items naming a calibration profile
+        self.profiles = profiles
+        self.process_workers = process_workers or cpus
+        self.decode_workers = decode_workers or max(1, cpus // 4)
+        self.encode_workers = encode_workers or max(1, cpus // 4)
+        self.tiled_engine = tiled_engine
+        self.tiled_min_pixels = tiled_min_pixels
+        self.memory = MemoryBudget(memory_budget_bytes)
+
+    def run(self, items, output_dir, resume=True, cancel_event=None, on_item=None):
+        """Process items, writing results and the progress file to output_dir.
+
+        cancel_event, if given, stops the batch once the items in flight are done;
+        the rest are recorded as cancelled. on_item(item) is called after each
+        item is recorded. Returns a throughput summary.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        cancel_event = cancel_event or threading.Event()
+        started = time.perf_counter()
+        summary = {status: 0 for status in ['succeeded', 'failed', 'skipped', 'cancelled']}
+        summary.update(total=len(items), pixels=0, stageSeconds={'decode': 0.0, 'process': 0.0, 'encode': 0.0})
+        lock = threading.Lock()
+
+        done = read_progress(output_dir) if resume else {}
+        progress_file = open(os.path.join(output_dir, PROGRESS_FILENAME), 'a' if resume else 'w')
+
+        def record(item, status, error=None):
+            item.status = status
+            item.error = error if error is not None else item.error
+            item.data = None
+            if item.reserved_bytes:
+                self.memory.release(item.reserved_bytes)
+                item.reserved_bytes = 0
+            with lock:
+                summary[status] += 1
+                if status == 'succeeded':
+                    summary['pixels'] += item.pixels
+                for stage, seconds in item.seconds.items():
+                    summary['stageSeconds'][stage] += seconds
+                if status != 'skipped':
+                    progress_file.write(json.dumps(item.to_dict()) + '\n')
+                    progress_file.flush()
+            if status == 'failed':
+                logger.warning(f"Batch item {item.path} failed: {item.error}")
+            if on_item is not None:
+                on_item(item)
+
+        decode_queue = queue.Queue()
+        process_queue = queue.Queue(maxsize=self.process_workers)
+        encode_queue = queue.Queue(maxsize=self.encode_workers)
+
+        version = self.processor.result_version()
+        for item in items:
+            if item.error is not None:
+                record(item, 'failed')
+                continue
+            item.params_hash = ResultCache.key(version, item.params, self._profile_digest(item.params))[:16]
+            # Changed settings, encoding, profile or algorithm version redo the item
+            if resume and done.get(item.path) == (item.output, item.params_hash) and os.path.exists(item.output):
+                record(item, 'skipped')
+            else:
+                decode_queue.put(item)
+
+        stages = [
+            ('decode', self._decode, decode_queue, process_queue, self.decode_workers),
+            ('process', self._process, process_queue, encode_queue, self.process_workers),
+            ('encode', self._encode, encode_queue, None, self.encode_workers),
+        ]
+        for _ in range(self.decode_workers):
+            decode_queue.put(None)
+
+        def work(name, func, inbox, outbox):
+            while True:
+                item = inbox.get()
+                if item is None:
+                    return
+                if cancel_event.is_set():
+                    record(item, 'cancelled')
+                    continue
+                stage_start = time.perf_counter()
+                try:
+                    func(item)
+                except Exception as e:
+                    # Unreadable or invalid files are expected in large batches; log only real bugs
+                    if not isinstance(e, (ValueError, OSError)):
+                        logger.exception(f"Batch {name} error for {item.path}: {e}")
+                    item.seconds[name] = time.perf_counter() - stage_start
+                    record(item, 'failed', f'{name} failed: {e}')
+                    continue
+                item.seconds[name] = time.perf_counter() - stage_start
+                if outbox is None:
+                    record(item, 'succeeded')
+                else:
+                    outbox.put(item)
+
+        try:
+            running = []
+            for name, func, inbox, outbox, workers in stages:
+                threads = [
+                    threading.Thread(target=work, args=(name, func, inbox, outbox), name=f'batch-{name}-{n}', daemon=True)
+                    for n in range(workers)
+                ]
+                for thread in threads:
+                    thread.start()
+                running.append((threads, outbox))
+            for i, (threads, outbox) in enumerate(running):
+                for thread in threads:
+                    thread.join()
+                # Stage drained: tell the next stage's workers to stop
+                if outbox is not None:
+                    for _ in running[i + 1][0]:
+                        outbox.put(None)
+        finally:
+            progress_file.close()
+
+        elapsed = time.perf_counter() - started
+        processed = summary['succeeded'] + summary['failed']
+        summary['elapsedSeconds'] = round(elapsed, 3)
+        summary['imagesPerHour'] = round(processed * 3600 / elapsed, 1) if elapsed > 0 else 0.0
+        summary['megapixelsPerSecond'] = round(summary['pixels'] / 1e6 / elapsed, 2) if elapsed > 0 else 0.0
+        summary['stageSeconds'] = {stage: round(seconds, 3) for stage, seconds in summary['stageSeconds'].items()}
+        summary['workers'] = {'decode': self.decode_workers, 'process': self.process_workers, 'encode': self.encode_workers}
+        summary['peakReservedBytes'] = self.memory.peak
+        logger.info(f"Batch finished - {summary['succeeded']} succeeded, {summary['failed']} failed, "
+                    f"{summary['skipped']} skipped in {elapsed:.1f}s ({summary['imagesPerHour']} images/hour)")
+        return summary
+
+    def _decode(self, item):
+        is_npy = os.path.splitext(item.path)[1].lower() == '.npy'
+        if is_npy:
+            h, w = np.load(item.path, mmap_mode='r').shape[:2]
+        else:
+            # Only reads the header
+            with Image.open(item.path) as image:
+                w, h = image.size
+        item.pixels = h * w
+
+        estimate = item.pixels * IN_MEMORY_BYTES_PER_PIXEL
+        if self.tiled_engine is not None and (item.pixels >= self.tiled_min_pixels
+                                              or estimate > self.memory.max_bytes):
+            item.tiled = True
+            estimate = self.tiled_engine.memory_budget_bytes
+        # Released when the item is recorded, whatever its outcome
+        self.memory.acquire(estimate)
+        item.reserved_bytes = estimate
+
+        if item.tiled:
+            item.data = open_source(item.path)
+        elif is_npy:
+            item.data = np.load(item.path)
+        else:
+            item.data = self.processor.decode_image_file(item.path)
+
+    def _profile(self, params):
+        if params['profile'] is None:
+            return None
+        if self.profiles is None:
+            raise ValueError('Calibration profiles are not configured')
+        try:
+            return self.profiles.get(params['profile'], params['profile_version'])
+        except UnknownProfileError as e:
+            # A misspelt name fails its items like any invalid input
+            raise ValueError(e.args[0])
+
+    def _profile_digest(self, params):
+        # An unversioned profile name follows the latest calibration, so hash what it resolves to
+        try:
+            profile = self._profile(params)
+        except ValueError:
+            return None
+        return profile.digest if profile is not None else None
+
+    def _process(self, item):
+        params = item.params
+        profile = self._profile(params)
+        if not item.tiled:
+            item.data = self.processor.process_image(
+                item.data, params['selection'], params['mode'],
+                params['gradient_strength'], params['brightness_preservation'], params['color_preservation'],
+                profile
+            )
+            return
+
+        correction_map = None
+        if profile is not None:
+            profile.check_image(item.data.shape)
+            correction_map = profile.correction_map
+        elif params['mode'] != 'uniform':
+            selection_area = self.processor.extract_selection_area(item.data, params['selection'])
+            correction_map = self.processor.analyze_gradient(selection_area, params['mode'])
+        item.data = self.tiled_engine.apply(
+            item.data, correction_map, params['mode'],
+            params['gradient_strength'], params['brightness_preservation'], params['color_preservation']
+        )
+
+    def _encode(self, item):
+        os.makedirs(os.path.dirname(item.output), exist_ok=True)
+        # Write next to the target and rename, so an interrupted run never leaves a partial output
+        partial = f'{item.output}.partial'
+        with open(partial, 'wb') as f:
+            if item.output.lower().endswith('.npy'):
+                np.save(f, item.data)
+            else:
+                params = item.params
+                f.write(self.processor.encode_image_bytes(
+                    item.data, params['format'] or format_for_path(item.output), 'final',
+                    params['encode_quality'], params['chroma_subsampling']
+                ))
+        os.replace(partial, item.output)
+
+
+class BatchRun:
+    """A batch running in a background thread, for the HTTP API."""
+
+    def __init__(self, runner, items, output_dir, resume=True):
+        self.id = uuid.uuid4().hex
+        self.status = 'running'
+        self.total = len(items)
+        self.finished = 0
+        self.failed = 0
+        self.summary = None
+        self.error = None
+        self.created_at = time.time()
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, args=(runner, items, output_dir, resume), name=f'batch-{self.id[:8]}', daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def done(self):
+        return self.status != 'running'
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _on_item(self, item):
+        # Called from the batch's worker threads
+        with self._lock:
+            self.finished += 1
+            if item.status == 'failed':
+                self.failed += 1
+
+    def _run(self, runner, items, output_dir, resume):
+        try:
+            self.summary = runner.run(items, output_dir, resume, self._cancel_event, self._on_item)
+            self.status = 'cancelled' if self._cancel_event.is_set() else 'succeeded'
+        except Exception as e:
+            logger.exception(f"Batch {self.id} failed: {e}")
+            self.error = 'Internal processing error'
+            self.status = 'failed'
+
+    def to_dict(self):
+        info = {
+            'batchId': self.id,
+            'status': self.status,
+            'total': self.total,
+            'finished': self.finished,
+            'failed': self.failed,
+            'createdAt': self.created_at,
+        }
+        if self.summary is not None:
+            info['summary'] = self.summary
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+
+def parse_selection(value):
+    """Parse "left,top,width,height" (fractions of the image size) from the command line."""
+    try:
+        left, top, width, height = (float(v) for v in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('selection must be left,top,width,height as fractions of the image size')
+    return {'left': left, 'top': top, 'width': width, 'height': height}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Remove lighting gradients from a folder or manifest of scans.')
+    parser.add_argument('input', help='directory of images, or a JSON/JSONL manifest')
+    parser.add_argument('output_dir', help='directory for corrected images and progress')
+    parser.add_argument('--selection', type=parse_selection, help='default selection as left,top,width,height fractions, e.g. 0.05,0.05,0.2,0.2')
+    parser.add_argument('--mode', choices=['uniform', 'advanced'], help='default mode (advanced)')
+    parser.add_argument('--profile', help='apply this calibration profile instead of analysing a selection')
+    parser.add_argument('--profile-version', type=int, help='profile version (default: latest)')
+    parser.add_argument('--profile-dir', default=os.environ.get('CALIBRATION_DIR', 'calibration_profiles'),
+                        help='calibration profile directory (default: $CALIBRATION_DIR or ./calibration_profiles)')
+    parser.add_argument('--gradient-strength', type=float)
+    parser.add_argument('--brightness-preservation', type=float)
+    parser.add_argument('--color-preservation', type=float)
+    parser.add_argument('--format', choices=list(FORMATS), help='output format (default: from the output extension, else jpeg)')
+    parser.add_argument('--encode-quality', type=int, help='JPEG/WebP quality, 1-100')
+    parser.add_argument('--chroma-subsampling', help='JPEG chroma subsampling: 4:4:4, 4:2:2 or 4:2:0')
+    parser.add_argument('--decode-workers', type=int)
+    parser.add_argument('--process-workers', type=int)
+    parser.add_argument('--encode-workers', type=int)
+    parser.add_argument('--tiled-min-megapixels', type=float, default=60,
+                        help='process images at least this large tile by tile (default 60)')
+    parser.add_argument('--tiled-memory-budget-mb', type=int, default=512)
+    parser.add_argument('--memory-budget-mb', type=int, default=4096,
+                        help='estimated working set of all images in flight (default 4096)')
+    parser.add_argument('--blur-mode', choices=BLUR_MODES, default='exact',
+                        help='pyramid computes the large lighting blurs at reduced resolution (faster, approximate)')
+    parser.add_argument('--no-resume', action='store_true', help='reprocess items that already succeeded')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    defaults = {'settings': {}}
+    if args.selection is not None:
+        defaults['selection'] = args.selection
+    if args.mode is not None:
+        defaults['mode'] = args.mode
+    for name, value in [('format', args.format),
+                        ('encodeQuality', args.encode_quality),
+                        ('chromaSubsampling', args.chroma_subsampling),
+                        ('profile', args.profile),
+                        ('profileVersion', args.profile_version)]:
+        if value is not None:
+            defaults[name] = value
+    for name, value in [('gradientStrength', args.gradient_strength),
+                        ('brightnessPreservation', args.brightness_preservation),
+                        ('colorPreservation', args.color_preservation)]:
+        if value is not None:
+            defaults['settings'][name] = value
+
+    processor = GradientRemovalProcessor(blur_mode=args.blur_mode)
+    runner = BatchRunner(
+        processor,
+        decode_workers=args.decode_workers,
+        process_workers=args.process_workers,
+        encode_workers=args.encode_workers,
+        tiled_engine=TiledCorrectionEngine(processor, memory_budget_bytes=args.tiled_memory_budget_mb * 1024**2),
+        tiled_min_pixels=int(args.tiled_min_megapixels * 1_000_000),
+        profiles=ProfileStore(args.profile_dir) if os.path.isdir(args.profile_dir) else None,
+        memory_budget_bytes=args.memory_budget_mb * 1024**2,
+    )
+    try:
+        items = collect_items(args.input, args.output_dir, defaults)
+    except ValueError as e:
+        parser.error(str(e))
+
+    summary = runner.run(items, args.output_dir, resume=not args.no_resume)
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
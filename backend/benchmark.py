@@ -0,0 +1,331 @@
+"""
+Speed and quality benchmark for gradient removal on synthetic fabrics.
+
+Each case renders a fabric (solid, twill or plaid) under a known lighting
+field (linear, quadratic or vignette). Every pipeline stage is timed on its
+own, and the case records how much of the known gradient is gone from the
+result. The results are written as JSON keyed by case, so two runs can be
+compared for speed and quality regressions.
+
+Usage:
+    python benchmark.py run --sizes 1,4,16 --output results.json
+    python benchmark.py compare baseline.json results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import cv2
+from gradient_removal import GradientRemovalProcessor, BLUR_MODES
+from pipeline import DEFAULT_PREVIEW_MAX_DIMENSION
+from tiled_processing import TiledCorrectionEngine
+
+logger = logging.getLogger(__name__)
+
+PATTERNS = ['solid', 'twill', 'plaid']
+GRADIENTS = ['linear', 'quadratic', 'vignette']
+MODES = ['uniform', 'advanced']
+SCHEMA_VERSION = 1
+
+# Background selection used for every case: the central half of the scan
+SELECTION = {'left': 0.25, 'top': 0.25, 'width': 0.5, 'height': 0.5}
+# Block size for the lighting measurement; much larger than any pattern period
+QUALITY_BLOCK = 64
+
+
+def lighting_field(u, v, gradient):
+    """Multiplicative lighting over normalised coordinates u, v in [-1, 1]."""
+    if gradient == 'linear':
+        return 1.0 + 0.2 * u + 0.1 * v
+    if gradient == 'quadratic':
+        return 1.1 - 0.12 * (u ** 2 + v ** 2) + 0.05 * u * v
+    if gradient == 'vignette':
+        return 1.15 - 0.35 * (u ** 2 + v ** 2) / 2
+    raise ValueError(f'Unknown gradient: {gradient}')
+
+
+def fabric_albedo(y, x, pattern, period, rng):
+    """Fabric colour (float32, HxWx3) for pixel rows y and columns x."""
+    shape = (len(y), len(x))
+    yy, xx = y[:, np.newaxis], x[np.newaxis, :]
+    if pattern == 'solid':
+        albedo = np.broadcast_to(np.float32([150, 70, 80]), shape + (3,)).copy()
+        albedo += rng.normal(0, 2, shape + (1,)).astype(np.float32)
+    elif pattern == 'twill':
+        # Diagonal ribs plus thread noise
+        ribs = 12 * np.sin((xx + yy) * (2 * np.pi / period))
+        albedo = np.float32([110, 120, 150]) + (ribs + rng.normal(0, 6, shape))[:, :, np.newaxis]
+    elif pattern == 'plaid':
+        # Overlapping warp and weft bands in two colours
+        bands = ((xx // period) % 2 + (yy // period) % 2) / 2.0
+        albedo = np.float32([170, 60, 50]) + bands[:, :, np.newaxis] * np.float32([-90, 40, 60])
+        albedo += rng.normal(0, 3, shape + (1,))
+    else:
+        raise ValueError(f'Unknown pattern: {pattern}')
+    return albedo.astype(np.float32)
+
+
+def synthetic_fabric(height, width, pattern='plaid', gradient='linear', period=16, seed=0, chunk_rows=512):
+    """Render a fabric under a known lighting gradient.
+
+    Returns (image, reference): the lit uint8 image and the block means of the
+    same fabric under flat lighting, for measuring how much gradient remains.
+    Rendered a block of rows at a time so 100 MP scans fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    reference = np.empty((height // QUALITY_BLOCK, width // QUALITY_BLOCK), dtype=np.float64)
+    x = np.arange(width, dtype=np.float32)
+    u = (x - (width - 1) / 2) / max((width - 1) / 2, 1)
+    # chunk_rows is a multiple of the quality block, so blocks never straddle chunks
+    chunk_rows -= chunk_rows % QUALITY_BLOCK
+    for y0 in range(0, height, chunk_rows):
+        y = np.arange(y0, min(y0 + chunk_rows, height), dtype=np.float32)
+        v = (y - (height - 1) / 2) / max((height - 1) / 2, 1)
+        albedo = np.clip(fabric_albedo(y, x, pattern, period, rng), 0, 255)
+        light = lighting_field(u[np.newaxis, :], v[:, np.newaxis], gradient).astype(np.float32)
+        image[y0:y0 + len(y)] = np.clip(albedo * light[:, :, np.newaxis], 0, 255)
+        blocks = block_means(albedo)
+        reference[y0 // QUALITY_BLOCK:y0 // QUALITY_BLOCK + len(blocks)] = blocks
+    return image, reference
+
+
+def block_means(image, block=QUALITY_BLOCK):
+    """Mean brightness of each full block x block tile."""
+    hb, wb = image.shape[0] // block, image.shape[1] // block
+    means = np.empty((hb, wb), dtype=np.float64)
+    for i in range(hb):
+        rows = np.asarray(image[i * block:(i + 1) * block, :wb * block], dtype=np.float32)
+        means[i] = rows.reshape(block, wb, block, -1).mean(axis=(0, 2, 3))
+    return means
+
+
+def gradient_removed(image_blocks, corrected_blocks, reference):
+    """Share of the lighting variation removed: 1 - spread(after) / spread(before).
+
+    Spread is the standard deviation of the log ratio between the image and the
+    flat-lit reference, block by block; 1.0 means perfectly flat lighting.
+    """
+    before = np.std(np.log(np.maximum(image_blocks, 1) / np.maximum(reference, 1)))
+    after = np.std(np.log(np.maximum(corrected_blocks, 1) / np.maximum(reference, 1)))
+    return float(1.0 - after / before) if before > 0 else 0.0
+
+
+def measure(func, repeat=1, track_memory=True):
+    """Run func, returning (result, {'seconds': best of repeat, 'peakBytes': traced peak}).
+
+    Memory is traced on an extra warm-up run, so tracing never slows the timed runs.
+    """
+    stats = {}
+    if track_memory:
+        tracemalloc.start()
+        func()
+        stats['peakBytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    stats['seconds'] = round(best, 6)
+    return result, stats
+
+
+def run_case(processor, tiled_engine, megapixels, pattern, gradient, repeat=1, track_memory=True,
+             tiled_min_megapixels=60, period=16):
+    """Benchmark one synthetic case and return its result record."""
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(megapixels * 1e6 / width))
+    image, reference = synthetic_fabric(height, width, pattern, gradient, period)
+    image_blocks = block_means(image)
+    stages = {}
+
+    encoded = processor.encode_image_bytes(image)
+    _, stages['decode'] = measure(lambda: processor.decode_image_bytes(encoded), repeat, track_memory)
+    # Preview proxy straight from the JPEG, decoded at reduced resolution
+    _, stages['decode_preview'] = measure(
+        lambda: processor.downscale_image(processor.open_image(encoded), DEFAULT_PREVIEW_MAX_DIMENSION),
+        repeat, track_memory
+    )
+
+    selection_area = processor.extract_selection_area(image, SELECTION)
+    correction_maps = {}
+    for mode in MODES:
+        correction_maps[mode], stages[f'analysis_{mode}'] = measure(
+            lambda: processor.analyze_gradient(selection_area, mode), repeat, track_memory
+        )
+
+    tiled = megapixels >= tiled_min_megapixels
+    results = {}
+    if tiled:
+        for mode in MODES:
+            results[mode], stages[f'apply_tiled_{mode}'] = measure(
+                lambda: tiled_engine.apply(image, correction_maps[mode], mode, 0.7, 0.8, 0.6), 1, False
+            )
+    else:
+        field, stages['field'] = measure(
+            lambda: processor.prepare_correction_field(correction_maps['advanced'], image.shape), repeat, track_memory
+        )
+
+        def decompose():
+            layers = processor.decompose_image(image)
+            for mode in MODES:
+                layers.texture(mode)
+            layers.median_lighting
+            return layers
+
+        layers, stages['decompose'] = measure(decompose, repeat, track_memory)
+        for mode in MODES:
+            results[mode], stages[f'blend_{mode}'] = measure(
+                lambda: processor.blend_correction(layers, field, mode, 0.7, 0.8, 0.6), repeat, track_memory
+            )
+        del layers, field
+
+    _, stages['encode'] = measure(lambda: processor.encode_image_bytes(results['advanced']), repeat, track_memory)
+
+    return {
+        'id': f'{megapixels:g}mp-{pattern}-{gradient}',
+        'megapixels': megapixels,
+        'size': {'width': width, 'height': height},
+        'pattern': pattern,
+        'gradient': gradient,
+        'tiled': tiled,
+        'stages': stages,
+        'totalSeconds': round(sum(stage['seconds'] for stage in stages.values()), 6),
+        'gradientRemoved': {
+            mode: round(gradient_removed(image_blocks, block_means(results[mode]), reference), 4) for mode in MODES
+        },
+    }
+
+
+def environment():
+    """What the numbers depend on, so runs from different machines aren't compared blindly."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def run(args):
+    processor = GradientRemovalProcessor(blur_mode=args.blur_mode)
+    tiled_engine = TiledCorrectionEngine(processor)
+    results = []
+    for megapixels in args.sizes:
+        for pattern in args.patterns:
+            for gradient in args.gradients:
+                result = run_case(processor, tiled_engine, megapixels, pattern, gradient,
+                                  args.repeat, not args.no_memory, args.tiled_min_megapixels)
+                removed = ', '.join(f'{mode} {value:.2f}' for mode, value in result['gradientRemoved'].items())
+                print(f"{result['id']:24s} {result['totalSeconds']:8.3f}s  removed: {removed}", flush=True)
+                results.append(result)
+
+    report = {
+        'schemaVersion': SCHEMA_VERSION,
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+        'environment': environment(),
+        'settings': {'repeat': args.repeat, 'selection': SELECTION, 'tiledMinMegapixels': args.tiled_min_megapixels,
+                     'blurMode': args.blur_mode},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.output}')
+    return 0
+
+
+def compare(args):
+    """Print per-stage speed ratios and quality changes; exit 1 on a regression."""
+    with open(args.baseline) as f:
+        baseline = {result['id']: result for result in json.load(f)['results']}
+    with open(args.current) as f:
+        current = {result['id']: result for result in json.load(f)['results']}
+
+    regressions = []
+    for case_id, result in current.items():
+        if case_id not in baseline:
+            continue
+        old = baseline[case_id]
+        for stage, stats in result['stages'].items():
+            if stage not in old['stages'] or old['stages'][stage]['seconds'] <= 0:
+                continue
+            ratio = stats['seconds'] / old['stages'][stage]['seconds']
+            flag = ''
+            # Ignore sub-millisecond stages, whose timings are mostly noise
+            if ratio > 1 + args.time_tolerance and stats['seconds'] > 1e-3:
+                flag = '  SLOWER'
+                regressions.append(f'{case_id} {stage} {ratio:.2f}x slower')
+            print(f'{case_id:24s} {stage:22s} {old["stages"][stage]["seconds"]:9.4f}s -> {stats["seconds"]:9.4f}s  {ratio:5.2f}x{flag}')
+        for mode, removed in result['gradientRemoved'].items():
+            before = old['gradientRemoved'].get(mode)
+            if before is not None and removed < before - args.quality_tolerance:
+                regressions.append(f'{case_id} {mode} removes {removed:.3f} of the gradient, was {before:.3f}')
+
+    if regressions:
+        print('\nRegressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print('\nNo regressions')
+    return 0
+
+
+def parse_list(value, choices=None, cast=str):
+    items = [cast(item) for item in value.split(',') if item]
+    if choices is not None:
+        unknown = [item for item in items if item not in choices]
+        if unknown:
+            raise argparse.ArgumentTypeError(f'unknown {unknown}, choose from {choices}')
+    return items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark gradient removal on synthetic fabrics.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('--sizes', type=lambda v: parse_list(v, cast=float), default=[1.0, 4.0],
+                            help='image sizes in megapixels, e.g. 1,4,16,100 (default 1,4)')
+    run_parser.add_argument('--patterns', type=lambda v: parse_list(v, PATTERNS), default=PATTERNS)
+    run_parser.add_argument('--gradients', type=lambda v: parse_list(v, GRADIENTS), default=GRADIENTS)
+    run_parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage; the best is kept')
+    run_parser.add_argument('--no-memory', action='store_true', help='skip the traced peak-memory runs')
+    run_parser.add_argument('--tiled-min-megapixels', type=float, default=60,
+                            help='sizes at least this large run through the tiled engine (default 60)')
+    run_parser.add_argument('--blur-mode', choices=BLUR_MODES, default='exact',
+                            help='blur mode of the processor, to compare exact and pyramid blurs')
+    run_parser.add_argument('--output', help='write results as JSON')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--time-tolerance', type=float, default=0.1,
+                                help='flag stages slower by more than this fraction (default 0.1)')
+    compare_parser.add_argument('--quality-tolerance', type=float, default=0.02,
+                                help='flag gradient removal dropping by more than this (default 0.02)')
+
+    args = parser.parse_args(argv)
+    # The processor logs every step at INFO, which would drown the report
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    return run(args) if args.command == 'run' else compare(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,111 @@
+"""
+Reusable scratch buffers and working-set accounting for the correction kernels.
+
+The final blend works through the image a block of rows at a time in a few
+scratch buffers. ScratchPool hands those buffers out and takes them back, so
+requests of the same width reuse them instead of allocating new temporaries
+every time. WorkingSet adds up the bytes one request holds, so the peak can be
+reported per request.
+"""
+
+import contextlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class WorkingSet:
+    """Bytes held by one request, and the peak reached."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+
+    def remove(self, nbytes):
+        with self._lock:
+            self.current -= nbytes
+
+
+class ScratchPool:
+    """NumPy buffers keyed by (shape, dtype), each lent to one caller at a time.
+
+    Returned buffers are kept for reuse up to max_idle_bytes; the least
+    recently returned shapes are dropped first.
+    """
+
+    def __init__(self, max_idle_bytes=256 * 1024**2):
+        self.max_idle_bytes = max_idle_bytes
+        self._idle = OrderedDict()
+        self._idle_bytes = 0
+        self._in_use_bytes = 0
+        self._peak_in_use_bytes = 0
+        self.reused = 0
+        self.allocated = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def borrow(self, shape, dtype=np.float32, working_set=None):
+        """Context manager yielding an uninitialised buffer of shape and dtype."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            buffers = self._idle.get(key)
+            buffer = buffers.pop() if buffers else None
+            if buffer is not None:
+                self._idle_bytes -= buffer.nbytes
+                self.reused += 1
+            else:
+                self.allocated += 1
+        if buffer is None:
+            buffer = np.empty(shape, dtype)
+
+        with self._lock:
+            self._in_use_bytes += buffer.nbytes
+            self._peak_in_use_bytes = max(self._peak_in_use_bytes, self._in_use_bytes)
+        if working_set is not None:
+            working_set.add(buffer.nbytes)
+        try:
+            yield buffer
+        finally:
+            if working_set is not None:
+                working_set.remove(buffer.nbytes)
+            self._give_back(key, buffer)
+
+    def _give_back(self, key, buffer):
+        with self._lock:
+            self._in_use_bytes -= buffer.nbytes
+            if buffer.nbytes > self.max_idle_bytes:
+                return
+            self._idle.setdefault(key, []).append(buffer)
+            self._idle.move_to_end(key)
+            self._idle_bytes += buffer.nbytes
+            while self._idle_bytes > self.max_idle_bytes:
+                _, dropped = self._idle.popitem(last=False)
+                self._idle_bytes -= sum(b.nbytes for b in dropped)
+
+    def __getstate__(self):
+        # Pickled along with the processor for process pools; buffers are not worth shipping
+        return {'max_idle_bytes': self.max_idle_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_idle_bytes'])
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idleBytes': self._idle_bytes,
+                'inUseBytes': self._in_use_bytes,
+                'peakInUseBytes': self._peak_in_use_bytes,
+                'reused': self.reused,
+                'allocated': self.allocated,
+            }
@@ -0,0 +1,292 @@
+"""
+Flat-field calibration profiles for scans from a fixed lighting rig.
+
+A rig's lighting gradient is nearly the same from one scan to the next, so
+the correction map can be captured once and reused, without analysing every
+scan or asking for a selection. A profile is captured either from a blank or
+reference scan of the rig (GradientRemovalProcessor.analyze_reference) or from
+an existing analysis of a selection. It is stored as a small float32 map, at
+most PROFILE_MAX_DIMENSION on its longest side, which is stretched over each
+new scan like any correction map and so fits any resolution.
+
+Profiles are stored by name, and every capture under a name adds a new
+version. Unless a version is given, the latest one applies. On disk each
+version is one file, <directory>/<name>/<version>.profile, holding a JSON
+metadata line followed by the map. Versions are claimed with a hard link, so
+processes sharing the directory never overwrite each other's captures.
+
+Usage:
+    python calibration.py capture RIG_A blank_scan.jpg --dir profiles
+    python calibration.py capture RIG_A scan.jpg --selection 0.05,0.05,0.2,0.2 --dir profiles
+    python calibration.py list --dir profiles
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump when the file layout changes; newer files are rejected instead of misread
+PROFILE_FORMAT_VERSION = 1
+PROFILE_MAX_DIMENSION = 256
+PROFILE_SUFFIX = '.profile'
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
+
+class UnknownProfileError(KeyError):
+    """No profile (or no such version of it) is stored under the name."""
+
+
+def validate_name(name):
+    if not isinstance(name, str) or not NAME_PATTERN.match(name):
+        raise ValueError('Invalid profile name: use up to 64 letters, digits, ".", "_" or "-"')
+    return name
+
+
+class CalibrationProfile:
+    """A stored correction map with where it came from.
+
+    version is None until the profile is saved to a ProfileStore.
+    """
+
+    def __init__(self, name, correction_map, kind, source, source_size, selection=None,
+                 version=None, created=None, algorithm_version=None):
+        self.name = validate_name(name)
+        self.correction_map = np.ascontiguousarray(correction_map, dtype=np.float32)
+        self.kind = kind
+        self.source = source
+        self.source_size = tuple(source_size)
+        self.selection = selection
+        self.version = version
+        self.created = created if created is not None else time.time()
+        self.algorithm_version = algorithm_version
+        # Identifies the map itself, for cache keys that must change when a profile is replaced
+        self.digest = hashlib.sha256(self.correction_map.tobytes()).hexdigest()[:16]
+
+    @classmethod
+    def from_analysis(cls, name, analysis, image_shape, source, selection=None, algorithm_version=None):
+        """Profile of a CorrectionAnalysis made on an image of image_shape."""
+        correction_map = analysis.correction_map.astype(np.float32)
+        h, w = correction_map.shape[:2]
+        scale = PROFILE_MAX_DIMENSION / max(h, w)
+        if scale < 1.0:
+            # The maps are smooth surfaces, so a small version resamples back almost exactly
+            size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            correction_map = cv2.resize(correction_map, size, interpolation=cv2.INTER_AREA)
+        return cls(name, correction_map, analysis.kind, source, (image_shape[1], image_shape[0]),
+                   selection, algorithm_version=algorithm_version)
+
+    @property
+    def nbytes(self):
+        return self.correction_map.nbytes
+
+    def matches_aspect(self, image_shape, tolerance=0.05):
+        """Whether image_shape has the aspect ratio of the scan the profile was captured on."""
+        source_w, source_h = self.source_size
+        return abs((image_shape[1] / image_shape[0]) / (source_w / source_h) - 1) <= tolerance
+
+    def check_image(self, image_shape):
+        """Log a warning if the profile is applied to a scan of another shape."""
+        if not self.matches_aspect(image_shape):
+            logger.warning(f"Calibration profile {self.name} v{self.version} was captured on a "
+                           f"{self.source_size[0]}x{self.source_size[1]} scan, applying it to "
+                           f"{image_shape[1]}x{image_shape[0]} stretches the correction")
+
+    def metadata(self):
+        h, w = self.correction_map.shape[:2]
+        return {
+            'name': self.name,
+            'version': self.version,
+            'kind': self.kind,
+            'source': self.source,
+            'sourceSize': {'width': self.source_size[0], 'height': self.source_size[1]},
+            'selection': self.selection,
+            'fieldSize': {'width': w, 'height': h},
+            'created': self.created,
+            'algorithmVersion': self.algorithm_version,
+            'digest': self.digest,
+        }
+
+
+class ProfileStore:
+    """Versioned calibration profiles in a directory, or only in memory if directory is None.
+
+    Loaded profiles are cached by file identity, so changes made by other
+    processes are picked up on the next get().
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._profiles = {}  # (name, version) -> (profile, file stamp)
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def versions(self, name):
+        """Stored versions of a profile, oldest first."""
+        validate_name(name)
+        if self.directory is None:
+            with self._lock:
+                return sorted(version for profile_name, version in self._profiles if profile_name == name)
+        try:
+            files = os.listdir(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return []
+        return sorted(int(f[:-len(PROFILE_SUFFIX)]) for f in files
+                      if f.endswith(PROFILE_SUFFIX) and f[:-len(PROFILE_SUFFIX)].isdigit())
+
+    def names(self):
+        if self.directory is None:
+            with self._lock:
+                return sorted({name for name, _ in self._profiles})
+        return sorted(name for name in os.listdir(self.directory)
+                      if NAME_PATTERN.match(name) and self.versions(name))
+
+    def get(self, name, version=None):
+        """The given (default: latest) version of a profile; raises UnknownProfileError."""
+        versions = self.versions(name)
+        if version is None and versions:
+            version = versions[-1]
+        if version not in versions:
+            label = name if version is None else f'{name} v{version}'
+            raise UnknownProfileError(f'Unknown calibration profile: {label}')
+        if self.directory is None:
+            with self._lock:
+                return self._profiles[(name, version)][0]
+
+        path = self._path(name, version)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise UnknownProfileError(f'Unknown calibration profile: {name} v{version}')
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._profiles.get((name, version))
+        if cached is not None and cached[1] == stamp:
+            return cached[0]
+        profile = self._read(path)
+        with self._lock:
+            self._profiles[(name, version)] = (profile, stamp)
+        return profile
+
+    def save(self, profile):
+        """Store profile as the next version of its name and return that version."""
+        if self.directory is None:
+            with self._lock:
+                versions = [version for name, version in self._profiles if name == profile.name]
+                profile.version = max(versions, default=0) + 1
+                self._profiles[(profile.name, profile.version)] = (profile, None)
+            return profile.version
+
+        os.makedirs(os.path.join(self.directory, profile.name), exist_ok=True)
+        temp_path = os.path.join(self.directory, profile.name,
+                                 f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        while True:
+            profile.version = max(self.versions(profile.name), default=0) + 1
+            self._write(temp_path, profile)
+            try:
+                # Fails if another process claimed this version in the meantime
+                os.link(temp_path, self._path(profile.name, profile.version))
+                break
+            except FileExistsError:
+                continue
+            finally:
+                os.remove(temp_path)
+        logger.info(f"Saved calibration profile {profile.name} v{profile.version} ({profile.kind})")
+        return profile.version
+
+    def delete(self, name, version=None):
+        """Delete one version, or all versions of a profile. Returns the number deleted."""
+        versions = self.versions(name) if version is None else [v for v in self.versions(name) if v == version]
+        for v in versions:
+            with self._lock:
+                self._profiles.pop((name, v), None)
+            if self.directory is not None:
+                try:
+                    os.remove(self._path(name, v))
+                except FileNotFoundError:
+                    pass
+        return len(versions)
+
+    def _path(self, name, version):
+        return os.path.join(self.directory, name, f'{version}{PROFILE_SUFFIX}')
+
+    @staticmethod
+    def _write(path, profile):
+        header = {
+            **profile.metadata(),
+            'formatVersion': PROFILE_FORMAT_VERSION,
+            'dtype': 'float32',
+            'byteOrder': 'little',
+        }
+        with open(path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(profile.correction_map.astype('<f4').tobytes())
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            metadata = json.loads(f.readline())
+            data = f.read()
+        if metadata.get('formatVersion', 0) > PROFILE_FORMAT_VERSION:
+            raise ValueError(f'Calibration profile {path} needs a newer version of this service')
+        size = metadata['fieldSize']
+        correction_map = np.frombuffer(data, dtype='<f4').reshape(size['height'], size['width'])
+        return CalibrationProfile(
+            metadata['name'], correction_map.astype(np.float32), metadata['kind'], metadata['source'],
+            (metadata['sourceSize']['width'], metadata['sourceSize']['height']), metadata.get('selection'),
+            metadata['version'], metadata['created'], metadata.get('algorithmVersion'),
+        )
+
+
+def main(argv=None):
+    from batch import parse_selection
+    from gradient_removal import GradientRemovalProcessor
+
+    parser = argparse.ArgumentParser(description='Capture and list flat-field calibration profiles.')
+    parser.add_argument('--dir', default=os.environ.get('CALIBRATION_DIR', 'calibration_profiles'),
+                        help='profile directory (default: $CALIBRATION_DIR or ./calibration_profiles)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    capture = commands.add_parser('capture', help='capture a profile from a scan')
+    capture.add_argument('name')
+    capture.add_argument('scan', help='blank/reference scan, or a scan to analyse with --selection')
+    capture.add_argument('--selection', type=parse_selection,
+                         help='analyse this selection (left,top,width,height fractions) instead of '
+                              'treating the whole scan as a blank reference')
+    commands.add_parser('list', help='list stored profiles')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    store = ProfileStore(args.dir)
+
+    if args.command == 'list':
+        for name in store.names():
+            print(json.dumps({**store.get(name).metadata(), 'versions': store.versions(name)}))
+        return 0
+
+    try:
+        validate_name(args.name)
+    except ValueError as e:
+        parser.error(str(e))
+    processor = GradientRemovalProcessor()
+    if args.scan.lower().endswith('.npy'):
+        image = np.load(args.scan)
+    else:
+        # Reference captures only need a reduced decode
+        image = processor.open_image(args.scan)
+    profile = processor.capture_profile(args.name, image, args.selection)
+    store.save(profile)
+    print(json.dumps(profile.metadata(), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,149 @@
+"""
+Image decoding for uploads and scans: codec backend, reduced-resolution and lazy decodes.
+
+JPEG stores 8x8 DCT blocks, so libjpeg can decode straight to 1/2, 1/4 or 1/8
+resolution by using fewer coefficients per block. That skips most of the
+IDCT, color conversion and upsampling work. A 40 MP JPEG decodes in ~0.2 s
+at 1/4 against ~0.45 s in full (~0.6 s through PIL). Previews decode at the
+smallest reduction that is still at least as large as the proxy and resize
+the rest of the way, so the proxy has the same size as one made from a full
+decode.
+
+OpenCV and PIL wrap the same libjpeg-turbo and libpng and decode 8-bit RGB and
+grayscale images to the same pixels. cv2 is faster because it skips PIL's
+copies. Other modes (CMYK, 16-bit, alpha, palette) and formats (TIFF, GIF, ...)
+always go through PIL's convert('RGB'). Neither library can decode a JPEG
+region without decoding the whole image, so region decodes crop a full decode
+and keep only the region: they save memory, not decode time. (Stopping PIL's
+JPEG decoder after the region's last row gives the same pixels, but is slower
+than cv2's full decode unless the region is near the top of the image.)
+
+Sources are encoded bytes, any buffer (bytearray, memoryview, mmap) or a local
+file path, which is memory-mapped instead of read into a bytes copy.
+"""
+
+import io
+import mmap
+import os
+import cv2
+import numpy as np
+from PIL import Image
+
+BACKENDS = ['cv2', 'pil']
+# Scale factors libjpeg can apply while decoding, largest first
+JPEG_REDUCTIONS = (8, 4, 2)
+
+_CV2_FORMATS = {'JPEG', 'PNG', 'WEBP', 'BMP'}
+_CV2_MODES = {'RGB', 'L'}
+_CV2_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def read_source(source):
+    """Encoded image data of a source: buffers pass through, file paths are memory-mapped."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f'Empty image file: {source}')
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return source
+
+
+class ImageDecoder:
+    """Decodes encoded images to RGB uint8 arrays, in full, reduced or by region."""
+
+    def __init__(self, backend='cv2'):
+        if backend not in BACKENDS:
+            raise ValueError(f'Invalid decoder backend. Must be one of {BACKENDS}')
+        self.backend = backend
+
+    @staticmethod
+    def open(data):
+        """PIL image of encoded data with only the header read."""
+        try:
+            return Image.open(io.BytesIO(data))
+        except Exception as e:
+            raise ValueError(f'Invalid image data: {e}')
+
+    def decode(self, source, max_dimension=None):
+        """(image, scale): the decoded RGB array and its width relative to the full image.
+
+        With max_dimension, JPEGs decode at the largest DCT reduction whose longest
+        side is still at least max_dimension; other formats decode in full.
+        """
+        data = read_source(source)
+        header = self.open(data)
+        w, h = header.size
+        reduction = 1
+        if max_dimension is not None and header.format == 'JPEG':
+            reduction = next((k for k in JPEG_REDUCTIONS
+                              if -(-max(w, h) // k) >= max_dimension and min(w, h) >= k), 1)
+
+        try:
+            if self.backend == 'cv2' and header.format in _CV2_FORMATS and header.mode in _CV2_MODES:
+                # PIL ignores EXIF orientation, so the backends agree
+                image = cv2.imdecode(np.frombuffer(data, np.uint8),
+                                     _CV2_FLAGS[reduction] | cv2.IMREAD_IGNORE_ORIENTATION)
+                if image is None:
+                    raise ValueError(f'cannot decode {header.format} data')
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            else:
+                if reduction > 1:
+                    header.draft('RGB', (w // reduction, h // reduction))
+                if header.mode != 'RGB':
+                    header = header.convert('RGB')
+                image = np.array(header)
+        except Exception as e:
+            raise ValueError(f'Invalid image data: {e}')
+        return image, image.shape[1] / w
+
+    def decode_region(self, source, bounds):
+        """The RGB pixels of bounds = (x1, y1, x2, y2), clipped to the image.
+
+        Only the region is kept, but the codecs decode the whole image to get it.
+        """
+        image, _ = self.decode(source)
+        x1, y1, x2, y2 = bounds
+        return image[max(0, y1):y2, max(0, x1):x2].copy()
+
+
+class EncodedImage:
+    """An encoded image that is decoded on demand: in full, reduced or by region.
+
+    shape comes from the header, so code that only needs the size never decodes.
+    Slicing it like an array, image[y1:y2, x1:x2], returns just that region
+    without keeping the rest of the decode.
+    """
+
+    def __init__(self, source, decoder):
+        self.data = read_source(source)
+        self.decoder = decoder
+        header = decoder.open(self.data)
+        self.format = header.format
+        w, h = header.size
+        self.shape = (h, w, 3)
+
+    @property
+    def reducible(self):
+        """Whether reduced decodes are cheaper than full ones."""
+        return self.format == 'JPEG'
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def decode(self, max_dimension=None):
+        """The RGB array, in full or reduced as by ImageDecoder.decode."""
+        return self.decoder.decode(self.data, max_dimension)[0]
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2 and all(isinstance(k, slice) for k in key)):
+            raise TypeError('EncodedImage only supports [rows, columns] slices')
+        h, w = self.shape[:2]
+        y1, y2, _ = key[0].indices(h)
+        x1, x2, _ = key[1].indices(w)
+        return self.decoder.decode_region(self.data, (x1, y1, x2, y2))
@@ -0,0 +1,62 @@
+"""
+Opt-in quality diagnostics for corrected images.
+
+Texture retention and lighting uniformity improvement compare blurs of the
+corrected image with blurs of the original, which costs more than several
+processing stages. So processing skips them unless DiagnosticsPolicy asks:
+for a request that sets "diagnostics": true, or on every sample_every-th
+request. Measurements run on proxies at most max_dimension pixels on their
+longest side (None measures at full resolution). Results go back to the caller,
+to the log and to histograms on /metrics.
+"""
+
+import logging
+import threading
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+TEXTURE_RETENTION = Histogram(
+    'gradient_removal_texture_retention', 'Texture standard deviation of corrected images relative to the original.',
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0)
+)
+UNIFORMITY_IMPROVEMENT = Histogram(
+    'gradient_removal_uniformity_improvement', 'Relative reduction of large-scale lighting variation.',
+    buckets=(-0.5, -0.25, 0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+
+
+class DiagnosticsPolicy:
+    """Which requests get quality diagnostics, and at what resolution."""
+
+    def __init__(self, sample_every=0, max_dimension=512):
+        # 0 measures only requests that ask for it, 1 every request, N every Nth
+        self.sample_every = sample_every
+        self.max_dimension = max_dimension
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def should_measure(self, requested=False):
+        if requested:
+            return True
+        if self.sample_every <= 0:
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self.sample_every == 0
+
+    def record(self, diagnostics):
+        """Log a measurement and add it to the /metrics histograms."""
+        TEXTURE_RETENTION.observe(diagnostics['textureRetention'])
+        UNIFORMITY_IMPROVEMENT.observe(diagnostics['uniformityImprovement'])
+        logger.info(f"Texture preservation: {diagnostics['textureRetention']:.3f} (target: >0.8)")
+        logger.info(f"Lighting uniformity improvement: {diagnostics['uniformityImprovement']:.3f} (higher is better)")
+        logger.info(f"Final brightness: Original={diagnostics['originalBrightness']:.1f}, "
+                    f"Final={diagnostics['finalBrightness']:.1f}")
+
+    def __getstate__(self):
+        # Pickled along with the processor for process pools
+        return {'sample_every': self.sample_every, 'max_dimension': self.max_dimension}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
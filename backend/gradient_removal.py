@@ -7,22 +7,349 @@ variations in fabric scans while preserving texture details.
 
 import numpy as np
 import cv2
-from PIL import Image
 import base64
-import io
-from scipy import ndimage
-from scipy.interpolate import griddata
+import copy
 import logging
+import threading
+from surface_fit import PolynomialSurface
+from region_stats import RegionStats
+from pattern_analysis import PatternAnalyzer
+from buffers import ScratchPool, WorkingSet
+from metrics import timed_stage, PATTERN_DECISIONS
+from diagnostics import DiagnosticsPolicy
+from encoding import ImageEncoder, FORMATS
+from decoding import ImageDecoder, EncodedImage, read_source
+from calibration import CalibrationProfile
 
 logger = logging.getLogger(__name__)
 
+# Bump whenever a change alters corrected output, so persisted results are recomputed
+ALGORITHM_VERSION = 3
+
+# Texture added back on top of the corrected lighting: weights of the fine (original - blur5),
+# medium (blur5 - blur15) and coarse (blur15 - blur35) detail
+TEXTURE_WEIGHTS = {'uniform': (1.0, 0.8, 0.0), 'advanced': (0.9, 0.8, 0.7)}
+
+# Longest side of the lightness proxy uniform analysis takes its region means from
+UNIFORM_STATS_DIMENSION = 256
+
+# 'exact' blurs at full resolution; 'pyramid' computes the large lighting blurs at reduced
+# resolution (pyramid_blur)
+BLUR_MODES = ['exact', 'pyramid']
+# Smallest Gaussian sigma pyramid_blur leaves at the reduced scale; below it the
+# kernel is too coarsely sampled there
+PYRAMID_MIN_SIGMA = 1.75
+
+def scaled_kernel(ksize, sigma, scale=1.0):
+    """Gaussian kernel size and sigma covering the same scene area on an image resized by scale."""
+    if scale == 1.0:
+        return ksize, sigma
+    return max(3, int(round(ksize * scale)) | 1), sigma * scale
+
+def gaussian_blur(image, ksize, sigma, parallel=None, mode='exact'):
+    """cv2.GaussianBlur with a square kernel, split across row bands when a ParallelEngine is given.
+    
+    mode='pyramid' computes kernels wide enough for it at reduced resolution (pyramid_blur).
+    """
+    if mode == 'pyramid' and pyramid_factor(ksize, sigma, image.shape) > 1:
+        return pyramid_blur(image, ksize, sigma, parallel)
+    if parallel is None:
+        return cv2.GaussianBlur(image, (ksize, ksize), sigma)
+    return parallel.gaussian_blur(image, ksize, sigma)
+
+def pyramid_factor(ksize, sigma, shape):
+    """Decimation factor for pyramid_blur: the largest power of two that leaves a sigma
+    of at least PYRAMID_MIN_SIGMA pixels at the reduced scale, or 1 for an exact blur."""
+    factor = 1
+    while sigma / (factor * 2) >= PYRAMID_MIN_SIGMA and (ksize // 2) // (factor * 2) >= 2:
+        factor *= 2
+    # Small images would be mostly exact edge bands
+    if min(shape[:2]) < 8 * (ksize // 2):
+        return 1
+    return factor
+
+def pyramid_blur(image, ksize, sigma, parallel=None):
+    """Fast approximation of gaussian_blur for large kernels.
+    
+    The image is block-averaged by pyramid_factor, blurred there with the sigma
+    left over after the box filter (sigma^2 = factor^2 * s^2 + (factor^2 - 1) / 12),
+    and upsampled bilinearly. Borders follow a different reflection at the reduced
+    scale, so bands within a kernel radius plus two blocks of each edge are
+    blurred exactly from the original instead.
+    
+    The error is at most half the input's value range times the L1 distance
+    between the two kernels, which is up to 0.22 for the lighting kernels
+    (tests/test_pyramid_blur.py).
+    """
+    h, w = image.shape[:2]
+    factor = pyramid_factor(ksize, sigma, image.shape)
+    radius = ksize // 2
+    small_h, small_w = h // factor, w // factor
+    # Views of the whole blocks; a remainder of up to factor - 1 pixels falls in the exact bands
+    small = cv2.resize(image[:small_h * factor, :small_w * factor], (small_w, small_h),
+                       interpolation=cv2.INTER_AREA)
+    small_sigma = np.sqrt(sigma**2 - (factor**2 - 1) / 12.0) / factor
+    small_radius = max(1, int(round(radius / factor)))
+    small = cv2.GaussianBlur(small, (2 * small_radius + 1, 2 * small_radius + 1), small_sigma,
+                             borderType=cv2.BORDER_REFLECT)
+    # Padding by one block lets the upsample cover the remainder without a non-integer scale
+    small = cv2.copyMakeBorder(small, 0, 1, 0, 1, cv2.BORDER_REPLICATE)
+    result = cv2.resize(small, ((small_w + 1) * factor, (small_h + 1) * factor),
+                        interpolation=cv2.INTER_LINEAR)[:h, :w]
+    
+    band = radius + 2 * factor
+    edges = [
+        ((slice(0, band), slice(None)), image[:band + radius], (slice(0, band), slice(None))),
+        ((slice(h - band, h), slice(None)), image[h - band - radius:], (slice(radius, None), slice(None))),
+        ((slice(None), slice(0, band)), image[:, :band + radius], (slice(None), slice(0, band))),
+        ((slice(None), slice(w - band, w)), image[:, w - band - radius:], (slice(None), slice(radius, None))),
+    ]
+    for target, window, inner in edges:
+        result[target] = gaussian_blur(np.ascontiguousarray(window), ksize, sigma, parallel)[inner]
+    return result
+
+def map_bands(parallel, func, height):
+    """Run func(y0, y1, wy0, wy1) over row bands, serially as one band without a ParallelEngine."""
+    if parallel is None:
+        return [func(0, height, 0, height)]
+    return parallel.map_bands(func, height)
+
+class ScaleSpace:
+    """Gaussian blurs of one image, each (ksize, sigma) level computed at most once.
+    
+    Levels are keyed by their full-resolution kernel and scaled for downscaled
+    previews. With cascade=True a level is blurred from the largest cached finer
+    level with the difference kernel (sigma^2 = s^2 - s_prev^2, support no wider
+    than the direct kernel): cheaper, but not bit-identical to a direct blur.
+    With blur_mode='pyramid' the large levels are computed by pyramid_blur.
+    Callers must not modify the returned arrays. Cached instances are shared
+    between request threads, so levels are computed and released under a lock.
+    """
+    
+    def __init__(self, image, scale=1.0, parallel=None, cascade=False, blur_mode='exact'):
+        self.image = image
+        self.scale = scale
+        self.parallel = parallel
+        self.cascade = cascade
+        self.blur_mode = blur_mode
+        self._levels = {}
+        self._lock = threading.Lock()
+    
+    def level(self, ksize, sigma):
+        key = (ksize, sigma)
+        with self._lock:
+            level = self._levels.get(key)
+            if level is None:
+                level = self._compute(ksize, sigma)
+                self._levels[key] = level
+        return level
+    
+    def _compute(self, ksize, sigma):
+        ksize, sigma = scaled_kernel(ksize, sigma, self.scale)
+        if self.cascade:
+            finer = [
+                (scaled_kernel(k, s, self.scale), level) for (k, s), level in self._levels.items()
+            ]
+            finer = [(k, s, level) for (k, s), level in finer if k < ksize and s < sigma]
+            if finer:
+                k_prev, s_prev, previous = max(finer, key=lambda item: item[1])
+                # Radii add up, so the cascade reads no further than the direct kernel
+                return gaussian_blur(previous, ksize - k_prev + 1, np.sqrt(sigma**2 - s_prev**2),
+                                     self.parallel, self.blur_mode)
+        return gaussian_blur(self.image, ksize, sigma, self.parallel, self.blur_mode)
+    
+    def release(self, keep=()):
+        """Drop cached levels except the (ksize, sigma) pairs in keep."""
+        with self._lock:
+            self._levels = {key: level for key, level in self._levels.items() if key in keep}
+    
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in list(self._levels.values()))
+
+class ImageLayers:
+    """Lighting/texture decomposition of one image, independent of the strength settings.
+    
+    Texture layers are built lazily per mode, so a cached instance only pays for
+    the modes that were actually requested.
+    """
+    
+    def __init__(self, image, scale=1.0, parallel=None, cascade=False, blur_mode='exact'):
+        self.image = image
+        self.scale = scale
+        self.parallel = parallel
+        self.original = image.astype(np.float32)
+        self.levels = ScaleSpace(self.original, scale, parallel, cascade, blur_mode)
+        if cascade:
+            # Texture needs the fine levels anyway; computing them first lets the base cascade
+            self.levels.level(5, 1.0)
+            self.levels.level(15, 3.0)
+        
+        # Get the base lighting (heavily smoothed)
+        self.base_lighting = self.levels.level(35, 7.0)
+        self.mean_brightness = float(np.mean(self.original))
+        self._median_lighting = None
+        self._textures = {}
+        self._means = {}
+        # Cached layers serve several request threads; each texture is built once
+        self._texture_lock = threading.Lock()
+    
+    @property
+    def median_lighting(self):
+        """Per-channel median of the base lighting (more robust than the mean)."""
+        if self._median_lighting is None:
+            self._median_lighting = np.median(self.base_lighting, axis=(0, 1)).astype(np.float32)
+        return self._median_lighting
+    
+    def mean(self, layer):
+        """Mean over all pixels and channels of the base lighting ('base') or a mode's texture."""
+        if layer not in self._means:
+            values = self.base_lighting if layer == 'base' else self.texture(layer)
+            self._means[layer] = float(np.mean(values, dtype=np.float64))
+        return self._means[layer]
+    
+    def has_texture(self, mode):
+        return mode in self._textures
+    
+    def texture(self, mode):
+        """Weighted multi-scale texture to add back on top of the corrected lighting."""
+        with self._texture_lock:
+            texture = self._textures.get(mode)
+            if texture is None:
+                texture = self._textures[mode] = self._build_texture(mode)
+        return texture
+    
+    @timed_stage('texture')
+    def _build_texture(self, mode):
+        # Texture details at multiple scales, as differences between blur levels:
+        # fine threads = original - blur5, medium weave = blur5 - blur15,
+        # coarse structure = blur15 - blur35
+        blur_fine = self.levels.level(5, 1.0)
+        blur_medium = self.levels.level(15, 3.0)
+        texture = np.empty_like(self.original)
+        # Uniform: full fine texture plus 80% of the medium weave;
+        # advanced: 90% fine, 80% medium and 70% coarse texture preservation
+        fine, medium, coarse = TEXTURE_WEIGHTS['uniform' if mode == 'uniform' else 'advanced']
+        
+        def build_band(y0, y1, *_):
+            # Row chunks keep the temporary small; the blur levels are shared and stay unmodified
+            for r0 in range(y0, y1, 256):
+                rows = slice(r0, min(r0 + 256, y1))
+                texture[rows] = self.original[rows] - blur_fine[rows]
+                detail = blur_fine[rows] - blur_medium[rows]
+                if fine != 1.0:
+                    texture[rows] *= fine
+                texture[rows] += medium * detail
+                if coarse:
+                    np.subtract(blur_medium[rows], self.base_lighting[rows], out=detail)
+                    texture[rows] += coarse * detail
+        
+        map_bands(self.parallel, build_band, texture.shape[0])
+        return texture
+    
+    def compact(self):
+        """Drop the intermediate blur levels, keeping what blending needs (for caching)."""
+        self.levels.release(keep=[(35, 7.0)])
+    
+    @property
+    def nbytes(self):
+        return self.original.nbytes + self.levels.nbytes + sum(t.nbytes for t in list(self._textures.values()))
+class CorrectionAnalysis:
+    """A selection's correction map and how it was derived.
+    
+    kind is 'uniform', 'conservative', 'gentle', 'standard' or 'flat-field' (from a
+    reference scan). Gentle and standard maps are clip(target / surface, *limits) of
+    a lighting surface fitted over the selection, which is kept so the map can be
+    evaluated at any resolution.
+    """
+    
+    def __init__(self, correction_map, kind, surface=None, target=None, limits=None):
+        self.correction_map = correction_map
+        self.kind = kind
+        self.surface = surface
+        self.target = target
+        self.limits = limits
+    
+    @property
+    def nbytes(self):
+        return self.correction_map.nbytes
+    
+    def surface_dict(self):
+        """The fitted surface as JSON-ready polynomial coefficients, or None.
+        
+        The map is stretched over the whole image, so at any output resolution
+        W x H the pixel (x, y) has u = 2 * (x + 0.5) / W - 1, v = 2 * (y + 0.5) / H - 1
+        and the factor is clip(target / surface(u, v), *limits), 1 where the surface is 0.
+        """
+        if self.surface is None:
+            return None
+        # Fold the mean shift into the constant term: surface - mean + target
+        coefficients = self.surface.coefficients.copy()
+        coefficients[0, 0] += self.target - self.surface.mean()
+        # The fit normalised pixel centres of the selection to [-1, 1]; resizing maps
+        # output pixel centres onto them scaled by n / (n - 1)
+        h, w = self.surface.shape
+        x_scale = w / (w - 1) if w > 1 else 1.0
+        y_scale = h / (h - 1) if h > 1 else 1.0
+        terms = PolynomialSurface.terms(self.surface.degree)
+        for a, b in terms:
+            coefficients[b, a] *= x_scale ** a * y_scale ** b
+        return {
+            'degree': self.surface.degree,
+            'terms': [{'x': a, 'y': b, 'coefficient': float(coefficients[b, a])} for a, b in terms],
+            'target': float(self.target),
+            'limits': list(self.limits),
+            'rmsResidual': self.surface.rms_residual,
+        }
+
 class GradientRemovalProcessor:
-    def __init__(self):
+    def __init__(self, parallel=None, blur_mode='exact'):
+        if blur_mode not in BLUR_MODES:
+            raise ValueError(f'Invalid blur mode. Must be one of {BLUR_MODES}')
         self.kernel_size = 15
         self.sigma = 2.0
-        
+        # Polynomial degree of the fitted lighting surface, for patterned and plain fabrics
+        self.gentle_surface_degree = 1
+        self.standard_surface_degree = 2
+        # Derive coarser blur levels from finer ones (faster, not bit-identical)
+        self.cascade_blurs = False
+        # 'pyramid' computes the large lighting blurs at reduced resolution (faster, approximate)
+        self.blur_mode = blur_mode
+        # Spectral pattern detection on a few FFT-sized windows of the selection
+        self.pattern_analyzer = PatternAnalyzer()
+        # The final blend runs in blocks of rows through pooled scratch buffers
+        self.blend_chunk_rows = 64
+        self.scratch_pool = ScratchPool()
+        # Texture/uniformity quality metrics are off unless requested or sampled
+        self.diagnostics = DiagnosticsPolicy()
+        # Result codec backend and quality presets
+        self.encoder = ImageEncoder()
+        # Upload codec backend; the backends decode to the same pixels
+        self.decoder = ImageDecoder()
+        # Optional parallel.ParallelEngine; results are identical to the serial path
+        self.parallel = parallel
+        
+    def result_version(self):
+        """Everything besides the request that determines an encoded result, for result cache keys."""
+        return [
+            ALGORITHM_VERSION, self.kernel_size, self.sigma,
+            self.gentle_surface_degree, self.standard_surface_degree, self.cascade_blurs, self.blur_mode,
+            self.pattern_analyzer.max_window, self.pattern_analyzer.max_windows,
+            self.encoder.backend, self.encoder.presets,
+        ]
+    
+    def serial(self):
+        """Copy of this processor that runs on the calling thread only."""
+        clone = copy.copy(self)
+        clone.parallel = None
+        return clone
+    
     def decode_image(self, image_data_url):
         """Decode base64 image data URL to numpy array."""
+        return self.decode_image_bytes(self.data_url_to_bytes(image_data_url))
+    
+    def data_url_to_bytes(self, image_data_url):
+        """Extract the encoded image bytes from a base64 data URL."""
         try:
             # Remove data URL prefix if present
             if ',' in image_data_url:
@@ -31,41 +358,58 @@ class GradientRemovalProcessor:
                 image_data = image_data_url
                 
             # Decode base64
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-                
-            # Convert to numpy array
-            return np.array(image)
+            return base64.b64decode(image_data)
         except Exception as e:
             logger.error(f"Error decoding image: {e}")
             raise ValueError(f"Invalid image data: {e}")
     
-    def encode_image(self, image_array):
+    @timed_stage('decode')
+    def decode_image_bytes(self, image_bytes):
+        """Decode encoded image bytes (JPEG, PNG, ...) or any buffer such as an mmap to an RGB numpy array."""
+        try:
+            return self.decoder.decode(image_bytes)[0]
+        except ValueError as e:
+            logger.error(f"Error decoding image: {e}")
+            raise
+    
+    def decode_image_file(self, path):
+        """Decode a local image file, memory-mapped instead of read into memory first."""
+        return self.decode_image_bytes(read_source(path))
+    
+    def open_image(self, image_bytes):
+        """EncodedImage for bytes, a buffer or a file path, decoded only when and as far as needed."""
+        return EncodedImage(image_bytes, self.decoder)
+    
+    def encode_image(self, image_array, format='jpeg', preset='final', quality=None, subsampling=None):
         """Encode numpy array to base64 data URL."""
+        return self.bytes_to_data_url(self.encode_image_bytes(image_array, format, preset, quality, subsampling), format)
+    
+    def bytes_to_data_url(self, image_bytes, format='jpeg'):
+        """Base64 data URL for encoded image bytes."""
+        return f"data:{FORMATS[format][0]};base64,{base64.b64encode(image_bytes).decode()}"
+    
+    @timed_stage('encode')
+    def encode_image_bytes(self, image_array, format='jpeg', preset='final', quality=None, subsampling=None):
+        """Encode numpy array to image bytes, JPEG unless format says otherwise.
+        
+        preset ('preview' or 'final') picks the quality/speed settings of the encoder;
+        quality and subsampling override them.
+        """
         try:
-            # Ensure values are in valid range
-            image_array = np.clip(image_array, 0, 255).astype(np.uint8)
-            
-            # Convert to PIL Image
-            image = Image.fromarray(image_array)
-            
-            # Save to bytes
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG', quality=95)
-            image_data = base64.b64encode(buffer.getvalue()).decode()
-            
-            return f"data:image/jpeg;base64,{image_data}"
+            return self.encoder.encode(image_array, format, preset, quality, subsampling)
         except Exception as e:
             logger.error(f"Error encoding image: {e}")
             raise ValueError(f"Error encoding image: {e}")
     
+    @timed_stage('extract_selection_area')
     def extract_selection_area(self, image, selection):
         """Extract the selected area from the image."""
-        h, w = image.shape[:2]
+        x1, y1, x2, y2 = self.selection_bounds(image.shape, selection)
+        return image[y1:y2, x1:x2]
+    
+    def selection_bounds(self, image_shape, selection):
+        """Convert a relative selection to clamped pixel bounds (x1, y1, x2, y2)."""
+        h, w = image_shape[:2]
         
         # Convert relative coordinates to absolute
         x1 = int(selection['left'] * w)
@@ -79,52 +423,61 @@ class GradientRemovalProcessor:
         x2 = max(x1+1, min(x2, w))
         y2 = max(y1+1, min(y2, h))
         
-        return image[y1:y2, x1:x2]
+        return x1, y1, x2, y2
     
+    def analyze_gradient(self, selection_area, mode='advanced'):
+        """Analyze the selection with the algorithm for the given mode."""
+        return self.analyze_correction(selection_area, mode).correction_map
+    
+    def analyze_correction(self, selection_area, mode='advanced'):
+        """Like analyze_gradient, returning a CorrectionAnalysis with the fitted surface."""
+        if mode == 'uniform':
+            return CorrectionAnalysis(self.analyze_gradient_uniform(selection_area), 'uniform')
+        return self.analyze_correction_advanced(selection_area)
+    
+    @timed_stage('analyze_uniform')
     def analyze_gradient_uniform(self, selection_area):
-        """Analyze gradient for uniform/solid fabrics with MUCH more aggressive correction."""
-        logger.info("🔥🔥🔥 NEW AGGRESSIVE UNIFORM ALGORITHM CALLED! 🔥🔥🔥")
-        # Convert to LAB color space for better analysis
-        lab = cv2.cvtColor(selection_area, cv2.COLOR_RGB2LAB)
-        lightness = lab[:, :, 0].astype(np.float32)
-        
-        h, w = lightness.shape
+        """Analyze gradient for uniform/solid fabrics with MUCH more aggressive correction.
         
-        # Apply smoothing to reduce texture noise but preserve gradient
-        smoothed = cv2.GaussianBlur(lightness, (21, 21), 5.0)  # More aggressive smoothing
+        Only five region means are needed, so they come from a summed-area table of a
+        small lightness proxy, and the map (an affine surface, clipped) is returned at
+        that proxy's resolution for consumers to stretch like any correction map.
+        """
+        logger.info("🔥🔥🔥 NEW AGGRESSIVE UNIFORM ALGORITHM CALLED! 🔥🔥🔥")
+        # LAB lightness statistics; a 21x21 blur first would barely move means over quarters of
+        # the selection, so it is left out (tests/test_region_stats.py checks the difference)
+        stats = RegionStats.from_lightness(selection_area, UNIFORM_STATS_DIMENSION)
         
         # Calculate the gradient across the entire selection
         # Use the difference between edges to determine correction needed
         
         # Get edge values for strong gradient detection
-        left_edge = np.mean(smoothed[:, :w//4])     # Left 25%
-        right_edge = np.mean(smoothed[:, -w//4:])   # Right 25% 
-        top_edge = np.mean(smoothed[:h//4, :])      # Top 25%
-        bottom_edge = np.mean(smoothed[-h//4:, :])  # Bottom 25%
-        center = np.mean(smoothed[h//4:-h//4, w//4:-w//4])  # Center region
+        left_edge = stats.fraction_mean(0.0, 0.0, 0.25, 1.0)     # Left 25%
+        right_edge = stats.fraction_mean(0.75, 0.0, 1.0, 1.0)    # Right 25%
+        top_edge = stats.fraction_mean(0.0, 0.0, 1.0, 0.25)      # Top 25%
+        bottom_edge = stats.fraction_mean(0.0, 0.75, 1.0, 1.0)   # Bottom 25%
+        center = stats.fraction_mean(0.25, 0.25, 0.75, 0.75)     # Center region
         
         logger.info(f"Edge analysis - Left: {left_edge:.1f}, Right: {right_edge:.1f}, Top: {top_edge:.1f}, Bottom: {bottom_edge:.1f}, Center: {center:.1f}")
         
-        # Calculate correction needed - target all regions to center brightness
-        y_coords, x_coords = np.mgrid[0:h, 0:w]
-        
         # Create STRONG correction surface based on position
         # Normalize coordinates to -1 to +1
-        x_norm = (x_coords.astype(np.float32) - w/2) / (w/2)
-        y_norm = (y_coords.astype(np.float32) - h/2) / (h/2)
+        h, w = stats.shape
+        x_norm = ((np.arange(w, dtype=np.float32) - w/2) / (w/2))[np.newaxis, :]
+        y_norm = ((np.arange(h, dtype=np.float32) - h/2) / (h/2))[:, np.newaxis]
         
-        # Calculate gradients in both directions
-        horizontal_gradient = (right_edge - left_edge) / w if w > 0 else 0
-        vertical_gradient = (bottom_edge - top_edge) / h if h > 0 else 0
+        # Edge differences across the whole selection, whatever its size in pixels
+        horizontal_gradient = right_edge - left_edge
+        vertical_gradient = bottom_edge - top_edge
         
-        logger.info(f"Calculated gradients - Horizontal: {horizontal_gradient:.6f}, Vertical: {vertical_gradient:.6f}")
+        logger.info(f"Calculated gradients - Horizontal: {horizontal_gradient:.3f}, Vertical: {vertical_gradient:.3f} (edge to edge)")
         
         # Create correction surface - much more aggressive
         gradient_surface = (
             center + 
-            horizontal_gradient * x_norm * w * 2.0 +  # 2x amplification
-            vertical_gradient * y_norm * h * 2.0      # 2x amplification
-        )
+            horizontal_gradient * x_norm * 2.0 +  # 2x amplification
+            vertical_gradient * y_norm * 2.0      # 2x amplification
+        ).astype(np.float32)
         
         # Target brightness (use center or median as target)
         target_brightness = center
@@ -145,20 +498,26 @@ class GradientRemovalProcessor:
         correction = 1.0 + (correction_delta * 3.0)  # Triple the correction strength
         correction = np.clip(correction, 0.1, 10.0)
         
-        logger.info(f"AGGRESSIVE uniform correction range: {np.min(correction):.3f} - {np.max(correction):.3f}")
+        correction_min, correction_max = float(np.min(correction)), float(np.max(correction))
+        logger.info(f"AGGRESSIVE uniform correction range: {correction_min:.3f} - {correction_max:.3f}")
         
         # If correction is too weak, force it stronger
-        correction_range = np.max(correction) - np.min(correction)
+        correction_range = correction_max - correction_min
         if correction_range < 0.2:  # If variation is too small
             # Force more variation based on position
             position_correction = 1.0 + (x_norm * 0.3) + (y_norm * 0.3)
             correction = correction * position_correction
-            logger.info(f"Forced stronger correction range: {np.min(correction):.3f} - {np.max(correction):.3f}")
+            logger.debug(f"Forced stronger correction range: {np.min(correction):.3f} - {np.max(correction):.3f}")
         
         return correction
     
     def analyze_gradient_advanced(self, selection_area):
         """Analyze gradient for multi-color fabrics using improved pattern-aware algorithm."""
+        return self.analyze_correction_advanced(selection_area).correction_map
+    
+    @timed_stage('analyze_advanced')
+    def analyze_correction_advanced(self, selection_area):
+        """analyze_gradient_advanced as a CorrectionAnalysis."""
         # Convert to LAB color space for better color analysis
         lab = cv2.cvtColor(selection_area, cv2.COLOR_RGB2LAB)
         
@@ -169,11 +528,11 @@ class GradientRemovalProcessor:
         h, w = lightness.shape
         if h < 50 or w < 50:
             # Too small for reliable pattern detection, use conservative approach
-            return self._conservative_correction(lightness)
+            PATTERN_DECISIONS.inc(correction='conservative')
+            return CorrectionAnalysis(self._conservative_correction(lightness), 'conservative')
         
         # Apply different blur levels to separate pattern from lighting
-        light_blur = cv2.GaussianBlur(lightness, (31, 31), 8.0)  # Large blur for lighting
-        pattern_blur = cv2.GaussianBlur(lightness, (5, 5), 1.0)  # Small blur for patterns
+        light_blur = gaussian_blur(lightness, 31, 8.0, self.parallel, self.blur_mode)  # Large blur for lighting
         
         # Calculate the difference to isolate pattern information
         pattern_component = lightness - light_blur
@@ -184,43 +543,40 @@ class GradientRemovalProcessor:
         
         if pattern_strength > 0.3:  # Strong pattern detected (like plaid/checkered)
             logger.info(f"Strong pattern detected (strength: {pattern_strength:.3f}), using gentle correction")
+            PATTERN_DECISIONS.inc(correction='gentle')
             return self._gentle_lighting_correction(lighting_component, lightness)
         else:
             logger.info(f"Weak pattern detected (strength: {pattern_strength:.3f}), using standard correction")
+            PATTERN_DECISIONS.inc(correction='standard')
             return self._standard_lighting_correction(lighting_component, lightness)
     
+    @timed_stage('analyze_reference')
+    def analyze_reference(self, reference, max_dimension=256):
+        """Flat-field correction from a blank or reference scan of the rig, as a CorrectionAnalysis.
+        
+        The whole reference is lighting, so its heavily blurred lightness is used
+        directly instead of a fitted surface, which keeps vignetting and hot spots
+        that a low-degree polynomial would smooth over.
+        """
+        proxy, _ = self.downscale_image(reference, max_dimension)
+        lightness = cv2.cvtColor(proxy, cv2.COLOR_RGB2LAB)[:, :, 0].astype(np.float32)
+        lighting = gaussian_blur(lightness, 31, 8.0, mode=self.blur_mode)
+        mean_lighting = float(np.mean(lighting))
+        correction = np.divide(mean_lighting, lighting, out=np.ones_like(lighting), where=lighting > 0)
+        limits = (0.7, 1.4)
+        return CorrectionAnalysis(np.clip(correction, *limits), 'flat-field', target=mean_lighting, limits=limits)
+    
+    def capture_profile(self, name, image, selection=None):
+        """Calibration profile from a blank/reference scan, or from the analysis of a selection."""
+        if selection is None:
+            analysis, source = self.analyze_reference(image), 'reference'
+        else:
+            analysis, source = self.analyze_correction(self.extract_selection_area(image, selection)), 'analysis'
+        return CalibrationProfile.from_analysis(name, analysis, image.shape, source, selection, ALGORITHM_VERSION)
+    
     def _analyze_pattern_strength(self, pattern_component):
         """Analyze the strength of repeating patterns in the fabric."""
-        try:
-            # Convert to frequency domain
-            f_transform = np.fft.fft2(pattern_component)
-            f_shift = np.fft.fftshift(f_transform)
-            magnitude_spectrum = np.abs(f_shift)
-            
-            # Analyze frequency distribution
-            h, w = magnitude_spectrum.shape
-            center_y, center_x = h // 2, w // 2
-            
-            # Create masks for different frequency regions
-            y, x = np.ogrid[:h, :w]
-            center_mask = (x - center_x)**2 + (y - center_y)**2 <= (min(h, w) * 0.1)**2
-            mid_freq_mask = ((x - center_x)**2 + (y - center_y)**2 > (min(h, w) * 0.1)**2) & \
-                           ((x - center_x)**2 + (y - center_y)**2 <= (min(h, w) * 0.4)**2)
-            
-            # Calculate energy in different frequency bands
-            low_freq_energy = np.sum(magnitude_spectrum[center_mask])
-            mid_freq_energy = np.sum(magnitude_spectrum[mid_freq_mask])
-            total_energy = np.sum(magnitude_spectrum)
-            
-            # Pattern strength is ratio of mid-frequency to total energy
-            if total_energy > 0:
-                pattern_strength = mid_freq_energy / total_energy
-            else:
-                pattern_strength = 0
-                
-            return min(pattern_strength * 10, 1.0)  # Scale and cap at 1.0
-        except:
-            return 0.2  # Default moderate pattern strength
+        return self.pattern_analyzer.strength(pattern_component)
     
     def _conservative_correction(self, lightness):
         """Very gentle correction for small areas."""
@@ -247,29 +603,16 @@ class GradientRemovalProcessor:
         return np.clip(correction, 0.9, 1.1)
     
     def _gentle_lighting_correction(self, lighting_component, original_lightness):
-        """Gentle correction that preserves patterns."""
-        h, w = lighting_component.shape
+        """Gentle correction that preserves patterns, as a CorrectionAnalysis."""
         mean_lighting = np.mean(lighting_component)
         
-        # Use very gentle polynomial fitting
-        y_coords, x_coords = np.mgrid[0:h, 0:w]
-        x_flat = x_coords.flatten()
-        y_flat = y_coords.flatten()
-        z_flat = lighting_component.flatten()
-        
-        # Fit only linear terms (no quadratic) for gentler correction
-        A = np.column_stack([x_flat, y_flat, np.ones(len(x_flat))])
-        
         try:
-            coeffs = np.linalg.lstsq(A, z_flat, rcond=None)[0]
-            
-            # Generate gentle correction surface
-            correction_surface = (coeffs[0] * x_coords + 
-                                coeffs[1] * y_coords + 
-                                coeffs[2])
+            # Fit only linear terms (no quadratic) for gentler correction
+            surface = PolynomialSurface.fit(lighting_component, degree=self.gentle_surface_degree)
+            logger.info(f"Gentle lighting surface - degree {surface.degree}, RMS residual: {surface.rms_residual:.3f}")
             
             # Normalize
-            correction_surface = correction_surface - np.mean(correction_surface) + mean_lighting
+            correction_surface = surface.evaluate() - surface.mean() + mean_lighting
             
             # Create very gentle correction factor
             correction = np.divide(mean_lighting, correction_surface, 
@@ -277,46 +620,25 @@ class GradientRemovalProcessor:
                                  where=correction_surface!=0)
             
             # Much tighter limits for pattern preservation
-            correction = np.clip(correction, 0.85, 1.15)
+            limits = (0.85, 1.15)
+            correction = np.clip(correction, *limits)
             
-            return correction
-        except:
-            return np.ones_like(lighting_component)
+            return CorrectionAnalysis(correction, 'gentle', surface, float(mean_lighting), limits)
+        except np.linalg.LinAlgError:
+            return CorrectionAnalysis(np.ones_like(lighting_component), 'gentle')
     
     def _standard_lighting_correction(self, lighting_component, original_lightness):
-        """Standard correction for fabrics without strong patterns."""
-        h, w = lighting_component.shape
+        """Standard correction for fabrics without strong patterns, as a CorrectionAnalysis."""
         mean_lighting = np.mean(lighting_component)
         
-        # Standard polynomial fitting
-        y_coords, x_coords = np.mgrid[0:h, 0:w]
-        x_flat = x_coords.flatten()
-        y_flat = y_coords.flatten()
-        z_flat = lighting_component.flatten()
-        
-        # Fit 2D polynomial (degree 2) but with regularization
-        A = np.column_stack([
-            x_flat**2, y_flat**2, x_flat*y_flat,
-            x_flat, y_flat, np.ones(len(x_flat))
-        ])
-        
         try:
-            # Add regularization to prevent overfitting
-            reg_param = 1e-6
-            ATA = A.T @ A + reg_param * np.eye(A.shape[1])
-            ATb = A.T @ z_flat
-            coeffs = np.linalg.solve(ATA, ATb)
-            
-            # Generate correction surface
-            correction_surface = (coeffs[0] * x_coords**2 + 
-                                coeffs[1] * y_coords**2 + 
-                                coeffs[2] * x_coords * y_coords +
-                                coeffs[3] * x_coords + 
-                                coeffs[4] * y_coords + 
-                                coeffs[5])
+            # Fit 2D polynomial (degree 2) with slight regularization to prevent overfitting
+            surface = PolynomialSurface.fit(lighting_component, degree=self.standard_surface_degree,
+                                            regularization=1e-6)
+            logger.info(f"Standard lighting surface - degree {surface.degree}, RMS residual: {surface.rms_residual:.3f}")
             
             # Normalize
-            correction_surface = correction_surface - np.mean(correction_surface) + mean_lighting
+            correction_surface = surface.evaluate() - surface.mean() + mean_lighting
             
             # Create correction factor
             correction = np.divide(mean_lighting, correction_surface, 
@@ -324,154 +646,366 @@ class GradientRemovalProcessor:
                                  where=correction_surface!=0)
             
             # Moderate limits to avoid artifacts
-            correction = np.clip(correction, 0.7, 1.4)
+            limits = (0.7, 1.4)
+            correction = np.clip(correction, *limits)
             
-            return correction
-        except:
-            return np.ones_like(lighting_component)
+            return CorrectionAnalysis(correction, 'standard', surface, float(mean_lighting), limits)
+        except np.linalg.LinAlgError:
+            return CorrectionAnalysis(np.ones_like(lighting_component), 'standard')
     
+    @timed_stage('apply')
     def apply_gradient_correction(self, image, selection, correction_map, mode='advanced',
                                 gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9):
         """Apply aggressive gradient correction while preserving fabric texture and thread details."""
-        h, w = image.shape[:2]
-        result = image.copy().astype(np.float32)
-        
         logger.info(f"Applying aggressive texture-preserving correction - Gradient: {gradient_strength}, Brightness: {brightness_preservation}, Color: {color_preservation}")
         
         if gradient_strength == 0:
             logger.info("Gradient strength is 0, returning original image")
             return image
         
-        # Resize correction map to match full image with smooth interpolation
-        correction_full = cv2.resize(correction_map, (w, h), interpolation=cv2.INTER_CUBIC)
-        
-        # Apply smoothing but not too heavy - we want effective gradient removal
-        correction_full = cv2.GaussianBlur(correction_full, (25, 25), 5.0)
-        
-        # Make correction more aggressive by amplifying the correction values
-        correction_delta = correction_full - 1.0
-        # Amplify the correction delta for more aggressive gradient removal
-        amplified_delta = correction_delta * 2.0  # Double the correction strength
-        effective_correction = 1.0 + (gradient_strength * amplified_delta)
+        correction_full = None
+        if mode != 'uniform':
+            correction_full = self.prepare_correction_field(correction_map, image.shape)
+        layers = self.decompose_image(image)
         
-        logger.info(f"Aggressive correction range: {np.min(effective_correction):.3f} - {np.max(effective_correction):.3f}")
-        
-        # ENHANCED TEXTURE-PRESERVING APPROACH:
-        # Separate texture at multiple scales for better preservation
+        result_corrected = self.blend_correction(
+            layers, correction_full, mode,
+            gradient_strength, brightness_preservation, color_preservation
+        )
+        if self.diagnostics.should_measure():
+            self.diagnostics.record(self.measure_quality(image, result_corrected, layers.levels))
         
-        # Extract texture details at multiple scales
-        fine_texture = result - cv2.GaussianBlur(result, (5, 5), 1.0)    # Fine threads
-        medium_texture = result - cv2.GaussianBlur(result, (15, 15), 3.0) # Medium weave
-        coarse_texture = result - cv2.GaussianBlur(result, (35, 35), 7.0) # Coarse structure
+        return result_corrected
+    
+    def correction_parameters(self, analysis, image_shape, mode='advanced', gradient_strength=0.5,
+                              brightness_preservation=0.8, color_preservation=0.9,
+                              field_max_dimension=64, target_lighting=None):
+        """Everything a client needs to apply a correction itself, as a JSON-ready dict.
+        
+        The correction map is returned as a float32 field at most field_max_dimension
+        on its longest side (with the image's aspect ratio), plus the fitted surface
+        when there is one. Blur sizes are in pixels of image_shape. target_lighting
+        is the per-channel median of the base lighting, used in uniform mode.
+        """
+        h, w = image_shape[:2]
+        correction = {'kind': analysis.kind}
+        if mode != 'uniform':
+            scale = min(1.0, field_max_dimension / max(h, w))
+            field_w, field_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+            field = cv2.resize(analysis.correction_map.astype(np.float32), (field_w, field_h),
+                               interpolation=cv2.INTER_AREA)
+            correction['field'] = {
+                'width': field_w,
+                'height': field_h,
+                'dtype': 'float32',
+                'byteOrder': 'little',
+                'data': base64.b64encode(field.astype('<f4').tobytes()).decode(),
+            }
+            correction['smoothing'] = {'kernelSize': 25, 'sigma': 5.0}
+            surface = analysis.surface_dict()
+            if surface is not None:
+                correction['surface'] = surface
+        
+        fine, medium, coarse = TEXTURE_WEIGHTS['uniform' if mode == 'uniform' else 'advanced']
+        blend = {
+            'gradientStrength': gradient_strength,
+            # Advanced: lighting * (1 + correctionGain * (factor - 1))
+            'correctionGain': 2.0 * gradient_strength,
+            'blurLevels': {
+                'fine': {'kernelSize': 5, 'sigma': 1.0},
+                'medium': {'kernelSize': 15, 'sigma': 3.0},
+                'lighting': {'kernelSize': 35, 'sigma': 7.0},
+            },
+            'textureWeights': {'fine': fine, 'medium': medium, 'coarse': coarse},
+            'brightnessPreservation': brightness_preservation,
+            'brightnessFactorLimits': [0.3, 3.0],
+            'colorPreservation': color_preservation,
+            'colorBlend': (color_preservation - 0.5) * 2.0 if color_preservation > 0.5 else 0.0,
+        }
+        if target_lighting is not None:
+            blend['targetLighting'] = [float(v) for v in target_lighting]
+        return {'correction': correction, 'blend': blend}
+    
+    @timed_stage('correction_field')
+    def prepare_correction_field(self, correction_map, image_shape, scale=1.0):
+        """Resize an analysis correction map to the full image and smooth it.
         
-        # Get the base lighting (heavily smoothed)
-        base_lighting = cv2.GaussianBlur(result, (35, 35), 7.0)
+        scale is the size of image_shape relative to the original scan, for previews.
+        """
+        h, w = image_shape[:2]
         
-        # Apply AGGRESSIVE correction to base lighting only
-        corrected_lighting = np.zeros_like(base_lighting)
-        for channel in range(3):  # RGB channels
-            corrected_lighting[:, :, channel] = base_lighting[:, :, channel] * effective_correction
+        # Resize correction map to match full image with smooth interpolation
+        correction_full = cv2.resize(correction_map, (w, h), interpolation=cv2.INTER_CUBIC)
         
-        # Recombine with preserved texture at all scales
-        # Start with corrected base lighting
-        result_corrected = corrected_lighting.copy()
+        # Apply smoothing but not too heavy - we want effective gradient removal
+        ksize, sigma = scaled_kernel(25, 5.0, scale)
+        return gaussian_blur(correction_full, ksize, sigma, self.parallel, self.blur_mode)
+    
+    @timed_stage('decompose')
+    def decompose_image(self, image, scale=1.0):
+        """Split the image into lighting and texture layers that don't depend on the strength settings."""
+        return ImageLayers(image, scale, self.parallel, self.cascade_blurs, self.blur_mode)
+    
+    def downscale_image(self, image, max_dimension):
+        """Downscale image so its longest side is at most max_dimension.
         
-        # Add back texture details with full strength (100% preservation)
-        result_corrected += fine_texture * 0.9     # 90% fine texture preservation
-        result_corrected += (medium_texture - fine_texture) * 0.8  # 80% medium texture
-        result_corrected += (coarse_texture - medium_texture) * 0.7  # 70% coarse texture
+        Returns (proxy, scale); images that already fit are returned unchanged with scale 1.0.
+        An EncodedImage is decoded at reduced resolution first where the codec allows it.
+        """
+        h, w = image.shape[:2]
+        scale = max_dimension / max(h, w)
+        if isinstance(image, EncodedImage):
+            image = image.decode(max_dimension)
+        if scale >= 1.0:
+            return image, 1.0
+        
+        proxy_w = max(1, int(round(w * scale)))
+        proxy_h = max(1, int(round(h * scale)))
+        proxy = cv2.resize(image, (proxy_w, proxy_h), interpolation=cv2.INTER_AREA)
+        return proxy, proxy_w / w
+    
+    @timed_stage('blend')
+    def blend_correction(self, layers, correction_full, mode='advanced',
+                         gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9,
+                         working_set=None):
+        """Recombine corrected lighting with preserved texture and apply the strength settings.
+        
+        This is the only stage that depends on the strength sliders, so it is all that
+        needs to rerun when just those change. correction_full is unused in uniform mode.
+        The result and scratch buffers are added to working_set (a buffers.WorkingSet),
+        if given, on top of whatever the caller already counted there.
+        """
+        if gradient_strength == 0:
+            return layers.image
         
-        # Alternative approach: Direct lighting gradient flattening
         if mode == 'uniform':
             # For uniform fabrics, create perfectly flat lighting
             logger.info("Uniform mode: Creating perfectly flat lighting")
-            
-            # Calculate target uniform brightness (median is more robust than mean)
-            target_brightness = np.median(base_lighting, axis=(0, 1))
-            
-            # Create perfectly uniform base lighting
-            uniform_lighting = np.full_like(base_lighting, target_brightness)
-            
-            # Blend based on gradient strength
-            final_lighting = gradient_strength * uniform_lighting + (1 - gradient_strength) * base_lighting
-            
-            # Combine with original texture
-            result_corrected = final_lighting + fine_texture + (medium_texture - fine_texture) * 0.8
+        elif logger.isEnabledFor(logging.DEBUG):
+            # Two full-resolution reductions, so only when debugging
+            logger.debug(f"Aggressive correction range: {1.0 + gradient_strength * 2.0 * (np.min(correction_full) - 1.0):.3f} - {1.0 + gradient_strength * 2.0 * (np.max(correction_full) - 1.0):.3f}")
+        
+        texture = layers.texture(mode)
+        target_lighting = layers.median_lighting if mode == 'uniform' else None
+        h, w = layers.original.shape[:2]
+        chunk_rows = self.blend_chunk_rows
+        row_sums = np.empty(h, dtype=np.float64)
+        result = np.empty(layers.original.shape, dtype=np.uint8)
+        working_set = working_set if working_set is not None else WorkingSet()
+        working_set.add(result.nbytes)
+        
+        def compose_rows(r0, r1, composed, effective):
+            return self.compose_correction(
+                layers.base_lighting[r0:r1], texture[r0:r1],
+                None if correction_full is None else correction_full[r0:r1],
+                mode, gradient_strength, target_lighting,
+                out=composed[:r1 - r0], scratch=effective[:r1 - r0]
+            )
+        
+        # The composed image is never held in full: pass one only sums it (not needed in
+        # uniform mode), pass two composes each block again and finishes it straight into
+        # the uint8 result
+        def sum_band(y0, y1, *_):
+            with self.scratch_pool.borrow((chunk_rows, w, 3), np.float32, working_set) as composed, \
+                    self.scratch_pool.borrow((chunk_rows, w), np.float32, working_set) as effective:
+                for r0 in range(y0, y1, chunk_rows):
+                    r1 = min(r0 + chunk_rows, y1)
+                    # Per-row sums keep the mean independent of how rows are banded
+                    row_sums[r0:r1] = np.sum(compose_rows(r0, r1, composed, effective), axis=(1, 2), dtype=np.float64)
+        
+        if mode == 'uniform':
+            # The uniform composition is affine in the layers, so its mean follows from
+            # theirs (cached with the layers) without composing the image an extra time
+            corrected_brightness = (
+                (1 - gradient_strength) * layers.mean('base')
+                + gradient_strength * float(np.mean(target_lighting)) + layers.mean(mode)
+            )
+        else:
+            map_bands(self.parallel, sum_band, h)
+            corrected_brightness = np.sum(row_sums) / layers.original.size
         
         # Brightness preservation - maintain overall brightness
-        if brightness_preservation > 0:
-            original_brightness = np.mean(result)
-            corrected_brightness = np.mean(result_corrected)
+        brightness_blend = self.brightness_blend_factor(
+            layers.mean_brightness, corrected_brightness, brightness_preservation
+        )
+        
+        def finish_band(y0, y1, *_):
+            with self.scratch_pool.borrow((chunk_rows, w, 3), np.float32, working_set) as composed, \
+                    self.scratch_pool.borrow((chunk_rows, w, 3), np.float32, working_set) as blended, \
+                    self.scratch_pool.borrow((chunk_rows, w), np.float32, working_set) as effective:
+                for r0 in range(y0, y1, chunk_rows):
+                    r1 = min(r0 + chunk_rows, y1)
+                    self.finish_correction(
+                        compose_rows(r0, r1, composed, effective), layers.original[r0:r1],
+                        brightness_blend, color_preservation,
+                        out=result[r0:r1], scratch=blended[:r1 - r0]
+                    )
+        
+        map_bands(self.parallel, finish_band, h)
+        logger.info(f"Working set peak: {working_set.peak / 1024**2:.1f} MiB")
+        return result
+    
+    def compose_correction(self, base_lighting, texture, correction_full, mode='advanced',
+                           gradient_strength=0.5, target_lighting=None, out=None, scratch=None):
+        """Corrected base lighting plus preserved texture, before the global brightness/color blends.
+        
+        In uniform mode the lighting is blended towards target_lighting (the per-channel
+        median of the base lighting); tiled execution passes 0 and adds it afterwards.
+        out (float32, shaped like base_lighting) and scratch (shaped like correction_full)
+        are optional preallocated buffers; without them new arrays are allocated.
+        """
+        if out is None:
+            out = np.empty(base_lighting.shape, dtype=np.float32)
+        if mode == 'uniform':
+            # Blend towards the robust (median) target brightness based on gradient strength
+            np.multiply(base_lighting, 1 - gradient_strength, out=out)
+            out += gradient_strength * np.asarray(target_lighting, dtype=np.float32)
+        else:
+            # Make correction more aggressive by amplifying the correction values
+            effective_correction = np.subtract(correction_full, 1.0, out=scratch)
+            # Amplify the correction delta for more aggressive gradient removal
+            effective_correction *= 2.0  # Double the correction strength
+            effective_correction *= gradient_strength
+            effective_correction += 1.0
             
-            if corrected_brightness > 0:
-                brightness_factor = original_brightness / corrected_brightness
-                # Less aggressive clamping to allow more correction
-                brightness_factor = np.clip(brightness_factor, 0.3, 3.0)
-                
-                # Apply brightness correction
-                brightness_blend = brightness_preservation * brightness_factor + (1 - brightness_preservation) * 1.0
-                result_corrected *= brightness_blend
-                logger.info(f"Brightness factor: {brightness_factor:.3f}, blend: {brightness_blend:.3f}")
+            # Apply AGGRESSIVE correction to base lighting only
+            np.multiply(base_lighting, effective_correction[:, :, np.newaxis], out=out)
+        
+        # Add back texture details at all scales
+        out += texture
+        return out
+    
+    def brightness_blend_factor(self, original_brightness, corrected_brightness, brightness_preservation):
+        """Global multiplier that restores the original mean brightness by brightness_preservation."""
+        if brightness_preservation <= 0 or corrected_brightness <= 0:
+            return 1.0
+        
+        brightness_factor = original_brightness / corrected_brightness
+        # Less aggressive clamping to allow more correction
+        brightness_factor = np.clip(brightness_factor, 0.3, 3.0)
+        
+        brightness_blend = brightness_preservation * brightness_factor + (1 - brightness_preservation) * 1.0
+        logger.info(f"Brightness factor: {brightness_factor:.3f}, blend: {brightness_blend:.3f}")
+        return brightness_blend
+    
+    def finish_correction(self, result_corrected, original, brightness_blend, color_preservation,
+                          out=None, scratch=None):
+        """Apply brightness and color preservation to a composed result and convert to uint8.
+        
+        Works in place on result_corrected. out (uint8) and scratch (float32, shaped like
+        the result) are optional preallocated buffers.
+        """
+        # Apply brightness correction
+        if brightness_blend != 1.0:
+            result_corrected *= brightness_blend
         
         # Color preservation - only if user wants it (lower values = more correction)
         if color_preservation > 0.5:  # Only blend if preservation > 50%
             blend_factor = (color_preservation - 0.5) * 2.0  # Map 0.5-1.0 to 0.0-1.0
-            result_corrected = blend_factor * result + (1 - blend_factor) * result_corrected
-            logger.info(f"Color preservation blend: {blend_factor:.3f}")
+            blended_original = np.multiply(original, blend_factor, out=scratch)
+            result_corrected *= 1 - blend_factor
+            result_corrected += blended_original
         
         # Ensure values are in valid range
-        result_corrected = np.clip(result_corrected, 0, 255)
+        np.clip(result_corrected, 0, 255, out=result_corrected)
         
-        # Texture quality check
-        original_texture_std = np.std(result - cv2.GaussianBlur(result, (15, 15), 3.0))
-        final_texture_std = np.std(result_corrected - cv2.GaussianBlur(result_corrected, (15, 15), 3.0))
+        if out is None:
+            return result_corrected.astype(np.uint8)
+        np.copyto(out, result_corrected, casting='unsafe')
+        return out
+    
+    def measure_quality(self, original, corrected, original_levels=None):
+        """Texture preservation and lighting uniformity of a corrected image, as a dict.
+        
+        Both images are measured on proxies at most diagnostics.max_dimension on their
+        longest side, or at full resolution if that is None. corrected may be a preview
+        smaller than original, which must be the full-resolution image. original_levels,
+        a ScaleSpace of original, saves recomputing its blurs at full resolution.
+        """
+        full_width = original.shape[1]
+        if original.shape[:2] != corrected.shape[:2]:
+            # Resample the original the way the preview was, so both carry the same fine detail
+            original = cv2.resize(original, corrected.shape[1::-1], interpolation=cv2.INTER_AREA)
+        max_dimension = self.diagnostics.max_dimension or max(corrected.shape[:2])
+        corrected_proxy, _ = self.downscale_image(corrected, max_dimension)
+        original, _ = self.downscale_image(original, max_dimension)
+        h, w = corrected_proxy.shape[:2]
+        if w != full_width:
+            original_levels = None
+        # Blur kernels cover the same scene area as on the full-resolution original
+        scale = w / full_width
+        original = original.astype(np.float32, copy=False)
+        corrected_proxy = corrected_proxy.astype(np.float32)
+        if original_levels is None:
+            original_levels = ScaleSpace(original, scale, self.parallel, self.cascade_blurs, self.blur_mode)
+        corrected_levels = ScaleSpace(corrected_proxy, scale, self.parallel, self.cascade_blurs, self.blur_mode)
         
+        # Texture quality check
+        original_texture_std = np.std(original - original_levels.level(15, 3.0))
+        final_texture_std = np.std(corrected_proxy - corrected_levels.level(15, 3.0))
         texture_ratio = final_texture_std / original_texture_std if original_texture_std > 0 else 1.0
-        logger.info(f"Texture preservation: {texture_ratio:.3f} (target: >0.8)")
         
         # Calculate lighting uniformity improvement
-        original_lighting_std = np.std(cv2.GaussianBlur(result, (25, 25), 5.0))
-        final_lighting_std = np.std(cv2.GaussianBlur(result_corrected, (25, 25), 5.0))
+        original_lighting_std = np.std(original_levels.level(25, 5.0))
+        final_lighting_std = np.std(corrected_levels.level(25, 5.0))
         uniformity_improvement = (original_lighting_std - final_lighting_std) / original_lighting_std if original_lighting_std > 0 else 0
         
-        logger.info(f"Lighting uniformity improvement: {uniformity_improvement:.3f} (higher is better)")
-        logger.info(f"Final brightness: Original={np.mean(result):.1f}, Final={np.mean(result_corrected):.1f}")
-        
-        return result_corrected.astype(np.uint8)
+        return {
+            'textureRetention': float(texture_ratio),
+            'uniformityImprovement': float(uniformity_improvement),
+            'originalBrightness': float(np.mean(original)),
+            'finalBrightness': float(np.mean(corrected_proxy)),
+            'measuredSize': {'width': w, 'height': h},
+        }
     
     def process_gradient_removal(self, image_data_url, selection, mode='advanced', 
                                 gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9):
         """Main processing function for gradient removal."""
         try:
-            logger.info(f"Processing gradient removal with mode: {mode}")
-            logger.info(f"Strength parameters - Gradient: {gradient_strength}, Brightness: {brightness_preservation}, Color: {color_preservation}")
-            
             # Decode image
             image = self.decode_image(image_data_url)
-            logger.info(f"Image shape: {image.shape}")
             
-            # Extract selection area
-            selection_area = self.extract_selection_area(image, selection)
-            logger.info(f"Selection area shape: {selection_area.shape}")
-            
-            # Analyze gradient based on mode
-            if mode == 'uniform':
-                correction_map = self.analyze_gradient_uniform(selection_area)
-            else:
-                correction_map = self.analyze_gradient_advanced(selection_area)
-            
-            # Apply correction to full image with strength parameters
-            corrected_image = self.apply_gradient_correction(
-                image, selection, correction_map, mode, 
+            corrected_image = self.process_image(
+                image, selection, mode,
                 gradient_strength, brightness_preservation, color_preservation
             )
             
             # Encode result
-            result_data_url = self.encode_image(corrected_image)
-            
-            logger.info("Gradient removal processing completed successfully")
-            return result_data_url
+            return self.encode_image(corrected_image)
             
         except Exception as e:
             logger.error(f"Error in gradient removal processing: {e}")
-            raise
\ No newline at end of file
+            raise
+    
+    def process_image(self, image, selection, mode='advanced',
+                      gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9,
+                      profile=None):
+        """Run gradient removal on an already decoded RGB array and return the corrected array.
+        
+        With a CalibrationProfile the stored correction replaces the analysis, and
+        selection is ignored.
+        """
+        logger.info(f"Processing gradient removal with mode: {mode}")
+        logger.info(f"Strength parameters - Gradient: {gradient_strength}, Brightness: {brightness_preservation}, Color: {color_preservation}")
+        logger.info(f"Image shape: {image.shape}")
+        
+        if profile is not None:
+            logger.info(f"Applying calibration profile {profile.name} v{profile.version}")
+            profile.check_image(image.shape)
+            correction_map = profile.correction_map
+        else:
+            # Extract selection area
+            selection_area = self.extract_selection_area(image, selection)
+            logger.info(f"Selection area shape: {selection_area.shape}")
+            
+            # Analyze gradient based on mode
+            correction_map = self.analyze_gradient(selection_area, mode)
+        
+        # Apply correction to full image with strength parameters
+        corrected_image = self.apply_gradient_correction(
+            image, selection, correction_map, mode, 
+            gradient_strength, brightness_preservation, color_preservation
+        )
+        
+        logger.info("Gradient removal processing completed successfully")
+        return corrected_image
@@ -0,0 +1,33 @@
+"""
+Gunicorn settings for production serving:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The master imports app.py once (preload_app), so the processor, caches and
+libraries are loaded before forking and shared copy-on-write. Each worker
+then runs app.warm_up() before it accepts requests.
+
+Run one worker per pod (WEB_CONCURRENCY=1, the default) and scale by adding
+pods behind a load balancer with sticky sessions. Uploaded images, jobs,
+batches, sessions and metrics live in the worker's memory, and gunicorn
+cannot pin a client to one of several workers: with more than one, job and
+batch lookups return 404 on the other workers, imageId lookups miss, and
+/metrics reports only the worker that served the scrape.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Heavy stages release the GIL, so threads serve concurrent requests within a worker
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+# Final renders of large scans can take minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 30
+
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up()
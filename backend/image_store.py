@@ -0,0 +1,186 @@
+"""
+Server-side image sessions for gradient removal.
+
+Scans are uploaded once and kept decoded in memory under a content-hash ID,
+so interactive requests only need to name the ID plus selection/settings
+instead of re-sending and re-decoding the whole image on every slider move.
+
+JPEGs can be registered lazily: they are stored encoded and decoded on
+demand, so previews that only need a reduced decode never pay for the full
+one. decoded() swaps in the full array once a request needs it.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import logging
+from decoding import EncodedImage
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownImageError(KeyError):
+    """No image is registered under the ID (never uploaded, or evicted)."""
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by total size in bytes, with TTL eviction."""
+
+    def __init__(self, max_bytes, ttl_seconds=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (value, nbytes, last_access)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key and mark it as recently used."""
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, nbytes, _ = entry
+            self._entries[key] = (value, nbytes, time.monotonic())
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes):
+        """Insert value, evicting least recently used entries to stay within budget."""
+        if nbytes > self.max_bytes:
+            logger.warning(f"Cache entry of {nbytes} bytes exceeds budget of {self.max_bytes} bytes, not caching")
+            return False
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, nbytes, time.monotonic())
+            self._total_bytes += nbytes
+            self._evict_expired()
+            while self._total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                logger.info(f"Evicting cache entry {oldest_key} (LRU)")
+                self._remove(oldest_key)
+            return True
+
+    def pop(self, key):
+        """Remove key from the cache. Returns True if it was present."""
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._evict_expired()
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return current size and hit/miss counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._total_bytes -= entry[1]
+        return True
+
+    def _evict_expired(self):
+        if self.ttl_seconds is None:
+            return
+        cutoff = time.monotonic() - self.ttl_seconds
+        expired = [key for key, (_, _, last_access) in self._entries.items() if last_access < cutoff]
+        for key in expired:
+            logger.info(f"Evicting cache entry {key} (expired)")
+            self._remove(key)
+
+
+class ImageStore:
+    """Decoded RGB images keyed by the SHA-256 of their encoded bytes."""
+
+    def __init__(self, processor, max_bytes=2 * 1024**3, ttl_seconds=30 * 60):
+        self.processor = processor
+        self._cache = LRUCache(max_bytes, ttl_seconds)
+
+    @staticmethod
+    def content_id(image_bytes):
+        """Content-hash ID for encoded image bytes (or any buffer, such as an mmap)."""
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def register_bytes(self, image_bytes, lazy=False):
+        """Register encoded image bytes, decoding only if not already stored.
+
+        Returns (image_id, image), where image is the decoded array or, for a
+        lazy registration of a JPEG, an EncodedImage.
+        """
+        image_id = self.content_id(image_bytes)
+        image = self._cache.get(image_id)
+        if image is not None:
+            logger.info(f"Image {image_id[:12]} already registered")
+            return image_id, image
+
+        if lazy:
+            encoded = self.processor.open_image(image_bytes)
+            if encoded.reducible:
+                self._cache.put(image_id, encoded, encoded.nbytes)
+                logger.info(f"Registered image {image_id[:12]} with shape {encoded.shape}, decoding on demand")
+                return image_id, encoded
+
+        image = self.processor.decode_image_bytes(image_bytes)
+        # Stored arrays are shared between requests; make accidental in-place edits fail loudly
+        image.flags.writeable = False
+        self._cache.put(image_id, image, image.nbytes)
+        logger.info(f"Registered image {image_id[:12]} with shape {image.shape}")
+        return image_id, image
+
+    def register_data_url(self, image_data_url, lazy=False):
+        """Register a base64 image data URL. Returns (image_id, image)."""
+        return self.register_bytes(self.processor.data_url_to_bytes(image_data_url), lazy)
+
+    def decoded(self, image_id, image):
+        """image as a full-resolution array; a lazily registered image is decoded and stored decoded."""
+        if not isinstance(image, EncodedImage):
+            return image
+        array = self.processor.decode_image_bytes(image.data)
+        array.flags.writeable = False
+        self._cache.put(image_id, array, array.nbytes)
+        logger.info(f"Decoded image {image_id[:12]} in full")
+        return array
+
+    def get(self, image_id):
+        """Return the decoded image for image_id, raising UnknownImageError if unknown or evicted."""
+        image = self._cache.get(image_id)
+        if image is None:
+            raise UnknownImageError(image_id)
+        return image
+
+    def remove(self, image_id):
+        return self._cache.pop(image_id)
+
+    def __contains__(self, image_id):
+        return image_id in self._cache
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,217 @@
+"""
+Asynchronous job queue for gradient removal requests.
+
+Jobs run on a bounded pool of worker threads. Final renders are prioritised
+over previews, and a new job from a session supersedes that session's older
+jobs: queued ones are dropped and running ones are cancelled at the next
+stage boundary, so dragging a slider never leaves a backlog of stale previews.
+When too many jobs are waiting, submission fails so the API can answer 429.
+"""
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_FINAL = 0
+PRIORITY_PREVIEW = 1
+
+JOB_STATUSES = ['queued', 'running', 'succeeded', 'failed', 'cancelled']
+
+
+class JobQueueFullError(Exception):
+    """Raised when the queue has no room for another job."""
+
+
+class JobCancelledError(Exception):
+    """Raised inside a job that was cancelled or superseded."""
+
+
+class Job:
+    """A unit of work tracked by JobManager."""
+
+    def __init__(self, func, session_id=None, priority=PRIORITY_PREVIEW):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.session_id = session_id
+        self.priority = priority
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._done_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def done(self):
+        return self._done_event.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelledError if the job was cancelled; called between pipeline stages."""
+        if self._cancel_event.is_set():
+            raise JobCancelledError(self.id)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or timeout expires. Returns True if finished."""
+        return self._done_event.wait(timeout)
+
+    def to_dict(self):
+        info = {
+            'jobId': self.id,
+            'status': self.status,
+            'priority': 'final' if self.priority == PRIORITY_FINAL else 'preview',
+            'createdAt': self.created_at,
+        }
+        if self.started_at is not None:
+            info['startedAt'] = self.started_at
+        if self.finished_at is not None:
+            info['finishedAt'] = self.finished_at
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+
+class JobManager:
+    """Bounded worker pool with priorities, latest-wins superseding and backpressure."""
+
+    def __init__(self, workers=2, max_pending=16, result_ttl_seconds=5 * 60):
+        self.max_pending = max_pending
+        self.result_ttl_seconds = result_ttl_seconds
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.workers = workers
+        # Started on first submit, so a pre-forking server can create the manager before forking
+        self._workers = []
+
+    def submit(self, func, session_id=None, priority=PRIORITY_PREVIEW):
+        """Queue func(job) and return the Job.
+
+        Jobs of the same session that the new one supersedes (same or lower
+        priority, i.e. a preview never cancels a final render) are cancelled once
+        it is accepted. Raises JobQueueFullError, superseding nothing, if max_pending
+        jobs would still be waiting after the superseded queued ones are dropped.
+        """
+        job = Job(func, session_id, priority)
+        with self._lock:
+            self._expire_finished()
+            superseded = [] if session_id is None else [
+                other for other in self._jobs.values()
+                if other.session_id == session_id and other.priority >= priority and not other.done
+            ]
+            replaced = sum(1 for other in superseded if other.status == 'queued')
+            if self._pending - replaced >= self.max_pending:
+                raise JobQueueFullError(f'{self._pending} jobs already queued')
+            for other in superseded:
+                self._cancel(other, 'superseded')
+            self._jobs[job.id] = job
+            self._pending += 1
+            if not self._workers:
+                self._start_workers()
+        self._queue.put((priority, next(self._sequence), job))
+        logger.info(f"Queued job {job.id} (session: {session_id}, priority: {priority})")
+        return job
+
+    def get(self, job_id):
+        """Return the job, raising KeyError if unknown or expired."""
+        with self._lock:
+            return self._jobs[job_id]
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns the job."""
+        with self._lock:
+            job = self._jobs[job_id]
+            if not job.done:
+                self._cancel(job, 'cancelled')
+            return job
+
+    def shutdown(self, timeout=None):
+        """Cancel outstanding jobs and stop the workers once their current job ends."""
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.done:
+                    self._cancel(job, 'cancelled (shutdown)')
+        for _ in self._workers:
+            # Sorts ahead of every real job
+            self._queue.put((-1, next(self._sequence), None))
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            counts = {status: 0 for status in JOB_STATUSES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {'workers': self.workers, 'maxPending': self.max_pending, 'jobs': counts}
+
+    def _start_workers(self):
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f'gradient-job-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _cancel(self, job, reason):
+        # Queued jobs are dropped when a worker dequeues them; running ones stop at the next check
+        job._cancel_event.set()
+        if job.status == 'queued':
+            self._finish(job, 'cancelled')
+            self._pending -= 1
+        logger.info(f"Job {job.id} {reason}")
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job.func = None
+        job._done_event.set()
+
+    def _expire_finished(self):
+        cutoff = time.time() - self.result_ttl_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _worker_loop(self):
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.done:
+                    continue
+                job.status = 'running'
+                job.started_at = time.time()
+                self._pending -= 1
+
+            try:
+                result = job.func(job)
+                status, error = 'succeeded', None
+            except JobCancelledError:
+                result, status, error = None, 'cancelled', None
+            except ValueError as e:
+                result, status, error = None, 'failed', str(e)
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed: {e}")
+                result, status, error = None, 'failed', 'Internal processing error'
+
+            with self._lock:
+                if job.cancelled and status == 'succeeded':
+                    # Superseded while finishing; nobody wants this result any more
+                    status, result = 'cancelled', None
+                self._finish(job, status, result, error)
+            logger.info(f"Job {job.id} {status}")
@@ -0,0 +1,204 @@
+"""
+Process-wide metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are plain Python objects with a lock each, so
+recording a sample costs a dict lookup and a bisect, cheap enough to leave on
+in production. app.py serves REGISTRY.render() at /metrics. Collectors add
+point-in-time values such as cache sizes when the metrics are scraped.
+"""
+
+import bisect
+import contextlib
+import functools
+import math
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+BYTE_BUCKETS = tuple(4 ** i * 1024 for i in range(3, 13))  # 64 KiB .. 16 GiB
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {sorted(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, labels, value) tuples for rendering."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in sorted(items):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield '_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class Registry:
+    """Metrics and scrape-time collectors, rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} already registered')
+            self._metrics[metric.name] = metric
+
+    def add_collector(self, collector):
+        """collector() returns (name, kind, documentation, [(labels dict, value), ...]) tuples."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        for collector in collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    'gradient_removal_stage_seconds', 'Time spent in each processing stage.', ['stage']
+)
+PATTERN_DECISIONS = Counter(
+    'gradient_removal_pattern_decisions_total',
+    'Advanced-mode lighting fits chosen by pattern strength.', ['correction']
+)
+INPUT_MEGAPIXELS = Histogram(
+    'gradient_removal_input_megapixels', 'Size of images submitted for processing.', buckets=MEGAPIXEL_BUCKETS
+)
+WORKING_SET_BYTES = Histogram(
+    'gradient_removal_working_set_peak_bytes',
+    'Peak bytes of image, layer, correction field and blend arrays held by one request.', buckets=BYTE_BUCKETS
+)
+
+
+def timed_stage(stage):
+    """Decorator recording the wrapped call's duration under STAGE_SECONDS{stage=...}."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+"""
+Pattern strength of a fabric selection from its spectrum.
+
+A repeating weave or print puts energy at spatial periods of 2.5 to 10 pixels.
+Those periods sit in the ring 0.1-0.4 * min(h, w) of the centred 2D spectrum,
+at any window size. The strength score is 10x the share of spectral magnitude
+in that ring, capped at 1.
+
+The input is real, so its spectrum is conjugate-symmetric. A real FFT
+computes half of it, and the other half is accounted for by weighting the
+columns that stand for two bins. Windows are cropped to FFT-friendly
+(5-smooth) sizes, and the ring masks are cached per shape. Large selections
+are scored from a few sampled windows with the selection's aspect ratio (the
+band is relative to the shorter side), with their band energies pooled.
+"""
+
+import functools
+import numpy as np
+
+
+def fast_length(n):
+    """Largest 2^a * 3^b * 5^c not greater than n, a size the FFT handles quickly."""
+    best = 1
+    power5 = 1
+    while power5 <= n:
+        power3 = power5
+        while power3 <= n:
+            # Largest power of two keeping the product within n
+            best = max(best, power3 << ((n // power3).bit_length() - 1))
+            power3 *= 3
+        power5 *= 5
+    return best
+
+
+@functools.lru_cache(maxsize=32)
+def band_weights(h, w):
+    """(mid_band, total) weights over the rfft2 half-spectrum of an h x w window.
+
+    Columns 1..(w-1)//2 stand for themselves and their mirrored bins, so they count twice.
+    """
+    ky = np.fft.fftfreq(h, 1.0 / h)[:, np.newaxis]
+    kx = np.arange(w // 2 + 1)[np.newaxis, :]
+    radius_sq = ky ** 2 + kx ** 2
+
+    column_weights = np.full(w // 2 + 1, 2.0)
+    column_weights[0] = 1.0
+    if w % 2 == 0:
+        column_weights[-1] = 1.0
+    size = min(h, w)
+    total = np.broadcast_to(column_weights, radius_sq.shape).copy()
+    mid_band = np.where((radius_sq > (size * 0.1) ** 2) & (radius_sq <= (size * 0.4) ** 2), total, 0.0)
+    # Shared between calls
+    total.flags.writeable = False
+    mid_band.flags.writeable = False
+    return mid_band, total
+
+
+def _offsets(length, window, count):
+    if count <= 1:
+        return [(length - window) // 2]
+    return np.linspace(0, length - window, count).astype(int)
+
+
+class PatternAnalyzer:
+    """Scores how strongly a (lighting-removed) lightness component repeats, from 0 to 1."""
+
+    def __init__(self, max_window=512, max_windows=4):
+        self.max_window = max_window
+        self.max_windows = max_windows
+
+    def strength(self, pattern_component):
+        mid_energy = 0.0
+        total_energy = 0.0
+        for window in self.windows(pattern_component):
+            magnitude = np.abs(np.fft.rfft2(window))
+            mid_band, total = band_weights(*window.shape)
+            mid_energy += float(np.vdot(magnitude, mid_band))
+            total_energy += float(np.vdot(magnitude, total))
+
+        if total_energy <= 0:
+            return 0.0
+        return min(mid_energy / total_energy * 10, 1.0)
+
+    def windows(self, component):
+        """Up to max_windows FFT-sized windows spread evenly over component.
+
+        Windows keep the component's aspect ratio, since the band is relative to the window's shorter side.
+        """
+        h, w = component.shape
+        scale = min(1.0, self.max_window / max(h, w))
+        win_h = fast_length(max(1, int(h * scale)))
+        win_w = fast_length(max(1, int(w * scale)))
+        rows = max(1, min(h // win_h, int(np.ceil(np.sqrt(self.max_windows)))))
+        cols = max(1, min(w // win_w, self.max_windows // rows))
+        for y0 in _offsets(h, win_h, rows):
+            for x0 in _offsets(w, win_w, cols):
+                yield component[y0:y0 + win_h, x0:x0 + win_w]
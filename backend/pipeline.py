@@ -0,0 +1,306 @@
+"""
+Staged, memoized gradient removal pipeline for interactive editing.
+
+Gradient removal splits into stages with different inputs:
+
+1. analysis of the selection      -> depends on (image, selection, mode),
+                                     or comes from a calibration profile
+2. correction field               -> analysis resized to the output resolution
+3. lighting/texture decomposition -> depends on the image (and output resolution)
+4. final blend                    -> depends on the three strength settings
+
+Results of stages 1-3 are kept in memory-bounded LRU caches, so moving a
+strength slider only reruns the cheap final blend (and the encode).
+
+Previews run stages 2-4 on a downscaled proxy of the image but share the
+full-resolution analysis with the final result, so both match visually.
+"""
+
+import logging
+from buffers import WorkingSet
+from image_store import LRUCache
+from metrics import WORKING_SET_BYTES
+from decoding import EncodedImage
+from encoding import FORMATS, CHROMA_SUBSAMPLING
+
+logger = logging.getLogger(__name__)
+
+QUALITY_LEVELS = ['preview', 'final']
+DEFAULT_PREVIEW_MAX_DIMENSION = 1280
+# Transient bytes per selection pixel while a selection is analyzed (measured
+# ~31 advanced, ~7 uniform on its small proxy), counted in request working sets
+ANALYSIS_BYTES_PER_PIXEL = {'uniform': 8, 'advanced': 32}
+
+
+def parse_processing_params(data):
+    """Validate selection, mode and strength settings of a gradient removal request.
+
+    Raises ValueError with a client-facing message if anything is missing or out of range.
+    """
+    # A calibration profile replaces the analysis, so it needs no selection
+    profile = data.get('profile')
+    if profile is not None and not isinstance(profile, str):
+        raise ValueError('Invalid profile: must be the name of a calibration profile')
+    profile_version = data.get('profileVersion')
+    if profile_version is not None and (isinstance(profile_version, bool) or not isinstance(profile_version, int)
+                                        or profile_version < 1):
+        raise ValueError('Invalid profileVersion: must be a positive integer')
+
+    for field in ['selection', 'mode']:
+        if field not in data and profile is None:
+            raise ValueError(f'Missing required field: {field}')
+
+    selection = data.get('selection')
+    mode = data.get('mode', 'advanced')
+    settings = data.get('settings', {})
+
+    # Extract strength parameters with defaults
+    gradient_strength = settings.get('gradientStrength', 0.5)
+    brightness_preservation = settings.get('brightnessPreservation', 0.8)
+    color_preservation = settings.get('colorPreservation', 0.9)
+
+    logger.info(f"Processing gradient removal request - Mode: {mode}, Selection: {selection}")
+    logger.info(f"Strength settings - Gradient: {gradient_strength}, Brightness: {brightness_preservation}, Color: {color_preservation}")
+
+    # Validate selection data
+    if selection is not None and (not isinstance(selection, dict)
+                                  or not all(key in selection for key in ['left', 'top', 'width', 'height'])):
+        raise ValueError('Invalid selection data')
+
+    # Validate mode
+    if mode not in ['uniform', 'advanced']:
+        raise ValueError('Invalid mode. Must be "uniform" or "advanced"')
+    if profile is not None and mode == 'uniform':
+        raise ValueError('Calibration profiles apply in advanced mode')
+
+    # Validate strength parameters
+    for param_name, param_value in [('gradientStrength', gradient_strength),
+                                  ('brightnessPreservation', brightness_preservation),
+                                  ('colorPreservation', color_preservation)]:
+        if not isinstance(param_value, (int, float)) or not 0 <= param_value <= 1:
+            raise ValueError(f'Invalid {param_name}: must be between 0 and 1')
+
+    # Validate quality: previews run on a downscaled proxy, final on the full image
+    quality = data.get('quality', 'final')
+    if quality not in QUALITY_LEVELS:
+        raise ValueError('Invalid quality. Must be "preview" or "final"')
+
+    preview_max_dimension = data.get('previewMaxDimension', DEFAULT_PREVIEW_MAX_DIMENSION)
+    if not isinstance(preview_max_dimension, int) or not 64 <= preview_max_dimension <= 8192:
+        raise ValueError('Invalid previewMaxDimension: must be an integer between 64 and 8192')
+
+    # Quality diagnostics cost extra blurs, so they are computed only on request
+    diagnostics = data.get('diagnostics', False)
+    if not isinstance(diagnostics, bool):
+        raise ValueError('Invalid diagnostics: must be true or false')
+
+    # Output encoding; without a format the endpoint negotiates one (JPEG by default)
+    output_format = data.get('format')
+    if output_format is not None and output_format not in FORMATS:
+        raise ValueError(f'Invalid format. Must be one of {list(FORMATS)}')
+
+    encode_quality = data.get('encodeQuality')
+    if encode_quality is not None and (isinstance(encode_quality, bool) or not isinstance(encode_quality, int)
+                                       or not 1 <= encode_quality <= 100):
+        raise ValueError('Invalid encodeQuality: must be an integer between 1 and 100')
+
+    chroma_subsampling = data.get('chromaSubsampling')
+    if chroma_subsampling is not None and chroma_subsampling not in CHROMA_SUBSAMPLING:
+        raise ValueError(f'Invalid chromaSubsampling. Must be one of {CHROMA_SUBSAMPLING}')
+
+    return {
+        'selection': selection,
+        'mode': mode,
+        'gradient_strength': gradient_strength,
+        'brightness_preservation': brightness_preservation,
+        'color_preservation': color_preservation,
+        'quality': quality,
+        'preview_max_dimension': preview_max_dimension,
+        'diagnostics': diagnostics,
+        'format': output_format,
+        'encode_quality': encode_quality,
+        'chroma_subsampling': chroma_subsampling,
+        'profile': profile,
+        'profile_version': profile_version,
+    }
+
+
+class StagedPipeline:
+    """Memoizes the analysis and decomposition stages of a GradientRemovalProcessor."""
+
+    def __init__(self, processor, max_layer_bytes=3 * 1024**3, max_field_bytes=1024**3,
+                 max_analysis_bytes=256 * 1024**2, ttl_seconds=30 * 60,
+                 tiled_engine=None, tiled_min_pixels=60_000_000):
+        self.processor = processor
+        # Final renders of very large scans bypass the layer cache and run tiled with bounded memory
+        self.tiled_engine = tiled_engine
+        self.tiled_min_pixels = tiled_min_pixels
+        self._layers = LRUCache(max_layer_bytes, ttl_seconds)
+        self._fields = LRUCache(max_field_bytes, ttl_seconds)
+        self._analyses = LRUCache(max_analysis_bytes, ttl_seconds)
+
+    def process(self, image_id, image, selection, mode='advanced',
+                gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9,
+                quality='final', preview_max_dimension=DEFAULT_PREVIEW_MAX_DIMENSION, cancel_check=None,
+                profile=None, working_set=None):
+        """Run gradient removal for a registered image, reusing cached stages.
+
+        image_id must identify the image content (e.g. an ImageStore ID). With
+        quality='preview' the result is at most preview_max_dimension on its
+        longest side; 'final' returns the full resolution result. cancel_check,
+        if given, is called between stages and may raise to abandon the request.
+        A CalibrationProfile, if given, replaces the analysis of the selection.
+        image may be an EncodedImage; previews then decode it at reduced resolution.
+
+        The arrays the request holds (decoded image, layers, correction field,
+        blend buffers and result) are added up in working_set, a WorkingSet the
+        caller may pass to read the peak; the peak is also recorded in /metrics.
+        """
+        working_set = working_set if working_set is not None else WorkingSet()
+        try:
+            return self._process(image_id, image, selection, mode,
+                                 gradient_strength, brightness_preservation, color_preservation,
+                                 quality, preview_max_dimension, cancel_check, profile, working_set)
+        finally:
+            if working_set.peak:
+                WORKING_SET_BYTES.observe(working_set.peak)
+
+    def _process(self, image_id, image, selection, mode, gradient_strength, brightness_preservation,
+                 color_preservation, quality, preview_max_dimension, cancel_check, profile, working_set):
+        cancel_check = cancel_check or (lambda: None)
+        logger.info(f"Staged gradient removal - Image: {image_id[:12]}, Mode: {mode}, Quality: {quality}")
+
+        max_dimension = None
+        if quality == 'preview' and max(image.shape[:2]) > preview_max_dimension:
+            max_dimension = preview_max_dimension
+        if max_dimension is None and isinstance(image, EncodedImage):
+            image = image.decode()
+        if gradient_strength == 0 and max_dimension is None:
+            logger.info("Gradient strength is 0, returning original image")
+            return image
+        if profile is not None:
+            logger.info(f"Applying calibration profile {profile.name} v{profile.version}")
+            profile.check_image(image.shape)
+
+        if max_dimension is None and self._use_tiled(image):
+            # The tiled engine keeps its tiles within its budget; the output is memory-mapped
+            working_set.add(self.tiled_engine.memory_budget_bytes)
+            correction_map = (self.analysis(image_id, image, selection, mode, profile, working_set)
+                              if mode != 'uniform' else None)
+            return self.tiled_engine.apply(
+                image, correction_map, mode,
+                gradient_strength, brightness_preservation, color_preservation
+            )
+
+        if max_dimension is not None and not isinstance(image, EncodedImage):
+            # The full-resolution upload stays in memory next to the preview proxy
+            working_set.add(image.nbytes)
+        layers = self.layers(image_id, image, mode, max_dimension, working_set)
+        if gradient_strength == 0:
+            return layers.image
+        cancel_check()
+
+        correction_full = None
+        if mode != 'uniform':
+            correction_full = self.correction_field(image_id, image, selection, mode, layers, profile, working_set)
+            working_set.add(correction_full.nbytes)
+            cancel_check()
+
+        return self.processor.blend_correction(
+            layers, correction_full, mode,
+            gradient_strength, brightness_preservation, color_preservation, working_set
+        )
+
+    def _use_tiled(self, image):
+        return self.tiled_engine is not None and image.shape[0] * image.shape[1] >= self.tiled_min_pixels
+
+    def analysis(self, image_id, image, selection, mode, profile=None, working_set=None):
+        """Correction map for (image, selection, mode), always analyzed at full resolution.
+
+        With a calibration profile it is the profile's map, and nothing is analyzed.
+        """
+        if profile is not None:
+            return profile.correction_map
+        return self.correction_analysis(image_id, image, selection, mode, working_set).correction_map
+
+    def correction_analysis(self, image_id, image, selection, mode, working_set=None):
+        """CorrectionAnalysis behind analysis(), including any fitted lighting surface.
+
+        working_set, if given, gets the analysis and, while it is computed, an
+        estimate of its temporaries.
+        """
+        working_set = working_set if working_set is not None else WorkingSet()
+        bounds = self.processor.selection_bounds(image.shape, selection)
+        key = (image_id, bounds, mode)
+        analysis = self._analyses.get(key)
+        if analysis is None:
+            x1, y1, x2, y2 = bounds
+            transient = (x2 - x1) * (y2 - y1) * ANALYSIS_BYTES_PER_PIXEL['uniform' if mode == 'uniform' else 'advanced']
+            working_set.add(transient)
+            try:
+                analysis = self.processor.analyze_correction(image[y1:y2, x1:x2], mode)
+            finally:
+                working_set.remove(transient)
+            self._analyses.put(key, analysis, analysis.nbytes)
+        else:
+            logger.info("Reusing cached gradient analysis")
+        working_set.add(analysis.nbytes)
+        return analysis
+
+    def correction_field(self, image_id, image, selection, mode, layers, profile=None, working_set=None):
+        """Correction field at the resolution of layers, computed once per analysis or profile."""
+        if profile is not None:
+            source = ('profile', profile.digest)
+        else:
+            source = self.processor.selection_bounds(image.shape, selection)
+        key = (image_id, source, mode, layers.image.shape)
+        correction_full = self._fields.get(key)
+        if correction_full is None:
+            correction_map = self.analysis(image_id, image, selection, mode, profile, working_set)
+            correction_full = self.processor.prepare_correction_field(
+                correction_map, layers.image.shape, layers.scale
+            )
+            self._fields.put(key, correction_full, correction_full.nbytes)
+        else:
+            logger.info("Reusing cached correction field")
+        return correction_full
+
+    def layers(self, image_id, image, mode, max_dimension=None, working_set=None):
+        """Lighting/texture decomposition of the image (or its preview proxy), computed once per mode.
+
+        working_set, if given, gets the bytes of the decomposition and its image,
+        counting the blur levels held while the texture is built.
+        """
+        working_set = working_set if working_set is not None else WorkingSet()
+        key = (image_id, max_dimension)
+        layers = self._layers.get(key)
+        if layers is None:
+            scale = 1.0
+            if max_dimension is not None:
+                image, scale = self.processor.downscale_image(image, max_dimension)
+            layers = self.processor.decompose_image(image, scale)
+        elif layers.has_texture(mode):
+            logger.info("Reusing cached image layers")
+            working_set.add(layers.image.nbytes + layers.nbytes)
+            return layers
+        layers.texture(mode)
+        held = layers.image.nbytes + layers.nbytes
+        working_set.add(held)
+        layers.compact()
+        working_set.remove(held - layers.image.nbytes - layers.nbytes)
+        # Re-insert so the cache accounts for the newly built texture layer
+        self._layers.put(key, layers, layers.nbytes)
+        return layers
+
+    def invalidate(self, image_id):
+        """Drop all cached stages for an image."""
+        for cache in [self._layers, self._fields, self._analyses]:
+            for key in [key for key in cache.keys() if key[0] == image_id]:
+                cache.pop(key)
+
+    def stats(self):
+        return {
+            'layers': self._layers.stats(),
+            'correctionFields': self._fields.stats(),
+            'analyses': self._analyses.stats(),
+        }
@@ -0,0 +1,80 @@
+"""
+Rectangle statistics from summed-area tables.
+
+A summed-area table S holds at S[y, x] the sum of all values above and to
+the left of (x, y), so the sum over any rectangle takes four lookups:
+
+    sum(x0:x1, y0:y1) = S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0]
+
+Building the table costs one pass; every mean after that is O(1) whatever the
+rectangle size. Tables are built in float64, so sums of 8-bit values stay exact.
+For coarse questions (how bright is the left quarter of a selection against
+its center?) the table is built over a small INTER_AREA proxy of the values, which makes it
+independent of the source resolution as well.
+"""
+
+import cv2
+import numpy as np
+
+
+class RegionStats:
+    """O(1) rectangle means of a 2D array, or per channel of a 3D one.
+
+    Rectangles are given in pixels of the source the statistics describe, or as
+    fractions of its size; with a proxy they are mapped to proxy pixels.
+    Every rectangle covers at least one pixel, so narrow sources never give
+    empty regions.
+    """
+
+    def __init__(self, values, source_shape=None):
+        values = np.asarray(values)
+        if values.dtype not in (np.uint8, np.float32, np.float64):
+            values = values.astype(np.float32)
+        self.shape = values.shape[:2]
+        self.source_shape = tuple(source_shape[:2]) if source_shape is not None else self.shape
+        self.table = cv2.integral(values, sdepth=cv2.CV_64F)
+
+    @classmethod
+    def from_lightness(cls, image, max_dimension=None):
+        """Statistics of the LAB lightness of an RGB image, over a proxy at most max_dimension on its longest side.
+
+        Lightness is converted at full resolution and averaged afterwards: L is not linear in
+        RGB, so the lightness of block-averaged colors drifts from the mean lightness on
+        contrasty textures (over 1 L on a plaid).
+        """
+        source_shape = image.shape
+        h, w = source_shape[:2]
+        lightness = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2LAB)[:, :, 0]
+        if max_dimension is not None and max(h, w) > max_dimension:
+            # An integer factor takes OpenCV's block-averaging fast path (~3x faster than an
+            # arbitrary one); it leaves out at most factor - 1 rows and columns at the far edges
+            factor = -(-max(h, w) // max_dimension)
+            proxy_h, proxy_w = max(1, h // factor), max(1, w // factor)
+            lightness = cv2.resize(lightness[:proxy_h * factor, :proxy_w * factor].astype(np.float32),
+                                   (proxy_w, proxy_h), interpolation=cv2.INTER_AREA)
+        return cls(lightness, source_shape)
+
+    def _bounds(self, x0, y0, x1, y1):
+        """Proxy pixel bounds of a source rectangle, clipped and at least one pixel wide and high."""
+        h, w = self.shape
+        source_h, source_w = self.source_shape
+        x0, x1 = x0 * w / source_w, x1 * w / source_w
+        y0, y1 = y0 * h / source_h, y1 * h / source_h
+        x0 = min(max(int(round(x0)), 0), w - 1)
+        y0 = min(max(int(round(y0)), 0), h - 1)
+        return x0, y0, max(x0 + 1, min(int(round(x1)), w)), max(y0 + 1, min(int(round(y1)), h))
+
+    def _sum(self, x0, y0, x1, y1):
+        s = self.table
+        return s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0]
+
+    def mean(self, x0=0, y0=0, x1=None, y1=None):
+        """Mean over the rectangle [x0, x1) x [y0, y1) in source pixels; defaults to everything."""
+        source_h, source_w = self.source_shape
+        x0, y0, x1, y1 = self._bounds(x0, y0, source_w if x1 is None else x1, source_h if y1 is None else y1)
+        return self._sum(x0, y0, x1, y1) / ((x1 - x0) * (y1 - y0))
+
+    def fraction_mean(self, left, top, right, bottom):
+        """Mean over a rectangle given as fractions (0-1) of the source width and height."""
+        source_h, source_w = self.source_shape
+        return self.mean(left * source_w, top * source_h, right * source_w, bottom * source_h)
@@ -0,0 +1,169 @@
+"""
+Persistent cache of encoded results, shared by worker processes.
+
+Each result is one file named by the SHA-256 of everything that determines it:
+the image's content hash, the selection, mode, strength settings, output
+resolution and encoding, and the processor's result_version(). The file holds a
+JSON metadata line followed by the encoded image. Writers write a temporary
+file and rename it into place, so readers in other processes see either the
+whole entry or none.
+
+Recency is the file's modification time, refreshed on every hit, so LRU order
+is shared across processes without coordination. Each process tracks the
+directory size from its last scan plus its own writes. When that estimate
+exceeds max_bytes, the process rescans and deletes the least recently used
+entries down to 90% of the budget. The directory can therefore overshoot the
+budget by what other processes wrote since the last scan.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TEMP_SUFFIX = '.tmp'
+# Temporary files this old were left by a crashed writer
+STALE_TEMP_SECONDS = 60 * 60
+
+
+class ResultCache:
+    """Encoded results on disk under content-addressed keys, evicted LRU by total size."""
+
+    def __init__(self, directory, max_bytes=5 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes, self._entries = self._scan_totals()
+
+    @staticmethod
+    def key(*parts):
+        """Cache key for JSON-serialisable parts (dict key order doesn't matter)."""
+        payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        # Two-level fan-out keeps directories small
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """(data, metadata) for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                metadata = json.loads(f.readline())
+                data = f.read()
+            if len(data) != metadata.get('bytes'):
+                raise ValueError(f'expected {metadata.get("bytes")} bytes, found {len(data)}')
+            # Mark as recently used for every process's eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # Never written, or evicted by another process
+            with self._lock:
+                self.misses += 1
+            return None
+        except ValueError as e:
+            logger.warning(f"Dropping corrupt result cache entry {key[:12]}: {e}")
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data, metadata
+
+    def put(self, key, data, metadata=None):
+        """Store data with JSON-serialisable metadata under key."""
+        path = self._path(key)
+        header = json.dumps({**(metadata or {}), 'bytes': len(data)}).encode() + b'\n'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}'
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = None
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(header)
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            # A full or read-only disk must not fail the request that produced the result
+            logger.warning(f"Could not write result cache entry {key[:12]}: {e}")
+            self._remove(temp_path)
+            return
+
+        with self._lock:
+            self._total_bytes += len(header) + len(data) - (replaced or 0)
+            self._entries += replaced is None
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the directory is within 90% of max_bytes."""
+        entries = []
+        now = time.time()
+        for path, size, mtime in self._scan():
+            if path.endswith(TEMP_SUFFIX):
+                if now - mtime > STALE_TEMP_SECONDS:
+                    self._remove(path)
+                continue
+            entries.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} result cache entries, {total / 1024**2:.0f} MiB left")
+
+        with self._lock:
+            self._total_bytes = total
+            self._entries = len(entries) - evicted
+
+    def _scan(self):
+        """(path, size, mtime) of every file below the cache directory."""
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _scan_totals(self):
+        sizes = [size for path, size, _ in self._scan() if not path.endswith(TEMP_SUFFIX)]
+        return sum(sizes), len(sizes)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': self._entries,
+                'bytes': self._total_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
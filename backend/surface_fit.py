@@ -0,0 +1,94 @@
+"""
+Least-squares polynomial surfaces for lighting correction.
+
+Fitting a polynomial over every pixel of a selection with an explicit
+N x terms design matrix costs hundreds of MB for large selections. On a
+regular grid the normal equations only need two kinds of sums:
+
+- sum(x^a * y^b) over the grid, which factorises into sum(x^a) * sum(y^b);
+- the moments sum(z * x^a * y^b), accumulated a block of rows at a time as
+  Y @ z @ X.T with small power matrices X and Y.
+
+Coordinates are normalised to [-1, 1] to keep the system well conditioned,
+and the surface is evaluated separably as Y.T @ C @ X.
+"""
+
+import numpy as np
+
+
+def _powers(coords, size, degree):
+    """(degree + 1, len(coords)) matrix of normalised coordinate powers."""
+    half = max((size - 1) / 2.0, 1.0)
+    u = (np.asarray(coords, dtype=np.float64) - (size - 1) / 2.0) / half
+    return u[np.newaxis, :] ** np.arange(degree + 1)[:, np.newaxis]
+
+
+class PolynomialSurface:
+    """A 2D polynomial z(x, y) with all terms x^a * y^b, a + b <= degree."""
+
+    def __init__(self, coefficients, shape, degree, rms_residual=None, samples=0):
+        # coefficients[b, a] multiplies x^a * y^b in normalised coordinates
+        self.coefficients = coefficients
+        self.shape = shape
+        self.degree = degree
+        self.rms_residual = rms_residual
+        self.samples = samples
+
+    @staticmethod
+    def terms(degree):
+        return [(a, b) for b in range(degree + 1) for a in range(degree + 1 - b)]
+
+    @classmethod
+    def fit(cls, values, degree=2, step=1, regularization=0.0, chunk_rows=256):
+        """Least-squares fit to a 2D array.
+
+        step > 1 fits on every step-th row and column only. regularization is
+        added to the diagonal of the normal equations (ridge). Raises
+        np.linalg.LinAlgError if the system is singular.
+        """
+        h, w = values.shape
+        ys = np.arange(0, h, step)
+        xs = np.arange(0, w, step)
+        x_powers = _powers(xs, w, degree)
+        y_powers = _powers(ys, h, degree)
+
+        # Moments sum(z * x^a * y^b) as moments[b, a], in float64 a block of rows at a time
+        sampled = values[::step, ::step]
+        moments = np.zeros((degree + 1, degree + 1))
+        sum_squares = 0.0
+        for r0 in range(0, len(ys), chunk_rows):
+            rows = sampled[r0:r0 + chunk_rows].astype(np.float64)
+            moments += y_powers[:, r0:r0 + chunk_rows] @ (rows @ x_powers.T)
+            sum_squares += float(np.einsum('ij,ij->', rows, rows))
+
+        # Grid sums of x^a * y^b factorise into per-axis power sums
+        x_sums = _powers(xs, w, 2 * degree).sum(axis=1)
+        y_sums = _powers(ys, h, 2 * degree).sum(axis=1)
+        terms = cls.terms(degree)
+        ata = np.array([[x_sums[a1 + a2] * y_sums[b1 + b2] for a2, b2 in terms] for a1, b1 in terms])
+        atb = np.array([moments[b, a] for a, b in terms])
+
+        solution = np.linalg.solve(ata + regularization * np.eye(len(terms)), atb)
+
+        samples = len(xs) * len(ys)
+        # Residual sum of squares from the same sums: |z|^2 - 2 c.A'z + c'A'Ac
+        sse = sum_squares - 2.0 * solution @ atb + solution @ ata @ solution
+        rms_residual = float(np.sqrt(max(sse, 0.0) / samples))
+
+        coefficients = np.zeros((degree + 1, degree + 1))
+        for (a, b), c in zip(terms, solution):
+            coefficients[b, a] = c
+        return cls(coefficients, (h, w), degree, rms_residual, samples)
+
+    def evaluate(self, dtype=np.float32):
+        """Surface sampled on the fitted pixel grid."""
+        h, w = self.shape
+        rows = (_powers(np.arange(h), h, self.degree).T @ self.coefficients).astype(dtype)
+        return rows @ _powers(np.arange(w), w, self.degree).astype(dtype)
+
+    def mean(self):
+        """Mean of the surface over the fitted pixel grid, without evaluating it."""
+        h, w = self.shape
+        y_means = _powers(np.arange(h), h, self.degree).mean(axis=1)
+        x_means = _powers(np.arange(w), w, self.degree).mean(axis=1)
+        return float(y_means @ self.coefficients @ x_means)
@@ -0,0 +1,60 @@
+import base64
+import logging
+import os
+import sys
+
+import cv2
+import pytest
+
+# Backend modules import each other as top-level modules, as they do when app.py runs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import synthetic_fabric  # noqa: E402
+from gradient_removal import GradientRemovalProcessor  # noqa: E402
+
+# The processing stages log every step at INFO
+logging.getLogger().setLevel(logging.WARNING)
+
+SELECTION = {'left': 0.1, 'top': 0.15, 'width': 0.6, 'height': 0.5}
+
+
+@pytest.fixture
+def processor():
+    return GradientRemovalProcessor()
+
+
+@pytest.fixture(scope='session')
+def fabric():
+    """A 480x640 plaid scan under a linear lighting gradient."""
+    return synthetic_fabric(480, 640, pattern='plaid', gradient='linear')[0]
+
+
+@pytest.fixture
+def selection():
+    return dict(SELECTION)
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """The Flask app module, with serial processing and no on-disk state."""
+    os.environ['GRADIENT_REMOVAL_WORKERS'] = '1'
+    for name in ['RESULT_CACHE_DIR', 'CALIBRATION_DIR', 'BATCH_ROOT', 'DIAGNOSTICS_SAMPLE_EVERY']:
+        os.environ.pop(name, None)
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture(scope='session')
+def fabric_png(fabric):
+    """The fabric scan encoded as PNG bytes."""
+    return cv2.imencode('.png', fabric[:, :, ::-1])[1].tobytes()
+
+
+@pytest.fixture(scope='session')
+def fabric_data_url(fabric_png):
+    return 'data:image/png;base64,' + base64.b64encode(fabric_png).decode()
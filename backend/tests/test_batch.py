@@ -0,0 +1,121 @@
+"""BatchRunner: outputs, resume, the memory budget and the progress counters."""
+
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from batch import (BatchRun, BatchRunner, IN_MEMORY_BYTES_PER_PIXEL, MemoryBudget, PROGRESS_FILENAME,
+                   collect_items)
+from tiled_processing import TiledCorrectionEngine
+
+
+@pytest.fixture
+def scans(tmp_path, fabric):
+    directory = tmp_path / 'scans'
+    directory.mkdir()
+    for i in range(4):
+        cv2.imwrite(str(directory / f'scan{i}.png'), np.roll(fabric, 7 * i, axis=1)[:, :, ::-1])
+    return directory
+
+
+def defaults(selection, strength=0.5):
+    return {'selection': selection, 'mode': 'advanced', 'settings': {'gradientStrength': strength}}
+
+
+def test_batch_matches_single_image_processing(processor, scans, selection, tmp_path):
+    output_dir = tmp_path / 'out'
+    items = collect_items(str(scans), str(output_dir), {**defaults(selection), 'format': 'png'})
+    summary = BatchRunner(processor, process_workers=2).run(items, str(output_dir))
+    assert summary['succeeded'] == 4 and summary['failed'] == 0
+
+    image = processor.decode_image_file(str(scans / 'scan2.png'))
+    expected = processor.process_image(image, selection, 'advanced', 0.5, 0.8, 0.9)
+    written = cv2.imread(str(output_dir / 'scan2.png'))[:, :, ::-1]
+    np.testing.assert_array_equal(written, expected)
+
+
+def test_resume_skips_only_unchanged_items(processor, scans, selection, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    runner = BatchRunner(processor, process_workers=2)
+    assert runner.run(collect_items(str(scans), output_dir, defaults(selection)), output_dir)['succeeded'] == 4
+
+    summary = runner.run(collect_items(str(scans), output_dir, defaults(selection)), output_dir)
+    assert summary['skipped'] == 4 and summary['succeeded'] == 0
+
+    # A removed output and changed settings are both processed again
+    os.remove(os.path.join(output_dir, 'scan0.jpg'))
+    summary = runner.run(collect_items(str(scans), output_dir, defaults(selection)), output_dir)
+    assert summary['succeeded'] == 1 and summary['skipped'] == 3
+    summary = runner.run(collect_items(str(scans), output_dir, defaults(selection, strength=0.7)), output_dir)
+    assert summary['succeeded'] == 4 and summary['skipped'] == 0
+
+    with open(os.path.join(output_dir, PROGRESS_FILENAME)) as f:
+        records = [json.loads(line) for line in f]
+    assert len({record['paramsHash'] for record in records}) == 2
+
+
+def test_invalid_items_fail_without_stopping_the_batch(processor, scans, tmp_path):
+    (scans / 'broken.png').write_bytes(b'not an image')
+    output_dir = str(tmp_path / 'out')
+    items = collect_items(str(scans), output_dir, {'mode': 'advanced'})
+    assert all(item.error == 'Missing required field: selection' for item in items)
+
+    items = collect_items(str(scans), output_dir, defaults({'left': 0.1, 'top': 0.1, 'width': 0.3, 'height': 0.3}))
+    summary = BatchRunner(processor).run(items, output_dir)
+    assert summary['succeeded'] == 4 and summary['failed'] == 1
+
+
+def test_memory_budget_bounds_images_in_flight(processor, scans, selection, fabric, tmp_path):
+    per_image = fabric.shape[0] * fabric.shape[1] * IN_MEMORY_BYTES_PER_PIXEL
+    output_dir = str(tmp_path / 'out')
+    runner = BatchRunner(processor, decode_workers=4, process_workers=4, encode_workers=2,
+                         memory_budget_bytes=2 * per_image)
+    summary = runner.run(collect_items(str(scans), output_dir, defaults(selection)), output_dir)
+    assert summary['succeeded'] == 4
+    assert per_image <= summary['peakReservedBytes'] <= 2 * per_image
+    assert runner.memory.reserved == 0
+
+
+def test_images_over_budget_run_tiled(processor, scans, selection, fabric, tmp_path):
+    engine = TiledCorrectionEngine(processor, memory_budget_bytes=8 * 1024**2)
+    output_dir = str(tmp_path / 'out')
+    runner = BatchRunner(processor, tiled_engine=engine, memory_budget_bytes=16 * 1024**2)
+    items = collect_items(str(scans), output_dir, defaults(selection))
+    summary = runner.run(items, output_dir)
+    assert summary['succeeded'] == 4
+    assert all(item.tiled for item in items)
+    assert summary['peakReservedBytes'] <= 16 * 1024**2
+
+
+def test_oversized_reservation_runs_alone():
+    budget = MemoryBudget(100)
+    budget.acquire(60)
+    granted = threading.Event()
+
+    def acquire_oversized():
+        budget.acquire(500)
+        granted.set()
+
+    thread = threading.Thread(target=acquire_oversized)
+    thread.start()
+    time.sleep(0.05)
+    assert not granted.is_set()
+    budget.release(60)
+    thread.join(timeout=5)
+    assert granted.is_set() and budget.reserved == 500
+
+
+def test_batch_run_counts_every_item(processor, scans, selection, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    (scans / 'broken.png').write_bytes(b'not an image')
+    runner = BatchRunner(processor, decode_workers=3, process_workers=3, encode_workers=3)
+    run = BatchRun(runner, collect_items(str(scans), output_dir, defaults(selection)), output_dir)
+    run._thread.join(timeout=60)
+    info = run.to_dict()
+    assert info['status'] == 'succeeded'
+    assert info['finished'] == 5 and info['failed'] == 1
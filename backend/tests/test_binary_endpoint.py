@@ -0,0 +1,79 @@
+"""/api/gradient-removal/binary: multipart, raw-body and registered-image requests."""
+
+import base64
+import io
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+SETTINGS = {'gradientStrength': 0.7, 'brightnessPreservation': 0.8, 'colorPreservation': 0.9}
+
+
+def decode_png(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)[:, :, ::-1]
+
+
+def headers_for(selection, mode, **extra):
+    return {
+        'X-Selection': json.dumps(selection), 'X-Mode': mode, 'X-Format': 'png',
+        'X-Gradient-Strength': str(SETTINGS['gradientStrength']),
+        'X-Brightness-Preservation': str(SETTINGS['brightnessPreservation']),
+        'X-Color-Preservation': str(SETTINGS['colorPreservation']),
+        **extra,
+    }
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+def test_multipart_matches_processor(client, processor, fabric, fabric_png, selection, mode):
+    params = {'selection': selection, 'mode': mode, 'format': 'png', 'settings': SETTINGS}
+    response = client.post('/api/gradient-removal/binary', data={
+        'image': (io.BytesIO(fabric_png), 'scan.png'), 'params': json.dumps(params),
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.headers['X-Mode'] == mode
+    expected = processor.process_image(fabric, selection, mode, 0.7, 0.8, 0.9)
+    np.testing.assert_array_equal(decode_png(response.data), expected)
+
+
+def test_raw_body_matches_multipart_and_json(client, fabric_png, fabric_data_url, selection):
+    raw = client.post('/api/gradient-removal/binary', data=fabric_png,
+                      headers=headers_for(selection, 'advanced'), content_type='image/png')
+    params = {'selection': selection, 'mode': 'advanced', 'format': 'png', 'settings': SETTINGS}
+    multipart = client.post('/api/gradient-removal/binary', data={
+        'image': (io.BytesIO(fabric_png), 'scan.png'), 'params': json.dumps(params),
+    }, content_type='multipart/form-data')
+    inline = client.post('/api/gradient-removal', json={'image': fabric_data_url, **params})
+
+    assert raw.status_code == multipart.status_code == inline.status_code == 200
+    assert raw.headers['X-Image-Id'] == multipart.headers['X-Image-Id']
+    inline_bytes = base64.b64decode(inline.get_json()['processedImage'].split(',', 1)[1])
+    assert raw.data == multipart.data == inline_bytes
+
+
+def test_registered_image_by_id(client, fabric_png, selection):
+    image_id = client.post('/api/images', data=fabric_png, content_type='image/png').get_json()['imageId']
+    by_id = client.post('/api/gradient-removal/binary',
+                        headers=headers_for(selection, 'uniform', **{'X-Image-Id': image_id}))
+    uploaded = client.post('/api/gradient-removal/binary', data=fabric_png,
+                           headers=headers_for(selection, 'uniform'), content_type='image/png')
+    assert by_id.status_code == 200
+    assert by_id.headers['X-Image-Id'] == image_id
+    assert by_id.data == uploaded.data
+
+
+@pytest.mark.parametrize('headers, with_body, status', [
+    ({}, False, 400),
+    ({'X-Selection': '{"left": 0.1'}, True, 400),
+    ({'X-Gradient-Strength': 'strong'}, True, 400),
+    ({'X-Mode': 'sideways'}, True, 400),
+    ({'X-Image-Id': 'f' * 64}, False, 404),
+])
+def test_rejects_bad_requests(client, fabric_png, selection, headers, with_body, status):
+    response = client.post('/api/gradient-removal/binary', data=fabric_png if with_body else b'',
+                           headers={**headers_for(selection, 'uniform'), **headers}, content_type='image/png')
+    assert response.status_code == status
+    assert 'error' in response.get_json()
@@ -0,0 +1,140 @@
+"""Versioned calibration profiles: the store, applying profiles and the profile API."""
+
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from calibration import PROFILE_FORMAT_VERSION, CalibrationProfile, ProfileStore, UnknownProfileError
+from gradient_removal import CorrectionAnalysis
+from pipeline import StagedPipeline
+
+
+def make_profile(name='RIG_A', level=1.0, shape=(48, 64)):
+    y, x = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float32)
+    correction_map = level + 0.2 * x / shape[1] - 0.1 * y / shape[0]
+    return CalibrationProfile.from_analysis(name, CorrectionAnalysis(correction_map, 'flat-field'),
+                                            (480, 640, 3), 'reference', algorithm_version=3)
+
+
+@pytest.fixture(params=['memory', 'directory'])
+def store(request, tmp_path):
+    return ProfileStore(None if request.param == 'memory' else str(tmp_path / 'profiles'))
+
+
+def test_versions_and_latest(store):
+    assert [store.save(make_profile(level=level)) for level in (1.0, 1.1, 1.2)] == [1, 2, 3]
+    store.save(make_profile('RIG_B'))
+    assert store.versions('RIG_A') == [1, 2, 3]
+    assert store.names() == ['RIG_A', 'RIG_B']
+
+    latest = store.get('RIG_A')
+    assert latest.version == 3
+    assert latest.correction_map[0, 0] == pytest.approx(1.2)
+    assert store.get('RIG_A', 1).correction_map[0, 0] == pytest.approx(1.0)
+    assert store.get('RIG_A', 1).digest != latest.digest
+
+
+@pytest.mark.parametrize('name, version', [('RIG_A', 4), ('RIG_C', None), ('RIG_C', 1)])
+def test_unknown_profiles_raise(store, name, version):
+    store.save(make_profile())
+    store.save(make_profile())
+    with pytest.raises(UnknownProfileError):
+        store.get(name, version)
+
+
+def test_delete_falls_back_to_the_previous_version(store):
+    for level in (1.0, 1.1, 1.2):
+        store.save(make_profile(level=level))
+    assert store.delete('RIG_A', 3) == 1
+    assert store.get('RIG_A').version == 2
+    assert store.delete('RIG_A', 3) == 0
+    # The next capture follows the latest version kept
+    assert store.save(make_profile()) == 3
+    assert store.delete('RIG_A') == 3
+    assert store.names() == []
+
+
+def test_rejects_invalid_names():
+    for name in ['', '../escape', 'a' * 65, '.hidden', None]:
+        with pytest.raises(ValueError):
+            make_profile(name)
+
+
+def test_directory_is_shared_between_stores(tmp_path):
+    first, second = ProfileStore(str(tmp_path)), ProfileStore(str(tmp_path))
+    saved = make_profile()
+    first.save(saved)
+    loaded = second.get('RIG_A')
+    np.testing.assert_array_equal(loaded.correction_map, saved.correction_map)
+    assert loaded.metadata() == saved.metadata()
+
+    # A newer capture in one process is the latest in the other
+    second.save(make_profile(level=1.3))
+    assert first.get('RIG_A').version == 2
+
+
+def test_concurrent_saves_get_distinct_versions(tmp_path):
+    stores = [ProfileStore(str(tmp_path)) for _ in range(8)]
+    versions = []
+    threads = [threading.Thread(target=lambda store=store: versions.append(store.save(make_profile())))
+               for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(versions) == list(range(1, 9))
+    assert stores[0].versions('RIG_A') == list(range(1, 9))
+
+
+def test_rejects_newer_file_format(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    store.save(make_profile())
+    path = store._path('RIG_A', 1)
+    with open(path, 'rb') as f:
+        header, data = json.loads(f.readline()), f.read()
+    with open(path, 'wb') as f:
+        f.write(json.dumps({**header, 'formatVersion': PROFILE_FORMAT_VERSION + 1}).encode() + b'\n' + data)
+    with pytest.raises(ValueError):
+        ProfileStore(str(tmp_path)).get('RIG_A')
+
+
+def test_profile_of_a_selection_reproduces_its_correction(processor, fabric, selection):
+    profile = processor.capture_profile('RIG_A', fabric, selection)
+    assert profile.source == 'analysis'
+    pipeline = StagedPipeline(processor)
+    analysed = pipeline.process('scan', fabric, selection, 'advanced', 0.7, 0.8, 0.9).astype(np.int16)
+    calibrated = pipeline.process('scan', fabric, None, 'advanced', 0.7, 0.8, 0.9, profile=profile)
+    np.testing.assert_array_equal(calibrated, processor.process_image(fabric, None, 'advanced', 0.7, 0.8, 0.9,
+                                                                      profile=profile))
+    assert np.abs(calibrated - analysed).max() <= 1
+
+
+def test_profile_api(client, fabric_data_url, selection):
+    created = [client.post('/api/calibration-profiles', json={'name': 'API_RIG', 'image': fabric_data_url, **body})
+               for body in [{}, {'selection': selection}]]
+    assert [response.status_code for response in created] == [201, 201]
+    assert [response.get_json()['version'] for response in created] == [1, 2]
+    assert [response.get_json()['source'] for response in created] == ['reference', 'analysis']
+
+    latest = client.get('/api/calibration-profiles/API_RIG').get_json()
+    assert (latest['version'], latest['versions']) == (2, [1, 2])
+    assert client.get('/api/calibration-profiles/API_RIG?version=1').get_json()['kind'] == 'flat-field'
+    assert client.get('/api/calibration-profiles/API_RIG?version=3').status_code == 404
+    assert client.get('/api/calibration-profiles/API_RIG?version=x').status_code == 400
+
+    def process(**profile):
+        return client.post('/api/gradient-removal', json={
+            'image': fabric_data_url, 'format': 'png', 'quality': 'preview', 'previewMaxDimension': 160, **profile,
+        })
+    assert process(profile='API_RIG').status_code == 200
+    assert process(profile='API_RIG', profileVersion=1).get_json()['processedImage'] != \
+        process(profile='API_RIG').get_json()['processedImage']
+    assert process(profile='API_RIG', profileVersion=3).status_code == 400
+    assert process(profile='NO_RIG').status_code == 400
+
+    assert client.delete('/api/calibration-profiles/API_RIG?version=2').get_json()['deleted'] == 1
+    assert client.get('/api/calibration-profiles/API_RIG').get_json()['version'] == 1
+    assert client.delete('/api/calibration-profiles/API_RIG').get_json()['deleted'] == 1
+    assert client.get('/api/calibration-profiles/API_RIG').status_code == 404
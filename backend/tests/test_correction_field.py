@@ -0,0 +1,92 @@
+"""/api/correction-field: compact fields and blend parameters a client can apply itself."""
+
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+
+def field_array(field):
+    values = np.frombuffer(base64.b64decode(field['data']), dtype='<f4')
+    return values.reshape(field['height'], field['width'])
+
+
+def surface_factor(surface, width, height):
+    """The fitted surface's correction factor at every pixel of a width x height grid."""
+    u = 2 * (np.arange(width) + 0.5) / width - 1
+    v = (2 * (np.arange(height) + 0.5) / height - 1)[:, np.newaxis]
+    values = sum(term['coefficient'] * u ** term['x'] * v ** term['y'] for term in surface['terms'])
+    return np.clip(surface['target'] / values, *surface['limits'])
+
+
+def apply_client_side(image, correction, blend):
+    """The advanced blend as the README describes it, from the field alone."""
+    h, w = image.shape[:2]
+    image = image.astype(np.float32)
+    smoothing = correction['smoothing']
+    factor = cv2.resize(field_array(correction['field']), (w, h), interpolation=cv2.INTER_LINEAR)
+    factor = cv2.GaussianBlur(factor, (smoothing['kernelSize'],) * 2, smoothing['sigma'])
+    b5, b15, b35 = (cv2.GaussianBlur(image, (level['kernelSize'],) * 2, level['sigma'])
+                    for level in (blend['blurLevels'][name] for name in ['fine', 'medium', 'lighting']))
+    weights = blend['textureWeights']
+    texture = weights['fine'] * (image - b5) + weights['medium'] * (b5 - b15) + weights['coarse'] * (b15 - b35)
+    corrected = b35 * (1 + blend['correctionGain'] * (factor - 1))[:, :, np.newaxis] + texture
+    brightness = np.clip(image.mean() / corrected.mean(), *blend['brightnessFactorLimits'])
+    corrected *= blend['brightnessPreservation'] * brightness + 1 - blend['brightnessPreservation']
+    corrected = (1 - blend['colorBlend']) * corrected + blend['colorBlend'] * image
+    # The server truncates to uint8
+    return np.floor(np.clip(corrected, 0, 255))
+
+
+def request_field(client, fabric_data_url, selection, **extra):
+    response = client.post('/api/correction-field', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced',
+        'settings': {'gradientStrength': 0.7, 'brightnessPreservation': 0.8, 'colorPreservation': 0.6}, **extra,
+    })
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+@pytest.mark.parametrize('field_max_dimension', [8, 64, 1024])
+def test_field_keeps_the_image_aspect(client, fabric_data_url, selection, field_max_dimension):
+    field = request_field(client, fabric_data_url, selection, fieldMaxDimension=field_max_dimension)
+    field = field['correction']['field']
+    expected = min(field_max_dimension, 640)
+    assert (field['width'], field['height']) == (expected, expected * 3 // 4)
+    assert len(base64.b64decode(field['data'])) == field['width'] * field['height'] * 4
+
+
+def test_surface_reproduces_the_correction_map(app_module, client, fabric, fabric_data_url, selection):
+    result = request_field(client, fabric_data_url, selection)
+    analysis = app_module.pipeline.correction_analysis(result['imageId'], fabric, selection, 'advanced')
+    surface = result['correction']['surface']
+    assert result['correction']['kind'] == analysis.kind
+    h, w = analysis.correction_map.shape
+    np.testing.assert_allclose(surface_factor(surface, w, h), analysis.correction_map, atol=1e-5)
+
+
+def test_client_side_blend_matches_the_server(client, processor, fabric, fabric_data_url, selection):
+    result = request_field(client, fabric_data_url, selection)
+    assert result['blend']['correctionGain'] == pytest.approx(1.4)
+    assert result['blend']['colorBlend'] == pytest.approx(0.2)
+    client_side = apply_client_side(fabric, result['correction'], result['blend'])
+    server = processor.process_image(fabric, selection, 'advanced', 0.7, 0.8, 0.6).astype(np.float32)
+    difference = np.abs(client_side - server)
+    # Only the 64 px field's bilinear resize, where the server resizes the map bicubically, differs
+    assert difference.mean() < 0.05
+    assert difference.max() <= 1
+
+
+def test_uniform_mode_returns_target_lighting_only(client, fabric_data_url, selection):
+    result = request_field(client, fabric_data_url, selection, mode='uniform')
+    assert 'field' not in result['correction']
+    assert len(result['blend']['targetLighting']) == 3
+
+
+@pytest.mark.parametrize('field_max_dimension', [4, 2048, 64.0])
+def test_rejects_bad_field_size(client, fabric_data_url, selection, field_max_dimension):
+    response = client.post('/api/correction-field', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced', 'fieldMaxDimension': field_max_dimension,
+    })
+    assert response.status_code == 400
@@ -0,0 +1,53 @@
+"""ImageDecoder region and reduced decodes against full decodes."""
+
+import cv2
+import numpy as np
+import pytest
+
+from decoding import EncodedImage, ImageDecoder
+
+ENCODINGS = {
+    'jpeg': ('.jpg', []),
+    'progressive-jpeg': ('.jpg', [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]),
+    'png': ('.png', []),
+}
+
+
+@pytest.fixture(params=list(ENCODINGS))
+def encoded(request, fabric):
+    extension, params = ENCODINGS[request.param]
+    return cv2.imencode(extension, fabric[:, :, ::-1], params)[1].tobytes()
+
+
+@pytest.mark.parametrize('backend', ['cv2', 'pil'])
+@pytest.mark.parametrize('bounds', [(64, 72, 384, 312), (0, 0, 640, 480), (600, 400, 700, 500), (5, 0, 6, 1)])
+def test_region_matches_full_decode(encoded, backend, bounds):
+    decoder = ImageDecoder(backend)
+    full, scale = decoder.decode(encoded)
+    x1, y1, x2, y2 = bounds
+    region = decoder.decode_region(encoded, bounds)
+    np.testing.assert_array_equal(region, full[y1:y2, x1:x2])
+    assert scale == 1.0
+
+
+def test_encoded_image_slices_decode_regions(encoded):
+    decoder = ImageDecoder()
+    image = EncodedImage(encoded, decoder)
+    full = decoder.decode(encoded)[0]
+    assert image.shape == full.shape
+    np.testing.assert_array_equal(image[100:300, 50:450], full[100:300, 50:450])
+    np.testing.assert_array_equal(image[-50:, :20], full[-50:, :20])
+    with pytest.raises(TypeError):
+        image[5]
+
+
+def test_backends_agree(encoded):
+    np.testing.assert_array_equal(ImageDecoder('cv2').decode(encoded)[0], ImageDecoder('pil').decode(encoded)[0])
+
+
+@pytest.mark.parametrize('max_dimension', [64, 100, 320, 639])
+def test_reduced_jpeg_decode_stays_at_least_max_dimension(fabric, max_dimension):
+    encoded = cv2.imencode('.jpg', fabric[:, :, ::-1])[1].tobytes()
+    image, scale = ImageDecoder().decode(encoded, max_dimension)
+    assert max(image.shape[:2]) >= max_dimension
+    assert image.shape[1] == round(fabric.shape[1] * scale)
@@ -0,0 +1,67 @@
+"""Opt-in, sampled and proxy-based quality diagnostics."""
+
+import pickle
+
+import pytest
+
+from diagnostics import DiagnosticsPolicy
+from pipeline import StagedPipeline
+
+
+def test_measures_only_on_request_by_default():
+    policy = DiagnosticsPolicy()
+    assert [policy.should_measure() for _ in range(10)] == [False] * 10
+    assert policy.should_measure(requested=True)
+
+
+def test_samples_every_nth_request():
+    policy = DiagnosticsPolicy(sample_every=3)
+    assert [policy.should_measure() for _ in range(7)] == [False, False, True, False, False, True, False]
+    # Requested measurements come on top of the sample and don't shift it
+    assert policy.should_measure(requested=True)
+    assert [policy.should_measure() for _ in range(2)] == [False, True]
+
+
+def test_policy_pickles_without_its_lock():
+    policy = pickle.loads(pickle.dumps(DiagnosticsPolicy(sample_every=4, max_dimension=256)))
+    assert (policy.sample_every, policy.max_dimension) == (4, 256)
+    assert [policy.should_measure() for _ in range(4)] == [False, False, False, True]
+
+
+@pytest.mark.parametrize('max_dimension', [512, 256])
+def test_proxy_measurements_match_full_resolution(processor, fabric, selection, max_dimension):
+    corrected = processor.process_image(fabric, selection, 'advanced', 0.8, 0.8, 0.9)
+    processor.diagnostics.max_dimension = None
+    full = processor.measure_quality(fabric, corrected)
+    processor.diagnostics.max_dimension = max_dimension
+    proxy = processor.measure_quality(fabric, corrected)
+
+    assert full['measuredSize'] == {'width': 640, 'height': 480}
+    assert max(proxy['measuredSize'].values()) == max_dimension
+    assert proxy['textureRetention'] == pytest.approx(full['textureRetention'], abs=0.02)
+    assert proxy['uniformityImprovement'] == pytest.approx(full['uniformityImprovement'], abs=0.02)
+    assert proxy['finalBrightness'] == pytest.approx(full['finalBrightness'], abs=0.5)
+
+
+def test_previews_are_measured_against_the_full_resolution_original(processor, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    preview = pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'preview', 320)
+    final = pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'final')
+    processor.diagnostics.max_dimension = 320
+    measured = processor.measure_quality(fabric, preview)
+    assert measured['measuredSize'] == {'width': 320, 'height': 240}
+    assert measured['textureRetention'] == pytest.approx(
+        processor.measure_quality(fabric, final)['textureRetention'], abs=0.05)
+
+
+def test_endpoint_reports_diagnostics_on_request_or_sample(app_module, client, fabric_data_url, selection,
+                                                           monkeypatch):
+    request = {'image': fabric_data_url, 'selection': selection, 'mode': 'uniform',
+               'quality': 'preview', 'previewMaxDimension': 320}
+    assert 'diagnostics' not in client.post('/api/gradient-removal', json=request).get_json()
+    requested = client.post('/api/gradient-removal', json={**request, 'diagnostics': True}).get_json()
+    assert set(requested['diagnostics']) >= {'textureRetention', 'uniformityImprovement', 'measuredSize'}
+
+    monkeypatch.setattr(app_module.processor.diagnostics, 'sample_every', 1)
+    assert 'diagnostics' in client.post('/api/gradient-removal', json=request).get_json()
+    assert client.post('/api/gradient-removal', json={**request, 'diagnostics': 'yes'}).status_code == 400
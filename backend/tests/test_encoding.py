@@ -0,0 +1,103 @@
+"""Output format negotiation, encoder backends and presets."""
+
+import io
+import json
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from encoding import ImageEncoder, format_for_path, negotiate_format
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+
+@pytest.mark.parametrize('accept, expected', [
+    (None, 'jpeg'),
+    ('', 'jpeg'),
+    ('image/png', 'png'),
+    ('image/webp,*/*', 'jpeg'),
+    ('image/webp,*/*;q=0.8', 'webp'),
+    ('image/png;q=0.9, image/webp;q=0.5', 'png'),
+    ('text/html, image/*;q=0.5', 'jpeg'),
+    ('IMAGE/PNG', 'png'),
+    ('image/jpeg;q=0, image/*', 'webp'),
+    ('image/jpeg;q=abc, image/png;q=0.1', 'png'),
+])
+def test_negotiates_format(accept, expected):
+    assert negotiate_format(accept) == expected
+
+
+@pytest.mark.parametrize('accept', ['text/html', 'image/gif', 'image/*;q=0'])
+def test_rejects_unacceptable_accept(accept):
+    with pytest.raises(ValueError):
+        negotiate_format(accept)
+
+
+@pytest.mark.parametrize('path, expected', [('scan.PNG', 'png'), ('a/b.jpeg', 'jpeg'), ('x.webp', 'webp'),
+                                            ('x.tif', 'jpeg'), ('noext', 'jpeg')])
+def test_format_for_path(path, expected):
+    assert format_for_path(path) == expected
+
+
+@pytest.mark.parametrize('backend', ['cv2', 'pil'])
+def test_png_is_lossless(fabric, backend):
+    np.testing.assert_array_equal(decode(ImageEncoder(backend).encode(fabric, 'png')), fabric)
+
+
+@pytest.mark.parametrize('format', ['jpeg', 'webp'])
+def test_backends_decode_alike(fabric, format):
+    cv2_pixels = decode(ImageEncoder('cv2').encode(fabric, format)).astype(np.int16)
+    pil_pixels = decode(ImageEncoder('pil').encode(fabric, format)).astype(np.int16)
+    assert np.abs(cv2_pixels - pil_pixels).max() <= 1
+
+
+def test_jpeg_backends_write_the_same_bytes(fabric):
+    assert ImageEncoder('cv2').encode(fabric, 'jpeg') == ImageEncoder('pil').encode(fabric, 'jpeg')
+
+
+@pytest.mark.parametrize('format', ['jpeg', 'webp'])
+def test_preview_preset_trades_fidelity_for_size(fabric, format):
+    encoder = ImageEncoder()
+    preview, final = encoder.encode(fabric, format, 'preview'), encoder.encode(fabric, format, 'final')
+    assert len(preview) < len(final)
+    assert cv2.PSNR(decode(preview), fabric) < cv2.PSNR(decode(final), fabric)
+
+
+def test_overrides_beat_the_preset(fabric):
+    encoder = ImageEncoder()
+    assert encoder.encode(fabric, 'jpeg', 'preview', quality=95) == encoder.encode(fabric, 'jpeg', 'final')
+    full_chroma = encoder.encode(fabric, 'jpeg', 'final', subsampling='4:4:4')
+    assert full_chroma != encoder.encode(fabric, 'jpeg', 'final')
+    assert Image.open(io.BytesIO(full_chroma)).layer[0][1:3] == (1, 1)
+
+
+def test_rejects_unknown_format_and_backend(fabric):
+    with pytest.raises(ValueError):
+        ImageEncoder().encode(fabric, 'gif')
+    with pytest.raises(ValueError):
+        ImageEncoder('imageio')
+
+
+@pytest.mark.parametrize('accept, mimetype', [('image/png', 'image/png'), ('image/webp,*/*;q=0.8', 'image/webp'),
+                                              (None, 'image/jpeg')])
+def test_binary_endpoint_negotiates(client, fabric_png, selection, accept, mimetype):
+    headers = {'X-Selection': json.dumps(selection), 'X-Mode': 'uniform',
+               'X-Quality': 'preview', 'X-Preview-Max-Dimension': '160'}
+    if accept:
+        headers['Accept'] = accept
+    response = client.post('/api/gradient-removal/binary', data=fabric_png, headers=headers,
+                           content_type='image/png')
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert 'Accept' in response.headers['Vary']
+    assert Image.open(io.BytesIO(response.data)).get_format_mimetype() == mimetype
+
+
+def test_binary_endpoint_rejects_unacceptable_accept(client, fabric_png, selection):
+    response = client.post('/api/gradient-removal/binary', data=fabric_png, content_type='image/png',
+                           headers={'X-Mode': 'uniform', 'X-Selection': json.dumps(selection), 'Accept': 'image/gif'})
+    assert response.status_code == 400
@@ -0,0 +1,148 @@
+"""JobManager superseding, priorities, backpressure and cancellation, and the job API."""
+
+import threading
+
+import pytest
+
+from jobs import PRIORITY_FINAL, PRIORITY_PREVIEW, JobCancelledError, JobManager, JobQueueFullError
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(workers=1, max_pending=2)
+    yield manager
+    manager.shutdown(TIMEOUT)
+
+
+@pytest.fixture
+def busy(manager):
+    """A running job holding the only worker until release is set."""
+    started, release = threading.Event(), threading.Event()
+
+    def block(job):
+        started.set()
+        release.wait(TIMEOUT)
+        return 'blocker'
+    job = manager.submit(block, session_id='other')
+    assert started.wait(TIMEOUT)
+    yield release
+    release.set()
+    job.wait(TIMEOUT)
+
+
+def finish(*jobs):
+    for job in jobs:
+        assert job.wait(TIMEOUT)
+
+
+def test_runs_jobs(manager):
+    job = manager.submit(lambda job: 42)
+    finish(job)
+    assert (job.status, job.result) == ('succeeded', 42)
+
+
+def test_latest_job_of_a_session_wins(manager, busy):
+    first = manager.submit(lambda job: 'first', session_id='editor')
+    second = manager.submit(lambda job: 'second', session_id='editor')
+    assert first.status == 'cancelled'
+    busy.set()
+    finish(first, second)
+    assert (first.status, first.result) == ('cancelled', None)
+    assert (second.status, second.result) == ('succeeded', 'second')
+
+
+def test_preview_never_supersedes_a_final(manager, busy):
+    final = manager.submit(lambda job: 'final', session_id='editor', priority=PRIORITY_FINAL)
+    preview = manager.submit(lambda job: 'preview', session_id='editor', priority=PRIORITY_PREVIEW)
+    busy.set()
+    finish(final, preview)
+    assert final.status == preview.status == 'succeeded'
+
+
+def test_finals_run_before_previews(manager, busy):
+    order = []
+    preview = manager.submit(lambda job: order.append('preview'), session_id='a')
+    final = manager.submit(lambda job: order.append('final'), session_id='b', priority=PRIORITY_FINAL)
+    busy.set()
+    finish(preview, final)
+    assert order == ['final', 'preview']
+
+
+def test_running_job_is_cancelled_at_its_next_check(manager):
+    started, release = threading.Event(), threading.Event()
+
+    def stages(job):
+        started.set()
+        release.wait(TIMEOUT)
+        job.check_cancelled()
+        return 'stale'
+    running = manager.submit(stages, session_id='editor')
+    assert started.wait(TIMEOUT)
+    latest = manager.submit(lambda job: 'latest', session_id='editor')
+    release.set()
+    finish(running, latest)
+    assert (running.status, running.result) == ('cancelled', None)
+    assert latest.status == 'succeeded'
+
+
+def test_full_queue_rejects_without_superseding(manager, busy):
+    queued = [manager.submit(lambda job: session, session_id=session) for session in ['a', 'b']]
+    with pytest.raises(JobQueueFullError):
+        manager.submit(lambda job: 'c', session_id='c')
+    with pytest.raises(JobQueueFullError):
+        # Would supersede the running job, which a rejected submit must leave alone
+        manager.submit(lambda job: 'other', session_id='other')
+    assert [job.status for job in queued] == ['queued', 'queued']
+    assert manager.stats()['jobs']['running'] == 1
+
+    # Replacing a queued job of the same session frees its slot
+    replacement = manager.submit(lambda job: 'a2', session_id='a')
+    assert queued[0].status == 'cancelled'
+    busy.set()
+    finish(replacement, queued[1])
+    assert replacement.result == 'a2'
+
+
+def test_cancel_and_failures(manager, busy):
+    cancelled = manager.submit(lambda job: 'never', session_id='a')
+    assert manager.cancel(cancelled.id).status == 'cancelled'
+
+    def invalid(job):
+        raise ValueError('Invalid selection data')
+
+    def broken(job):
+        raise RuntimeError('boom')
+    failures = [manager.submit(invalid, session_id='b'), manager.submit(broken, session_id='c')]
+    busy.set()
+    finish(*failures)
+    assert [(job.status, job.error) for job in failures] == [
+        ('failed', 'Invalid selection data'), ('failed', 'Internal processing error')]
+    with pytest.raises(KeyError):
+        manager.get('unknown')
+
+
+def test_check_cancelled_raises_once_cancelled(manager, busy):
+    job = manager.submit(lambda job: None, session_id='a')
+    job.check_cancelled()
+    manager.cancel(job.id)
+    with pytest.raises(JobCancelledError):
+        job.check_cancelled()
+
+
+def test_job_api_round_trip(client, fabric_data_url, selection):
+    submitted = client.post('/api/jobs', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'uniform',
+        'quality': 'preview', 'previewMaxDimension': 320, 'sessionId': 'test-jobs',
+    })
+    assert submitted.status_code == 202
+    job_id = submitted.get_json()['jobId']
+
+    polled = client.get(f'/api/jobs/{job_id}?wait={TIMEOUT}').get_json()
+    assert polled['status'] == 'succeeded'
+    assert polled['imageSize'] == {'width': 320, 'height': 240}
+    assert polled['processedImage'].startswith('data:image/jpeg;base64,')
+    assert client.delete(f'/api/jobs/{job_id}').get_json()['status'] == 'succeeded'
+    assert client.get('/api/jobs/unknown').status_code == 404
+    assert client.get(f'/api/jobs/{job_id}?wait=soon').status_code == 400
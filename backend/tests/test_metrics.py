@@ -0,0 +1,94 @@
+"""Prometheus text exposition of metrics.py and /metrics."""
+
+import re
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+# A sample line: name, optional {label="value",...}, and a number
+SAMPLE_LINE = re.compile(
+    r'^[a-zA-Z_:][a-zA-Z0-9_:]*'
+    r'(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*"(,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*")*\})?'
+    r' (-?[0-9.e+-]+|\+Inf|-Inf|NaN)$'
+)
+
+
+def sample_value(text, sample):
+    """Value of the sample line starting with sample (name and labels), or None."""
+    for line in text.splitlines():
+        if line.startswith(sample + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+def test_renders_exposition_format():
+    registry = Registry()
+    requests = Counter('demo_requests_total', 'Requests.', ['endpoint', 'status'], registry=registry)
+    in_flight = Gauge('demo_in_flight', 'In flight.', registry=registry)
+    latency = Histogram('demo_seconds', 'Latency.', ['endpoint'], buckets=(0.1, 1.0), registry=registry)
+    requests.inc(endpoint='a', status=200)
+    requests.inc(2, endpoint='a', status=200)
+    in_flight.inc()
+    for value in [0.05, 0.1, 0.5, 3.0]:
+        latency.observe(value, endpoint='a')
+
+    assert registry.render() == '\n'.join([
+        '# HELP demo_requests_total Requests.',
+        '# TYPE demo_requests_total counter',
+        'demo_requests_total{endpoint="a",status="200"} 3',
+        '# HELP demo_in_flight In flight.',
+        '# TYPE demo_in_flight gauge',
+        'demo_in_flight 1',
+        '# HELP demo_seconds Latency.',
+        '# TYPE demo_seconds histogram',
+        'demo_seconds_bucket{endpoint="a",le="0.1"} 2',
+        'demo_seconds_bucket{endpoint="a",le="1"} 3',
+        'demo_seconds_bucket{endpoint="a",le="+Inf"} 4',
+        'demo_seconds_sum{endpoint="a"} 3.65',
+        'demo_seconds_count{endpoint="a"} 4',
+    ]) + '\n'
+
+
+def test_escapes_label_values_and_renders_collectors():
+    registry = Registry()
+    Counter('demo_total', 'Demo.', ['path'], registry=registry).inc(path='a"b\\c\nd')
+    registry.add_collector(lambda: [('demo_cache_bytes', 'gauge', 'Cache bytes.',
+                                     [({'cache': 'images'}, 1024), ({'cache': 'layers'}, 0.5)])])
+    lines = registry.render().splitlines()
+    assert 'demo_total{path="a\\"b\\\\c\\nd"} 1' in lines
+    assert lines[-3:] == ['# TYPE demo_cache_bytes gauge', 'demo_cache_bytes{cache="images"} 1024',
+                          'demo_cache_bytes{cache="layers"} 0.5']
+
+
+def test_rejects_wrong_labels_and_duplicate_names():
+    registry = Registry()
+    counter = Counter('demo_total', 'Demo.', ['endpoint'], registry=registry)
+    with pytest.raises(ValueError):
+        counter.inc(status=200)
+    with pytest.raises(ValueError):
+        Gauge('demo_total', 'Again.', registry=registry)
+
+
+def test_metrics_endpoint(client, fabric_data_url, selection):
+    before = client.get('/metrics').get_data(as_text=True)
+    response = client.post('/api/gradient-removal', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced',
+        'quality': 'preview', 'previewMaxDimension': 320,
+    })
+    assert response.status_code == 200
+
+    scrape = client.get('/metrics')
+    assert scrape.mimetype == 'text/plain'
+    assert scrape.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    text = scrape.get_data(as_text=True)
+    for line in text.splitlines():
+        assert line.startswith(('# HELP ', '# TYPE ')) or SAMPLE_LINE.match(line), line
+
+    requests = 'gradient_removal_http_requests_total{endpoint="process_gradient_removal",mode="advanced",status="200"}'
+    assert sample_value(text, requests) == (sample_value(before, requests) or 0) + 1
+    blends = 'gradient_removal_stage_seconds_count{stage="blend"}'
+    assert sample_value(text, blends) > (sample_value(before, blends) or 0)
+    for family in ['gradient_removal_cache_bytes', 'gradient_removal_jobs', 'gradient_removal_scratch_bytes',
+                   'gradient_removal_working_set_peak_bytes', 'gradient_removal_input_megapixels']:
+        assert f'# TYPE {family} ' in text
@@ -0,0 +1,53 @@
+"""ParallelEngine row bands against the serial path."""
+
+import cv2
+import numpy as np
+import pytest
+
+from gradient_removal import GradientRemovalProcessor
+from parallel import ParallelEngine, band_bounds
+from pipeline import StagedPipeline
+
+
+@pytest.fixture(scope='module', params=['thread', 'process'])
+def engine(request):
+    # Small bands so the 480-row fixture splits into several of them
+    engine = ParallelEngine(workers=4, kind=request.param, min_band_rows=16)
+    yield engine
+    engine.shutdown()
+
+
+@pytest.mark.parametrize('height, band_count, halo', [(480, 4, 0), (481, 4, 7), (10, 32, 3), (1, 4, 2)])
+def test_bands_cover_every_row_once(height, band_count, halo):
+    bands = band_bounds(height, band_count, halo)
+    assert [y0 for y0, *_ in bands] == [0] + [y1 for _, y1, *_ in bands[:-1]]
+    assert bands[-1][1] == height
+    for y0, y1, wy0, wy1 in bands:
+        assert (wy0, wy1) == (max(0, y0 - halo), min(height, y1 + halo))
+
+
+@pytest.mark.parametrize('ksize, sigma', [(5, 1.0), (35, 10.0), (101, 30.0)])
+def test_blur_matches_cv2(engine, fabric, ksize, sigma):
+    image = fabric.astype(np.float32)
+    np.testing.assert_array_equal(engine.gaussian_blur(image, ksize, sigma),
+                                  cv2.GaussianBlur(image, (ksize, ksize), sigma))
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+@pytest.mark.parametrize('quality', ['final', 'preview'])
+def test_pipeline_matches_serial(engine, processor, fabric, selection, mode, quality):
+    serial = StagedPipeline(processor).process('scan', fabric, selection, mode, 0.7, 0.8, 0.9, quality, 320)
+    parallel = StagedPipeline(GradientRemovalProcessor(parallel=engine)).process(
+        'scan', fabric, selection, mode, 0.7, 0.8, 0.9, quality, 320)
+    np.testing.assert_array_equal(parallel, serial)
+
+
+def test_serial_copy_drops_the_engine(engine):
+    processor = GradientRemovalProcessor(parallel=engine)
+    assert processor.serial().parallel is None
+    assert processor.parallel is engine
+
+
+def test_rejects_unknown_executor_kind():
+    with pytest.raises(ValueError):
+        ParallelEngine(kind='fiber')
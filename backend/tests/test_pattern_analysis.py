@@ -0,0 +1,69 @@
+"""PatternAnalyzer scores, FFT window sizes and cached band masks."""
+
+import numpy as np
+import pytest
+
+from pattern_analysis import PatternAnalyzer, band_weights, fast_length
+
+
+def is_smooth(n):
+    for prime in (2, 3, 5):
+        while n % prime == 0:
+            n //= prime
+    return n == 1
+
+
+def full_spectrum_score(window):
+    """Mid-band share of the whole centred spectrum, scored as before the real FFT."""
+    magnitude = np.abs(np.fft.fftshift(np.fft.fft2(window)))
+    h, w = window.shape
+    y, x = np.ogrid[:h, :w]
+    radius = np.sqrt((y - h // 2) ** 2 + (x - w // 2) ** 2)
+    size = min(h, w)
+    ring = (radius > size * 0.1) & (radius <= size * 0.4)
+    return min(magnitude[ring].sum() / magnitude.sum() * 10, 1.0)
+
+
+def test_fast_length_is_the_largest_smooth_size():
+    for n in range(1, 3000):
+        length = fast_length(n)
+        assert length <= n and is_smooth(length)
+        assert not any(is_smooth(m) for m in range(length + 1, n + 1))
+
+
+@pytest.mark.parametrize('shape', [(64, 64), (60, 90), (75, 48), (81, 81)])
+def test_half_spectrum_matches_full_spectrum(shape):
+    window = np.random.default_rng(1).normal(size=shape) + np.sin(np.arange(shape[1]) * 1.7)
+    analyzer = PatternAnalyzer(max_window=max(shape), max_windows=1)
+    assert analyzer.strength(window) == pytest.approx(full_spectrum_score(window))
+
+
+def test_band_masks_are_cached_read_only():
+    band_weights.cache_clear()
+    first = band_weights(96, 128)
+    assert band_weights(96, 128) is first
+    assert band_weights.cache_info().hits == 1
+    with pytest.raises(ValueError):
+        first[0][0, 0] = 1.0
+
+
+@pytest.mark.parametrize('shape', [(2000, 3000), (300, 4000), (100, 100), (7, 500)])
+def test_windows_are_sampled_at_fft_sizes(shape):
+    analyzer = PatternAnalyzer()
+    windows = list(analyzer.windows(np.zeros(shape, np.float32)))
+    assert 1 <= len(windows) <= analyzer.max_windows
+    for window in windows:
+        assert max(window.shape) <= analyzer.max_window
+        assert all(is_smooth(n) for n in window.shape)
+
+
+@pytest.mark.parametrize('period, expected', [(4, 1.0), (8, 1.0), (64, 0.0), (128, 0.0)])
+def test_scores_weave_periods_only(period, expected):
+    # Stripes that repeat exactly within the 384 x 512 windows, so all their energy sits in one bin
+    x = np.arange(640, dtype=np.float32)
+    stripes = np.broadcast_to(np.sin(2 * np.pi * x / period), (480, 640))
+    assert PatternAnalyzer().strength(stripes) == pytest.approx(expected, abs=0.01)
+
+
+def test_flat_component_scores_zero():
+    assert PatternAnalyzer().strength(np.zeros((64, 64))) == 0.0
@@ -0,0 +1,78 @@
+"""StagedPipeline stage caching across slider changes."""
+
+import numpy as np
+import pytest
+
+from pipeline import StagedPipeline
+
+
+@pytest.fixture
+def calls(processor, monkeypatch):
+    """Calls to the processor's analysis and decomposition stages, counted by name."""
+    calls = {'analyze_correction': 0, 'decompose_image': 0, 'prepare_correction_field': 0}
+    for name in calls:
+        stage = getattr(processor, name)
+
+        def counting(*args, _name=name, _stage=stage, **kwargs):
+            calls[_name] += 1
+            return _stage(*args, **kwargs)
+        monkeypatch.setattr(processor, name, counting)
+    return calls
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+def test_matches_one_shot_processing(processor, fabric, selection, mode):
+    pipeline = StagedPipeline(processor)
+    for strength in [0.5, 0.9]:
+        staged = pipeline.process('scan', fabric, selection, mode, strength, 0.8, 0.9)
+        expected = processor.process_image(fabric, selection, mode, strength, 0.8, 0.9)
+        np.testing.assert_array_equal(staged, expected)
+
+
+def test_slider_changes_reuse_stages(processor, calls, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.5, 0.8, 0.9)
+    assert calls == {'analyze_correction': 1, 'decompose_image': 1, 'prepare_correction_field': 1}
+
+    for strength, brightness, color in [(0.9, 0.8, 0.9), (0.9, 0.3, 0.9), (0.9, 0.3, 0.1)]:
+        pipeline.process('scan', fabric, selection, 'advanced', strength, brightness, color)
+    assert calls == {'analyze_correction': 1, 'decompose_image': 1, 'prepare_correction_field': 1}
+    assert pipeline.stats()['layers']['hits'] == 3
+
+
+def test_new_selection_reanalyzes_on_cached_layers(processor, calls, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.5, 0.8, 0.9)
+    moved = dict(selection, left=0.3)
+    pipeline.process('scan', fabric, moved, 'advanced', 0.5, 0.8, 0.9)
+    assert calls == {'analyze_correction': 2, 'decompose_image': 1, 'prepare_correction_field': 2}
+
+
+def test_images_are_cached_separately(processor, calls, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    pipeline.process('scan', fabric, selection, 'uniform', 0.5, 0.8, 0.9)
+    darker = (fabric * 0.8).astype(np.uint8)
+    result = pipeline.process('other', darker, selection, 'uniform', 0.5, 0.8, 0.9)
+    assert calls['decompose_image'] == 2
+    np.testing.assert_array_equal(result, processor.process_image(darker, selection, 'uniform', 0.5, 0.8, 0.9))
+
+
+def test_invalidate_drops_every_stage(processor, calls, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.5, 0.8, 0.9)
+    pipeline.process('other', fabric, selection, 'advanced', 0.5, 0.8, 0.9)
+    pipeline.invalidate('scan')
+    stats = pipeline.stats()
+    assert [stats[stage]['entries'] for stage in ['layers', 'correctionFields', 'analyses']] == [1, 1, 1]
+
+    pipeline.process('scan', fabric, selection, 'advanced', 0.5, 0.8, 0.9)
+    assert calls == {'analyze_correction': 3, 'decompose_image': 3, 'prepare_correction_field': 3}
+
+
+def test_layer_budget_evicts_least_recently_used(processor, fabric, selection):
+    layer_bytes = StagedPipeline(processor).layers('probe', fabric, 'uniform').nbytes
+    pipeline = StagedPipeline(processor, max_layer_bytes=int(layer_bytes * 1.5))
+    pipeline.process('scan', fabric, selection, 'uniform', 0.5, 0.8, 0.9)
+    pipeline.process('other', fabric, selection, 'uniform', 0.5, 0.8, 0.9)
+    assert pipeline.stats()['layers']['entries'] == 1
+    assert pipeline.stats()['layers']['bytes'] <= int(layer_bytes * 1.5)
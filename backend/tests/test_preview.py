@@ -0,0 +1,80 @@
+"""Preview quality: a downscaled proxy with the full-resolution analysis."""
+
+import cv2
+import numpy as np
+import pytest
+
+from decoding import EncodedImage
+from pipeline import StagedPipeline
+
+
+def area_resize(image, shape):
+    return cv2.resize(image, (shape[1], shape[0]), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+def test_preview_matches_downscaled_final(processor, fabric, selection, mode):
+    pipeline = StagedPipeline(processor)
+    final = pipeline.process('scan', fabric, selection, mode, 0.8, 0.8, 0.9, 'final')
+    preview = pipeline.process('scan', fabric, selection, mode, 0.8, 0.8, 0.9, 'preview', 320)
+
+    assert final.shape == fabric.shape
+    assert preview.shape == (240, 320, 3)
+    downscaled_final = area_resize(final, preview.shape)
+    difference = np.abs(preview - downscaled_final).mean()
+    # The correction moves pixels by several levels on average; the preview is within one of the final
+    assert difference < 1.0
+    assert difference < 0.25 * np.abs(area_resize(fabric, preview.shape) - downscaled_final).mean()
+
+
+def test_previews_share_the_full_resolution_analysis(processor, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'preview', 320)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'preview', 160)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'final')
+    stats = pipeline.stats()
+    assert stats['analyses']['entries'] == 1
+    assert stats['layers']['entries'] == stats['correctionFields']['entries'] == 3
+
+
+def test_small_images_preview_at_full_resolution(processor, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    preview = pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'preview', 1280)
+    final = pipeline.process('scan', fabric, selection, 'advanced', 0.8, 0.8, 0.9, 'final')
+    np.testing.assert_array_equal(preview, final)
+
+
+def test_encoded_upload_previews_without_full_decode(processor, fabric, selection, monkeypatch):
+    jpeg = cv2.imencode('.jpg', fabric[:, :, ::-1], [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+    image = EncodedImage(jpeg, processor.decoder)
+    full_decodes = []
+    decode = image.decode
+
+    def counting_decode(max_dimension=None):
+        if max_dimension is None:
+            full_decodes.append(max_dimension)
+        return decode(max_dimension)
+    monkeypatch.setattr(image, 'decode', counting_decode)
+
+    preview = StagedPipeline(processor).process('scan', image, selection, 'uniform', 0.8, 0.8, 0.9, 'preview', 160)
+    assert preview.shape == (120, 160, 3)
+    assert full_decodes == []
+
+
+def test_endpoint_previews(client, fabric_data_url, selection):
+    response = client.post('/api/gradient-removal', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced',
+        'quality': 'preview', 'previewMaxDimension': 320,
+    })
+    assert response.status_code == 200
+    assert response.get_json()['imageSize'] == {'width': 320, 'height': 240}
+    assert response.get_json()['quality'] == 'preview'
+
+
+@pytest.mark.parametrize('data', [{'quality': 'draft'}, {'quality': 'preview', 'previewMaxDimension': 32},
+                                  {'quality': 'preview', 'previewMaxDimension': 320.5}])
+def test_endpoint_rejects_bad_preview_params(client, fabric_data_url, selection, data):
+    response = client.post('/api/gradient-removal', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced', **data,
+    })
+    assert response.status_code == 400
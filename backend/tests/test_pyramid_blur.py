@@ -0,0 +1,63 @@
+"""pyramid_blur against the exact blur, for the figures documented in the README."""
+
+import numpy as np
+import pytest
+
+from gradient_removal import GradientRemovalProcessor, gaussian_blur, pyramid_factor
+
+# The lighting blurs that switch to pyramid_blur
+LIGHTING_KERNELS = [(35, 7.0), (31, 8.0), (25, 5.0)]
+
+
+def line_response(h, ksize, sigma, mode):
+    """The blur as an h x h matrix acting on columns: response to a unit row at each y."""
+    w = 8 * (ksize // 2) + 8
+    matrix = np.zeros((h, h))
+    for y in range(h):
+        image = np.zeros((h, w), np.float32)
+        image[y] = 1
+        matrix[:, y] = gaussian_blur(image, ksize, sigma, mode=mode)[:, w // 2]
+    return matrix
+
+
+@pytest.mark.parametrize('ksize,sigma,bound', [(35, 7.0, 0.19), (31, 8.0, 0.22), (25, 5.0, 0.13)])
+def test_kernel_difference_bound(ksize, sigma, bound):
+    # Both blurs are separable and linear, so the 2D kernel of an output pixel is an outer
+    # product of matrix rows; its L1 distance to the exact kernel bounds the error per unit
+    # of input contrast
+    h = 8 * (ksize // 2) + 8
+    factor = pyramid_factor(ksize, sigma, (h, h))
+    pyramid, exact = line_response(h, ksize, sigma, 'pyramid'), line_response(h, ksize, sigma, 'exact')
+    rows = range(h // 2, h // 2 + factor)
+    distance = max(
+        np.abs(np.outer(pyramid[y], pyramid[x]) - np.outer(exact[y], exact[x])).sum()
+        for y in rows for x in rows
+    )
+    # Edge bands are blurred exactly
+    assert np.abs(pyramid[:ksize // 2] - exact[:ksize // 2]).max() < 1e-6
+    assert bound - 0.01 < distance <= bound
+
+
+@pytest.fixture(scope='module')
+def noise():
+    return np.random.default_rng(1).integers(0, 256, (2000, 3000, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('ksize,sigma', LIGHTING_KERNELS)
+def test_uniform_noise_blurs(noise, ksize, sigma):
+    difference = gaussian_blur(noise, ksize, sigma, mode='pyramid').astype(int) - gaussian_blur(noise, ksize, sigma)
+    assert np.abs(difference).max() <= 4
+
+    values = noise.astype(np.float32)
+    difference = gaussian_blur(values, ksize, sigma, mode='pyramid') - gaussian_blur(values, ksize, sigma)
+    assert np.abs(difference).max() <= 2.7
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+def test_uniform_noise_corrected_output(noise, mode):
+    selection = {'left': 0.1, 'top': 0.1, 'width': 0.3, 'height': 0.3}
+    results = [
+        GradientRemovalProcessor(blur_mode=blur_mode).process_image(noise, selection, mode, 0.5, 0.8, 0.9)
+        for blur_mode in ['exact', 'pyramid']
+    ]
+    assert np.abs(results[1].astype(int) - results[0]).max() <= 1
@@ -0,0 +1,51 @@
+"""RegionStats means, and uniform-mode region means against the full-resolution blurred ones."""
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmark import synthetic_fabric
+from gradient_removal import UNIFORM_STATS_DIMENSION
+from region_stats import RegionStats
+
+# Edge quarters and center of a selection, as (left, top, right, bottom) fractions
+REGIONS = [(0.0, 0.0, 0.25, 1.0), (0.75, 0.0, 1.0, 1.0), (0.0, 0.0, 1.0, 0.25),
+           (0.0, 0.75, 1.0, 1.0), (0.25, 0.25, 0.75, 0.75)]
+
+# Lightness levels (0-255) the proxy means may differ from the blurred full-resolution ones
+MEAN_TOLERANCE = 0.25
+
+
+def baseline_means(area):
+    """Region means as uniform analysis took them before RegionStats: over a 21x21 blur at full resolution."""
+    lightness = cv2.cvtColor(area, cv2.COLOR_RGB2LAB)[:, :, 0].astype(np.float32)
+    blurred = cv2.GaussianBlur(lightness, (21, 21), 5.0)
+    h, w = blurred.shape
+    return [blurred[:, :w // 4].mean(), blurred[:, -(w // 4):].mean(), blurred[:h // 4].mean(),
+            blurred[-(h // 4):].mean(), blurred[h // 4:-(h // 4), w // 4:-(w // 4)].mean()]
+
+
+def test_mean_matches_numpy():
+    values = np.random.default_rng(0).random((37, 53), dtype=np.float32) * 255
+    stats = RegionStats(values)
+    assert stats.mean() == pytest.approx(values.mean(dtype=np.float64))
+    assert stats.mean(5, 3, 20, 30) == pytest.approx(values[3:30, 5:20].mean(dtype=np.float64))
+    assert stats.fraction_mean(0.5, 0.0, 1.0, 0.5) == pytest.approx(
+        stats.mean(26.5, 0, 53, 18.5))
+
+
+def test_narrow_source_never_gives_empty_regions():
+    stats = RegionStats.from_lightness(np.full((2, 300, 3), 128, np.uint8), UNIFORM_STATS_DIMENSION)
+    for region in REGIONS:
+        assert np.isfinite(stats.fraction_mean(*region))
+
+
+@pytest.mark.parametrize('pattern', ['plaid', 'twill', 'solid'])
+@pytest.mark.parametrize('gradient', ['linear', 'vignette'])
+@pytest.mark.parametrize('shape', [(600, 800), (1200, 1600), (40, 1200), (100, 100)])
+def test_proxy_means_match_blurred_means(pattern, gradient, shape):
+    h, w = shape
+    area = synthetic_fabric(h + 100, w + 100, pattern=pattern, gradient=gradient)[0][50:50 + h, 50:50 + w]
+    stats = RegionStats.from_lightness(area, UNIFORM_STATS_DIMENSION)
+    means = [stats.fraction_mean(*region) for region in REGIONS]
+    np.testing.assert_allclose(means, baseline_means(area), atol=MEAN_TOLERANCE)
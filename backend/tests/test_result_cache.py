@@ -0,0 +1,106 @@
+"""ResultCache keys, entries, eviction and invalidation, and its use by the endpoints."""
+
+import os
+import time
+
+import pytest
+
+import gradient_removal
+from result_cache import STALE_TEMP_SECONDS, ResultCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / 'results'), max_bytes=10_000)
+
+
+def test_key_ignores_dict_order_only():
+    selection = {'left': 0.1, 'top': 0.2, 'width': 0.5, 'height': 0.5}
+    key = ResultCache.key('image', selection, 'advanced', 0.5)
+    assert key == ResultCache.key('image', dict(reversed(list(selection.items()))), 'advanced', 0.5)
+    assert key != ResultCache.key('image', selection, 'uniform', 0.5)
+    assert key != ResultCache.key('image', selection, 'advanced', 0.6)
+    assert key != ResultCache.key('image', selection, 0.5, 'advanced')
+
+
+def test_round_trip_and_misses(cache):
+    key = ResultCache.key('a')
+    assert cache.get(key) is None
+    cache.put(key, b'\x00jpeg\nbytes', {'width': 4, 'height': 3})
+    data, metadata = cache.get(key)
+    assert data == b'\x00jpeg\nbytes'
+    assert metadata == {'width': 4, 'height': 3, 'bytes': 11}
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    assert cache.stats()['entries'] == 1
+
+
+def test_entries_are_shared_between_instances(cache):
+    key = ResultCache.key('shared')
+    cache.put(key, b'result')
+    other = ResultCache(cache.directory, cache.max_bytes)
+    assert other.get(key)[0] == b'result'
+    assert other.stats()['entries'] == 1
+
+
+def test_corrupt_entries_are_dropped(cache):
+    key = ResultCache.key('truncated')
+    cache.put(key, b'0123456789')
+    path = cache._path(key)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert cache.get(key) is None
+    assert not os.path.exists(path)
+
+
+def test_evicts_least_recently_used(cache):
+    keys = [ResultCache.key(i) for i in range(4)]
+    now = time.time()
+    for age, key in zip([40, 30, 20, 10], keys):
+        cache.put(key, b'x' * 2000)
+        os.utime(cache._path(key), (now - age, now - age))
+    # A hit makes the oldest entry the most recently used
+    assert cache.get(keys[0]) is not None
+
+    cache.put(ResultCache.key('big'), b'x' * 4000)
+    assert cache.stats()['bytes'] <= 0.9 * cache.max_bytes
+    assert [cache.get(key) is not None for key in keys] == [True, False, False, True]
+
+
+def test_eviction_removes_stale_temp_files(cache):
+    cache.put(ResultCache.key('a'), b'data')
+    shard = os.path.dirname(cache._path(ResultCache.key('a')))
+    stale, fresh = os.path.join(shard, 'stale.1.2.tmp'), os.path.join(shard, 'fresh.1.2.tmp')
+    for path in (stale, fresh):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+    old = time.time() - STALE_TEMP_SECONDS - 1
+    os.utime(stale, (old, old))
+    cache.evict()
+    assert not os.path.exists(stale) and os.path.exists(fresh)
+    assert cache.stats()['entries'] == 1
+
+
+def test_endpoint_serves_hits_and_invalidates_on_version(app_module, client, fabric_data_url, selection,
+                                                          tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'result_cache', ResultCache(str(tmp_path / 'endpoint')))
+    request = {'image': fabric_data_url, 'selection': selection, 'mode': 'uniform',
+               'quality': 'preview', 'previewMaxDimension': 160}
+
+    def process(**changes):
+        response = client.post('/api/gradient-removal', json={**request, **changes})
+        assert response.status_code == 200
+        return response.get_json()
+
+    first = process()
+    assert 'peakWorkingSetBytes' in first
+    hit = process()
+    assert 'peakWorkingSetBytes' not in hit
+    assert hit['processedImage'] == first['processedImage']
+    assert app_module.result_cache.stats()['hits'] == 1
+
+    process(settings={'gradientStrength': 0.9})
+    process(format='png')
+    monkeypatch.setattr(gradient_removal, 'ALGORITHM_VERSION', gradient_removal.ALGORITHM_VERSION + 1)
+    process()
+    stats = app_module.result_cache.stats()
+    assert (stats['hits'], stats['entries']) == (1, 4)
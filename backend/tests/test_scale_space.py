@@ -0,0 +1,67 @@
+"""ScaleSpace: each level computed once, and safe to share between threads."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from gradient_removal import ImageLayers, ScaleSpace, gaussian_blur
+
+LEVELS = [(5, 1.0), (15, 3.0), (25, 5.0), (35, 7.0)]
+
+
+def test_levels_match_direct_blurs_and_are_computed_once(fabric, monkeypatch):
+    image = fabric.astype(np.float32)
+    levels = ScaleSpace(image)
+    calls = []
+    compute = levels._compute
+    monkeypatch.setattr(levels, '_compute', lambda *key: calls.append(key) or compute(*key))
+    for ksize, sigma in LEVELS + LEVELS:
+        np.testing.assert_array_equal(levels.level(ksize, sigma), gaussian_blur(image, ksize, sigma))
+    assert calls == LEVELS
+
+
+@pytest.mark.parametrize('cascade', [False, True])
+def test_concurrent_levels_and_release(fabric, cascade):
+    image = fabric[:160, :200].astype(np.float32)
+    levels = ScaleSpace(image, cascade=cascade)
+    expected = {key: ScaleSpace(image, cascade=cascade) for key in LEVELS}
+    expected = {key: space.level(*key) for key, space in expected.items()}
+    stop = threading.Event()
+    errors = []
+
+    def release():
+        try:
+            while not stop.is_set():
+                levels.release(keep=[(35, 7.0)])
+                assert levels.nbytes >= 0
+        except Exception as e:
+            errors.append(e)
+
+    def read(n):
+        key = LEVELS[n % len(LEVELS)]
+        level = levels.level(*key)
+        if not cascade:
+            np.testing.assert_array_equal(level, expected[key])
+        return level.shape
+
+    releaser = threading.Thread(target=release)
+    releaser.start()
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            shapes = list(executor.map(read, range(400)))
+    finally:
+        stop.set()
+        releaser.join()
+    assert not errors
+    assert set(shapes) == {image.shape}
+
+
+def test_shared_layers_build_each_texture_once(fabric):
+    layers = ImageLayers(fabric)
+    with ThreadPoolExecutor(4) as executor:
+        textures = list(executor.map(lambda n: layers.texture(['uniform', 'advanced'][n % 2]), range(8)))
+    layers.compact()
+    assert all(t is layers.texture('uniform') for t in textures[::2])
+    assert all(t is layers.texture('advanced') for t in textures[1::2])
@@ -0,0 +1,82 @@
+"""PolynomialSurface against the explicit design-matrix solvers it replaced."""
+
+import numpy as np
+import pytest
+
+from surface_fit import PolynomialSurface
+
+
+def lighting(h, w, seed=0):
+    """A smooth lighting falloff with sensor noise, like a blurred lighting component."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    u, v = (x - w / 2) / w, (y - h / 2) / h
+    surface = 140 + 25 * u - 12 * v - 30 * u * u - 18 * v * v + 9 * u * v
+    return (surface + rng.normal(0, 3, (h, w))).astype(np.float32)
+
+
+def design_matrix(h, w, degree, step=1):
+    """Explicit N x terms matrix in the same normalised coordinates and term order as PolynomialSurface."""
+    ys, xs = np.arange(0, h, step), np.arange(0, w, step)
+    u = (xs - (w - 1) / 2) / max((w - 1) / 2, 1)
+    v = (ys - (h - 1) / 2) / max((h - 1) / 2, 1)
+    vv, uu = np.meshgrid(v, u, indexing='ij')
+    return np.column_stack([uu.ravel() ** a * vv.ravel() ** b for a, b in PolynomialSurface.terms(degree)])
+
+
+def coefficient_vector(surface):
+    return np.array([surface.coefficients[b, a] for a, b in PolynomialSurface.terms(surface.degree)])
+
+
+@pytest.mark.parametrize('shape', [(97, 131), (240, 320), (5, 50)])
+def test_linear_fit_matches_lstsq(shape):
+    values = lighting(*shape)
+    surface = PolynomialSurface.fit(values, degree=1)
+    a = design_matrix(*shape, degree=1)
+    expected = np.linalg.lstsq(a, values.ravel().astype(np.float64), rcond=None)[0]
+
+    np.testing.assert_allclose(coefficient_vector(surface), expected, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(surface.evaluate(), (a @ expected).reshape(shape), atol=1e-3)
+
+
+@pytest.mark.parametrize('step', [1, 3])
+def test_quadratic_fit_matches_normal_equations(step):
+    values = lighting(150, 210)
+    surface = PolynomialSurface.fit(values, degree=2, step=step, regularization=1e-6)
+    a = design_matrix(150, 210, degree=2, step=step)
+    z = values[::step, ::step].ravel().astype(np.float64)
+    expected = np.linalg.solve(a.T @ a + 1e-6 * np.eye(a.shape[1]), a.T @ z)
+
+    np.testing.assert_allclose(coefficient_vector(surface), expected, rtol=1e-8, atol=1e-8)
+    residual = z - a @ expected
+    assert surface.rms_residual == pytest.approx(np.sqrt(np.mean(residual ** 2)), rel=1e-6)
+    assert surface.samples == len(z)
+
+
+def test_maps_match_previous_pixel_coordinate_solvers():
+    # The solvers before PolynomialSurface fitted in raw pixel coordinates: lstsq for the
+    # gentle (linear) surface and ridge normal equations with 1e-6 for the quadratic one
+    h, w = 180, 260
+    values = lighting(h, w)
+    y, x = np.mgrid[0:h, 0:w].astype(np.float64)
+    x, y, z = x.ravel(), y.ravel(), values.ravel().astype(np.float64)
+
+    a = np.column_stack([x, y, np.ones_like(x)])
+    linear = (a @ np.linalg.lstsq(a, z, rcond=None)[0]).reshape(h, w)
+    np.testing.assert_allclose(PolynomialSurface.fit(values, degree=1).evaluate(), linear, atol=1e-3)
+
+    a = np.column_stack([x ** 2, y ** 2, x * y, x, y, np.ones_like(x)])
+    quadratic = (a @ np.linalg.solve(a.T @ a + 1e-6 * np.eye(6), a.T @ z)).reshape(h, w)
+    surface = PolynomialSurface.fit(values, degree=2, regularization=1e-6)
+    np.testing.assert_allclose(surface.evaluate(), quadratic, atol=1e-2)
+
+
+def test_mean_matches_evaluated_map():
+    surface = PolynomialSurface.fit(lighting(123, 77), degree=3)
+    assert surface.mean() == pytest.approx(float(surface.evaluate(np.float64).mean()), rel=1e-12)
+
+
+def test_singular_system_raises():
+    # A single row cannot determine the y terms; callers fall back to a flat surface
+    with pytest.raises(np.linalg.LinAlgError):
+        PolynomialSurface.fit(lighting(1, 50), degree=1)
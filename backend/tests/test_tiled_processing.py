@@ -0,0 +1,53 @@
+"""TiledCorrectionEngine against the untiled correction and its memory budget."""
+
+import numpy as np
+import pytest
+
+from gradient_removal import GradientRemovalProcessor
+from parallel import ParallelEngine
+from tiled_processing import BYTES_PER_PIXEL, IMAGE_HALO, MIN_TILE_SIZE, TiledCorrectionEngine
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+@pytest.mark.parametrize('strengths', [(0.5, 0.8, 0.9), (1.0, 0.9, 0.0), (0.3, 0.0, 0.6)])
+def test_tiled_matches_untiled(processor, fabric, selection, mode, strengths):
+    # 4 MB leaves tiles of ~150 px, so the scan splits into a grid with halos on every side
+    engine = TiledCorrectionEngine(processor, memory_budget_bytes=4 * 1024**2)
+    assert len(list(engine.tiles(fabric.shape))) >= 6
+
+    correction_map = processor.analyze_gradient(processor.extract_selection_area(fabric, selection), mode)
+    expected = processor.apply_gradient_correction(fabric, selection, correction_map, mode, *strengths)
+    tiled = engine.apply(fabric, correction_map, mode, *strengths)
+    assert np.abs(np.asarray(tiled).astype(int) - expected).max() <= 1
+
+
+@pytest.mark.parametrize('budget', [4 * 1024**2, 32 * 1024**2, 512 * 1024**2])
+@pytest.mark.parametrize('shape', [(20000, 20000), (40000, 3000)])
+def test_tile_size_follows_budget(processor, budget, shape):
+    engine = TiledCorrectionEngine(processor, memory_budget_bytes=budget)
+    tile_h, tile_w = engine.tile_shape(shape)
+    assert tile_h >= MIN_TILE_SIZE and tile_w >= MIN_TILE_SIZE
+    window_pixels = (tile_h + 2 * IMAGE_HALO) * (tile_w + 2 * IMAGE_HALO)
+    assert window_pixels * BYTES_PER_PIXEL <= budget
+    # Most of the budget is used, so tiles aren't needlessly small
+    assert window_pixels * BYTES_PER_PIXEL > budget / 2
+
+
+def test_tiles_cover_image_once(processor):
+    engine = TiledCorrectionEngine(processor, memory_budget_bytes=4 * 1024**2)
+    covered = np.zeros((1000, 1300), dtype=int)
+    for y0, y1, x0, x1 in engine.tiles(covered.shape):
+        covered[y0:y1, x0:x1] += 1
+    assert (covered == 1).all()
+
+
+def test_concurrent_tiles_share_budget(fabric, selection):
+    processor = GradientRemovalProcessor(parallel=ParallelEngine(workers=4, kind='thread'))
+    engine = TiledCorrectionEngine(processor, memory_budget_bytes=16 * 1024**2)
+    tile_h, tile_w = engine.tile_shape((20000, 20000))
+    assert 4 * (tile_h + 2 * IMAGE_HALO) * (tile_w + 2 * IMAGE_HALO) * BYTES_PER_PIXEL <= 16 * 1024**2
+
+    correction_map = processor.analyze_gradient(processor.extract_selection_area(fabric, selection), 'advanced')
+    expected = processor.apply_gradient_correction(fabric, selection, correction_map, 'advanced', 0.5, 0.8, 0.9)
+    tiled = engine.apply(fabric, correction_map, 'advanced', 0.5, 0.8, 0.9)
+    assert np.abs(np.asarray(tiled).astype(int) - expected).max() <= 1
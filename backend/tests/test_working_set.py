@@ -0,0 +1,57 @@
+"""Per-request peak working set reported by StagedPipeline.process."""
+
+import tracemalloc
+
+import pytest
+
+from buffers import WorkingSet
+from metrics import WORKING_SET_BYTES
+from pipeline import StagedPipeline
+
+
+def observations():
+    return sum(value for suffix, _, value in WORKING_SET_BYTES.samples() if suffix == '_count')
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'advanced'])
+@pytest.mark.parametrize('quality', ['final', 'preview'])
+def test_peak_matches_allocations(processor, fabric, selection, mode, quality):
+    # Warm up the scratch pool and cv2 so only the request's own arrays are traced
+    StagedPipeline(processor).process('warm', fabric, selection, mode, 0.5, 0.8, 0.9, quality, 200)
+    pipeline = StagedPipeline(processor)
+    working_set = WorkingSet()
+    tracemalloc.start()
+    try:
+        pipeline.process('scan', fabric, selection, mode, 0.5, 0.8, 0.9, quality, 200, working_set=working_set)
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # Previews also count the upload, which was allocated before tracing started
+    assert 0.75 * traced_peak <= working_set.peak <= 1.25 * traced_peak
+
+
+def test_cached_layers_are_counted(processor, fabric, selection):
+    pipeline = StagedPipeline(processor)
+    first, second = WorkingSet(), WorkingSet()
+    pipeline.process('scan', fabric, selection, 'advanced', 0.5, 0.8, 0.9, working_set=first)
+    pipeline.process('scan', fabric, selection, 'advanced', 0.9, 0.8, 0.9, working_set=second)
+
+    layers = pipeline.layers('scan', fabric, 'advanced')
+    h, w = fabric.shape[:2]
+    # Layers, the single-channel float32 correction field and the uint8 result
+    held = layers.image.nbytes + layers.nbytes + h * w * 4 + fabric.nbytes
+    assert held <= second.peak < first.peak
+
+
+def test_peak_is_recorded(processor, fabric, selection):
+    before = observations()
+    StagedPipeline(processor).process('scan', fabric, selection, 'uniform', 0.5, 0.8, 0.9)
+    assert observations() == before + 1
+
+
+def test_peak_is_returned_by_the_api(client, fabric_data_url, selection):
+    response = client.post('/api/gradient-removal', json={
+        'image': fabric_data_url, 'selection': selection, 'mode': 'advanced', 'quality': 'preview',
+    })
+    assert response.status_code == 200
+    assert response.get_json()['peakWorkingSetBytes'] > 0
@@ -0,0 +1,368 @@
+"""
+Out-of-core tiled execution of the gradient correction.
+
+Very large scans (e.g. 20k x 20k at 600 dpi) don't fit the in-memory path,
+which keeps several full-size float32 copies of the image. The tiled engine
+processes overlapping tiles whose halo covers the largest blur kernel, so
+every output pixel sees exactly the same neighbourhood as in the untiled
+path. Global statistics (mean brightness, uniform-mode median) are gathered
+in a first pass while the composed tiles are spilled to a memory-mapped
+scratch file; the second pass applies the global blends and writes the
+memory-mapped uint8 output. Peak memory is set by the budget, not the image.
+"""
+
+import math
+import os
+import tempfile
+import logging
+import numpy as np
+from PIL import Image
+from metrics import timed_stage
+
+logger = logging.getLogger(__name__)
+
+# Largest blur radius in the decomposition (35x35 base lighting) and in the
+# correction field smoothing (25x25)
+IMAGE_HALO = 35 // 2
+CORRECTION_HALO = 25 // 2
+
+# Rough float32 working set per window pixel during pass one: the float image,
+# base lighting, texture, two blur temporaries, the composed result and the
+# correction field (all 3-channel except the last)
+BYTES_PER_PIXEL = 96
+
+MIN_TILE_SIZE = 64
+MEDIAN_BINS = 65536
+
+
+def cubic_resize_weights(out_start, out_stop, out_size, in_size):
+    """Source indices and weights of cv2.resize INTER_CUBIC for output rows/cols [out_start, out_stop).
+
+    Lets a tile of a resized map be computed without resizing the whole map.
+    """
+    a = -0.75  # OpenCV's bicubic coefficient
+    scale = in_size / out_size
+    f = ((np.arange(out_start, out_stop) + 0.5) * scale - 0.5).astype(np.float32).astype(np.float64)
+    s = np.floor(f)
+    t = f - s
+    w0 = ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a
+    w1 = ((a + 2) * t - (a + 3)) * t * t + 1
+    w2 = ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1
+    w3 = 1 - w0 - w1 - w2
+    indices = np.clip(s.astype(np.int64)[:, None] + np.arange(-1, 3)[None, :], 0, in_size - 1)
+    return indices, np.stack([w0, w1, w2, w3], axis=1)
+
+
+def resize_cubic_region(correction_map, out_shape, y0, y1, x0, x1):
+    """Region [y0:y1, x0:x1] of cv2.resize(correction_map, out_shape, INTER_CUBIC)."""
+    h, w = out_shape[:2]
+    map_h, map_w = correction_map.shape
+    iy, wy = cubic_resize_weights(y0, y1, h, map_h)
+    ix, wx = cubic_resize_weights(x0, x1, w, map_w)
+
+    # Interpolate rows first, restricted to the map columns this region needs
+    col_lo, col_hi = ix.min(), ix.max() + 1
+    rows = correction_map[:, col_lo:col_hi].astype(np.float64)
+    tmp = np.einsum('yk,ykx->yx', wy, rows[iy])
+    region = np.einsum('xk,yxk->yx', wx, tmp[:, ix - col_lo])
+    return region.astype(np.float32)
+
+
+def open_source(path):
+    """Open an image for tiled reading.
+
+    .npy files are memory-mapped and read lazily. Other formats are decoded once
+    by PIL into a memory-mapped scratch file, so only the 8-bit decode is held
+    in memory, never the float working copies.
+    """
+    if os.path.splitext(path)[1].lower() == '.npy':
+        source = np.load(path, mmap_mode='r')
+        if source.ndim != 3 or source.shape[2] != 3 or source.dtype != np.uint8:
+            raise ValueError(f"Expected an HxWx3 uint8 array in {path}, got {source.shape} {source.dtype}")
+        return source
+
+    with Image.open(path) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        w, h = image.size
+        source = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(h, w, 3))
+        strip = max(1, (64 * 1024**2) // (w * 3))
+        for y in range(0, h, strip):
+            source[y:y + strip] = np.asarray(image.crop((0, y, w, min(h, y + strip))))
+    return source
+
+
+def memmap_spec(array):
+    """(filename, dtype, offset, shape) to reopen a file-backed memmap in another process, or None."""
+    if not isinstance(array, np.memmap) or not isinstance(array.filename, str):
+        return None
+    return array.filename, array.dtype.str, array.offset, array.shape
+
+
+def _open_spec(spec, mode):
+    filename, dtype, offset, shape = spec
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+
+def compose_tile(processor, source, scratch, bounds, correction_map, mode, gradient_strength, with_median):
+    """Pass one for a tile: compose it into scratch and return its partial statistics."""
+    y0, y1, x0, x1 = bounds
+    h, w = source.shape[:2]
+
+    # Window = tile plus a halo large enough for the 35x35 blurs to be exact inside the tile
+    wy0, wy1 = max(0, y0 - IMAGE_HALO), min(h, y1 + IMAGE_HALO)
+    wx0, wx1 = max(0, x0 - IMAGE_HALO), min(w, x1 + IMAGE_HALO)
+    inner = (slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0))
+
+    window = np.ascontiguousarray(source[wy0:wy1, wx0:wx1])
+    layers = processor.decompose_image(window)
+    base_lighting = layers.base_lighting[inner]
+    texture = layers.texture(mode)[inner]
+
+    correction_full = None
+    if mode != 'uniform':
+        correction_full = correction_tile(processor, correction_map, source.shape, bounds)
+
+    composed = processor.compose_correction(
+        base_lighting, texture, correction_full, mode, gradient_strength, target_lighting=0.0
+    )
+    scratch[y0:y1, x0:x1] = composed
+    return TilePartial(
+        original_sum=float(np.sum(layers.original[inner], dtype=np.float64)),
+        composed_sum=float(np.sum(composed, dtype=np.float64)),
+        histograms=lighting_histograms(base_lighting) if with_median else None,
+        pixel_count=(y1 - y0) * (x1 - x0),
+    )
+
+
+def finish_tile(processor, source, scratch, output, bounds, lighting_offset, brightness_blend, color_preservation):
+    """Pass two for a tile: apply the global blends and write the uint8 output."""
+    y0, y1, x0, x1 = bounds
+    composed = np.array(scratch[y0:y1, x0:x1])
+    composed += lighting_offset
+    original = source[y0:y1, x0:x1].astype(np.float32)
+    output[y0:y1, x0:x1] = processor.finish_correction(composed, original, brightness_blend, color_preservation)
+
+
+def correction_tile(processor, correction_map, image_shape, bounds):
+    """Correction field for a tile: cubic resize of a haloed region, then the 25x25 smoothing."""
+    y0, y1, x0, x1 = bounds
+    h, w = image_shape[:2]
+    cy0, cy1 = max(0, y0 - CORRECTION_HALO), min(h, y1 + CORRECTION_HALO)
+    cx0, cx1 = max(0, x0 - CORRECTION_HALO), min(w, x1 + CORRECTION_HALO)
+
+    region = resize_cubic_region(correction_map, image_shape, cy0, cy1, cx0, cx1)
+    # Smooth exactly like prepare_correction_field; the halo makes the tile interior exact
+    smoothed = processor.prepare_correction_field(region, region.shape)
+    return smoothed[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+
+
+def _compose_tile_process(args):
+    """Process-pool worker for pass one, reopening the memory-mapped arrays by file."""
+    processor, source_spec, scratch_spec, bounds, correction_map, mode, gradient_strength, with_median = args
+    return compose_tile(processor, _open_spec(source_spec, 'r'), _open_spec(scratch_spec, 'r+'),
+                        bounds, correction_map, mode, gradient_strength, with_median)
+
+
+def _finish_tile_process(args):
+    """Process-pool worker for pass two."""
+    processor, source_spec, scratch_spec, output_spec, bounds, lighting_offset, brightness_blend, color_preservation = args
+    output = _open_spec(output_spec, 'r+')
+    finish_tile(processor, _open_spec(source_spec, 'r'), _open_spec(scratch_spec, 'r'), output,
+                bounds, lighting_offset, brightness_blend, color_preservation)
+    output.flush()
+
+
+class TiledCorrectionEngine:
+    """Applies GradientRemovalProcessor's correction tile by tile within a memory budget.
+
+    If the processor has a ParallelEngine, tiles run concurrently on it and the
+    budget is shared between the concurrent tiles.
+    """
+
+    def __init__(self, processor, memory_budget_bytes=512 * 1024**2, tile_size=None):
+        self.processor = processor
+        self.memory_budget_bytes = memory_budget_bytes
+        self.tile_size = tile_size
+
+    @property
+    def parallel(self):
+        return self.processor.parallel
+
+    def tile_shape(self, image_shape):
+        """Tile (height, width) so the concurrent tiles plus halos stay within the memory budget."""
+        h, w = image_shape[:2]
+        if self.tile_size is not None:
+            return min(h, self.tile_size), min(w, self.tile_size)
+
+        concurrent_tiles = self.parallel.workers if self.parallel is not None else 1
+        budget_pixels = self.memory_budget_bytes // (BYTES_PER_PIXEL * concurrent_tiles)
+        side = max(MIN_TILE_SIZE, int(math.sqrt(budget_pixels)) - 2 * IMAGE_HALO)
+        tile_w = min(w, side)
+        # Narrow images get taller tiles for the same budget
+        tile_h = max(MIN_TILE_SIZE, budget_pixels // (tile_w + 2 * IMAGE_HALO) - 2 * IMAGE_HALO)
+        return min(h, tile_h), tile_w
+
+    def tiles(self, image_shape):
+        """Yield (y0, y1, x0, x1) bounds of the tiles covering the image."""
+        h, w = image_shape[:2]
+        tile_h, tile_w = self.tile_shape(image_shape)
+        for y0 in range(0, h, tile_h):
+            for x0 in range(0, w, tile_w):
+                yield y0, min(h, y0 + tile_h), x0, min(w, x0 + tile_w)
+
+    @timed_stage('tiled_apply')
+    def apply(self, source, correction_map, mode='advanced',
+              gradient_strength=0.5, brightness_preservation=0.8, color_preservation=0.9,
+              output_path=None):
+        """Tiled equivalent of GradientRemovalProcessor.apply_gradient_correction.
+
+        source is an HxWx3 uint8 array, typically memory-mapped (see open_source).
+        Returns the corrected image as a uint8 memmap, written to output_path as
+        .npy if given, otherwise to a temporary file.
+        """
+        h, w = source.shape[:2]
+        tiles = list(self.tiles(source.shape))
+        logger.info(f"Tiled gradient correction - {w}x{h} in {len(tiles)} tiles of {self.tile_shape(source.shape)}")
+
+        use_processes = self.parallel is not None and self.parallel.kind == 'process'
+        if use_processes and memmap_spec(source) is None:
+            logger.info("Source is not file-backed, running tiles in threads instead of processes")
+            use_processes = False
+
+        output = self._open_output(output_path, (h, w, 3), named=use_processes)
+        if gradient_strength == 0:
+            logger.info("Gradient strength is 0, copying original image")
+            for y0, y1, x0, x1 in tiles:
+                output[y0:y1, x0:x1] = source[y0:y1, x0:x1]
+            output.flush()
+            return output
+
+        with tempfile.NamedTemporaryFile(suffix='.scratch') if use_processes else tempfile.TemporaryFile() as scratch_file:
+            scratch = np.memmap(scratch_file, dtype=np.float32, mode='w+', shape=(h, w, 3))
+            # Tiles never use the processor's own parallelism; they are the unit of parallel work
+            processor = self.processor.serial()
+
+            # Pass one: compose each tile into scratch and gather global statistics
+            with_median = mode == 'uniform'
+            if use_processes:
+                source_spec, scratch_spec = memmap_spec(source), memmap_spec(scratch)
+                scratch.flush()
+                partials = self.parallel.executor.map(_compose_tile_process, [
+                    (processor, source_spec, scratch_spec, bounds, correction_map, mode, gradient_strength, with_median)
+                    for bounds in tiles
+                ])
+            else:
+                partials = self._map_tiles(lambda bounds: compose_tile(
+                    processor, source, scratch, bounds, correction_map, mode, gradient_strength, with_median
+                ), tiles)
+            # Partials are folded in as they arrive, so only the running histograms stay in memory
+            stats = TileStatistics.merge(partials)
+
+            # Uniform mode blends towards the global median lighting, which is only known now
+            lighting_offset = np.zeros(3, dtype=np.float32)
+            if mode == 'uniform':
+                lighting_offset = gradient_strength * stats.median_lighting()
+
+            pixel_count = float(h * w)
+            original_brightness = stats.original_sum / (pixel_count * 3)
+            corrected_brightness = (stats.composed_sum + float(np.sum(lighting_offset)) * pixel_count) / (pixel_count * 3)
+            brightness_blend = self.processor.brightness_blend_factor(
+                original_brightness, corrected_brightness, brightness_preservation
+            )
+
+            # Pass two: apply the global blends and write the output
+            if use_processes:
+                scratch.flush()
+                output_spec = memmap_spec(output)
+                self.parallel.map(_finish_tile_process, [
+                    (processor, source_spec, scratch_spec, output_spec, bounds,
+                     lighting_offset, brightness_blend, color_preservation)
+                    for bounds in tiles
+                ])
+            else:
+                list(self._map_tiles(lambda bounds: finish_tile(
+                    processor, source, scratch, output, bounds, lighting_offset, brightness_blend, color_preservation
+                ), tiles))
+
+        output.flush()
+        if use_processes and output_path is None:
+            # Workers are done with the temporary output; the mapping stays valid after unlinking
+            os.unlink(output.filename)
+        return output
+
+    def _map_tiles(self, func, tiles):
+        """func over tiles, as an iterator of results in tile order."""
+        if self.parallel is None:
+            return (func(bounds) for bounds in tiles)
+        return self.parallel.thread_executor.map(func, tiles)
+
+    def _open_output(self, output_path, shape, named=False):
+        if output_path is not None:
+            return np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8, shape=shape)
+        if named:
+            # Worker processes reopen the output by name; it is unlinked once they are done
+            with tempfile.NamedTemporaryFile(suffix='.npy', delete=False) as output_file:
+                path = output_file.name
+            return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=shape)
+
+
+class TilePartial:
+    """Statistics of one tile from pass one."""
+
+    def __init__(self, original_sum, composed_sum, histograms, pixel_count):
+        self.original_sum = original_sum
+        self.composed_sum = composed_sum
+        self.histograms = histograms
+        self.pixel_count = pixel_count
+
+
+def lighting_histograms(base_lighting):
+    """Per-channel histograms of base lighting values for the global median."""
+    # Lighting is a blur of 8-bit data, so it lies in [0, 255]; fine bins make the
+    # median accurate to ~0.002 levels
+    bins = np.clip(base_lighting * (MEDIAN_BINS / 256.0), 0, MEDIAN_BINS - 1).astype(np.int64)
+    return np.stack([
+        np.bincount(bins[:, :, channel].ravel(), minlength=MEDIAN_BINS)
+        for channel in range(3)
+    ])
+
+
+class TileStatistics:
+    """Global sums and lighting histograms merged from all tiles."""
+
+    def __init__(self):
+        self.original_sum = 0.0
+        self.composed_sum = 0.0
+        self.histograms = None
+        self.count = 0
+
+    @classmethod
+    def merge(cls, partials):
+        # Merge in tile order so results don't depend on scheduling
+        stats = cls()
+        for partial in partials:
+            stats.add(partial)
+        return stats
+
+    def add(self, partial):
+        self.original_sum += partial.original_sum
+        self.composed_sum += partial.composed_sum
+        self.count += partial.pixel_count
+        if partial.histograms is not None:
+            if self.histograms is None:
+                self.histograms = partial.histograms.copy()
+            else:
+                self.histograms += partial.histograms
+            # The running total holds the counts now
+            partial.histograms = None
+
+    def median_lighting(self):
+        """Per-channel median of the base lighting, from the histograms."""
+        medians = np.empty(3, dtype=np.float32)
+        for channel in range(3):
+            cumulative = np.cumsum(self.histograms[channel])
+            index = int(np.searchsorted(cumulative, (self.count + 1) / 2.0))
+            medians[channel] = (index + 0.5) * (256.0 / MEDIAN_BINS)
+        return medians
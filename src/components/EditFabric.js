@@ -40,6 +40,17 @@ const EditFabric = () => {
   const containerRef = useRef(null);
   const previewCanvasRef = useRef(null);
   const fileInputRef = useRef(null);
+  // Server-side session for the current image so slider changes don't re-upload it
+  const serverImageRef = useRef({ source: null, imageId: null });
+  // Job session of this editor: each new job supersedes its older previews on the server
+  const jobSessionRef = useRef(null);
+  if (jobSessionRef.current === null) {
+    jobSessionRef.current = window.crypto && window.crypto.randomUUID
+      ? window.crypto.randomUUID()
+      : `editor-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  }
+  // Number of the latest gradient removal request; older ones don't touch the state
+  const latestRequestRef = useRef(0);
 
   const validateFile = (file) => {
     const maxSize = 10 * 1024 * 1024; // 10MB
@@ -142,62 +153,137 @@ const EditFabric = () => {
     }
   };
 
-  const processGradientRemoval = useCallback(async () => {
-    if (!selectionArea || !selectedImage) return;
+  // Request a gradient-removed image from the backend as an asynchronous job.
+  // Previews are rendered at screen size; 'final' runs at full resolution with the
+  // same analysis. Returns null if the job failed or a newer one superseded it.
+  const fetchGradientRemoval = useCallback(async (quality) => {
+    const img = imageRef.current;
     
-    console.log('Processing gradient removal with:', {
-      selection: selectionArea, 
-      mode: gradientRemovalMode,
-      strength: gradientStrength,
-      brightness: brightnessPreservation,
-      color: colorPreservation
-    });
-    setIsProcessing(true);
-    try {
+    const uploadImage = async () => {
       const canvas = document.createElement('canvas');
       const ctx = canvas.getContext('2d');
-      const img = imageRef.current;
-      
       canvas.width = img.naturalWidth;
       canvas.height = img.naturalHeight;
       ctx.drawImage(img, 0, 0);
       
       const imageData = canvas.toDataURL('image/jpeg', 0.9);
-      
-      const response = await fetch('http://localhost:5001/api/gradient-removal', {
+      const uploadResponse = await fetch('http://localhost:5001/api/images', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({
-          image: imageData,
-          selection: selectionArea,
-          mode: gradientRemovalMode,
-          imageSize: {
-            width: img.naturalWidth,
-            height: img.naturalHeight
-          },
-          settings: {
-            gradientStrength: gradientStrength / 100,
-            brightnessPreservation: brightnessPreservation / 100,
-            colorPreservation: colorPreservation / 100
-          }
-        }),
+        body: JSON.stringify({ image: imageData }),
       });
-      
-      if (response.ok) {
-        const result = await response.json();
-        setGradientPreview(result.processedImage);
+      if (!uploadResponse.ok) {
+        throw new Error(`Image upload failed: ${uploadResponse.status}`);
+      }
+      const { imageId } = await uploadResponse.json();
+      serverImageRef.current = { source: selectedImage, imageId };
+      return imageId;
+    };
+    
+    const displayDimension = Math.max(imageDisplaySize.width, imageDisplaySize.height) * (window.devicePixelRatio || 1);
+    const previewMaxDimension = displayDimension > 0
+      ? Math.min(8192, Math.max(64, Math.ceil(displayDimension)))
+      : 1280;
+    
+    const submitJob = (imageId) => fetch('http://localhost:5001/api/jobs', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        imageId,
+        sessionId: jobSessionRef.current,
+        selection: selectionArea,
+        mode: gradientRemovalMode,
+        quality,
+        previewMaxDimension,
+        imageSize: {
+          width: img.naturalWidth,
+          height: img.naturalHeight
+        },
+        settings: {
+          gradientStrength: gradientStrength / 100,
+          brightnessPreservation: brightnessPreservation / 100,
+          colorPreservation: colorPreservation / 100
+        }
+      }),
+    });
+    
+    // Upload only when the image changed since the last request
+    let imageId = serverImageRef.current.source === selectedImage
+      ? serverImageRef.current.imageId
+      : await uploadImage();
+    let response = await submitJob(imageId);
+    
+    // The server may have evicted the session; upload again and retry once
+    if (response.status === 404) {
+      imageId = await uploadImage();
+      response = await submitJob(imageId);
+    }
+    
+    // The job queue is full; try once more when the server says it has room
+    if (response.status === 429) {
+      const retryAfter = Number(response.headers.get('Retry-After')) || 1;
+      await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+      response = await submitJob(imageId);
+    }
+    
+    if (!response.ok) {
+      console.error('Gradient removal failed:', response.status);
+      return null;
+    }
+    const { jobId } = await response.json();
+    
+    // Long-poll until the job finishes
+    for (;;) {
+      const statusResponse = await fetch(`http://localhost:5001/api/jobs/${jobId}?wait=10`);
+      if (!statusResponse.ok) {
+        console.error('Gradient removal job lookup failed:', statusResponse.status);
+        return null;
+      }
+      const job = await statusResponse.json();
+      if (job.status === 'succeeded') {
+        return job.processedImage;
+      }
+      if (job.status === 'failed') {
+        console.error('Gradient removal failed:', job.error);
+        return null;
+      }
+      if (job.status === 'cancelled') {
+        // Superseded by a newer request from this editor
+        return null;
+      }
+    }
+  }, [selectionArea, selectedImage, gradientRemovalMode, gradientStrength, brightnessPreservation, colorPreservation, imageDisplaySize]);
+
+  const processGradientRemoval = useCallback(async () => {
+    if (!selectionArea || !selectedImage) return;
+    
+    console.log('Processing gradient removal with:', {
+      selection: selectionArea, 
+      mode: gradientRemovalMode,
+      strength: gradientStrength,
+      brightness: brightnessPreservation,
+      color: colorPreservation
+    });
+    const requestNumber = ++latestRequestRef.current;
+    setIsProcessing(true);
+    try {
+      const processedImage = await fetchGradientRemoval('preview');
+      if (processedImage && requestNumber === latestRequestRef.current) {
+        setGradientPreview(processedImage);
         console.log('Gradient removal successful');
-      } else {
-        console.error('Gradient removal failed:', response.status);
       }
     } catch (error) {
       console.error('Gradient removal processing failed:', error);
     } finally {
-      setIsProcessing(false);
+      if (requestNumber === latestRequestRef.current) {
+        setIsProcessing(false);
+      }
     }
-  }, [selectionArea, selectedImage, gradientRemovalMode, gradientStrength, brightnessPreservation, colorPreservation]);
+  }, [selectionArea, selectedImage, gradientRemovalMode, gradientStrength, brightnessPreservation, colorPreservation, fetchGradientRemoval]);
 
   // Debounced processing for real-time updates
   const debouncedProcessGradientRemoval = useCallback(
@@ -222,9 +308,24 @@ const EditFabric = () => {
     }
   }, [gradientStrength, brightnessPreservation, colorPreservation, debouncedProcessGradientRemoval]);
 
-  const applyGradientRemoval = () => {
+  const applyGradientRemoval = async () => {
     if (gradientPreview) {
-      setSelectedImage(gradientPreview);
+      // The preview is screen-sized; render the final result at full resolution
+      const requestNumber = ++latestRequestRef.current;
+      setIsProcessing(true);
+      let finalImage = null;
+      try {
+        finalImage = await fetchGradientRemoval('final');
+      } catch (error) {
+        console.error('Gradient removal processing failed:', error);
+      } finally {
+        if (requestNumber === latestRequestRef.current) {
+          setIsProcessing(false);
+        }
+      }
+      if (!finalImage || requestNumber !== latestRequestRef.current) return;
+      
+      setSelectedImage(finalImage);
       setEditorMode('crop');
       setSelectionArea(null);
       setGradientPreview(null);